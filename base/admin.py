@@ -30,6 +30,8 @@ import time
 import traceback
 import urllib
 
+from google.appengine.api import datastore
+from google.appengine.api import memcache
 from google.appengine.api.labs import taskqueue
 from google.appengine.ext import db
 
@@ -38,10 +40,15 @@ from categories import all_test_sets
 from base import decorators
 from base import manage_dirty
 from base import util
+from models import mapper
+from models import result_archive
 from models import result_stats
+from models import user_test
 from models.result import ResultParent
+from models.result import ResultParentDirty
 from models.result import ResultTime
 from models.user_agent import UserAgent
+from models.user_agent import UserAgentChangeLog
 #from models.user_agent import UserAgentGroup
 
 from django import http
@@ -54,6 +61,24 @@ add_to_builtins('base.custom_filters')
 
 UPDATE_ALL_BATCH_SIZE = 25
 UPDATE_ALL_UNCACHED_BATCH_SIZE = 250
+# Browsers per UpdateStatsCache call and seconds of work per task.
+UPDATE_STATS_CACHE_CHUNK_SIZE = 10
+UPDATE_STATS_CACHE_TIME_BUDGET = 20
+
+UPDATE_UA_STRING_LISTS_BATCH_SIZE = 200
+UPDATE_UA_STRING_LISTS_TIME_BUDGET = 20
+# Each task of a chain renews the lease; a lost chain is restarted once it
+# expires.
+UPDATE_UA_STRING_LISTS_LEASE_KEY = 'update_ua_string_lists_chain'
+UPDATE_UA_STRING_LISTS_LEASE_SECONDS = 300
+
+ARCHIVE_RESULTS_TIME_BUDGET = 20
+# User tests whose categories are queued per ArchiveResults task.
+ARCHIVE_USER_TESTS_BATCH_SIZE = 100
+
+MIGRATE_DIRTY_BATCH_SIZE = 200
+MIGRATE_DIRTY_TIME_BUDGET = 20
+MIGRATE_DIRTY_MAPPER_NAME = 'migrate_dirty_result_times'
 
 
 def Render(request, template_file, params):
@@ -83,18 +108,25 @@ def GetDirty(request):
   if dirty == '1':
     is_dirty = True
 
-  parents = db.Query(ResultParent)
-  parents.filter('category =', category)
+  if is_dirty:
+    markers = ResultParentDirty.all().filter('category =', category)
+    # A marker can outlive its parent.
+    parents = [p for p in db.get([m.parent_key() for m in markers.fetch(10)])
+               if p]
+  else:
+    parents = db.Query(ResultParent)
+    parents.filter('category =', category)
+    parents = parents.fetch(10)
 
   dirtys = []
-  for parent in parents.fetch(10):
+  for parent in parents:
     logging.info('parent %s' % parent.key())
-    time = db.Query(ResultTime)
-    if is_dirty:
-      time.filter('dirty =', True)
-    time.ancestor(parent)
-    logging.info('time.count() %s' % time.count())
-    if time.count() > 0:
+    has_result_times = is_dirty
+    if not is_dirty:
+      time = db.Query(ResultTime, keys_only=True)
+      time.ancestor(parent)
+      has_result_times = time.get() is not None
+    if has_result_times:
       key = parent.key()
       dirtys.append(
           '<a href="/admin/schedule-dirty-update?result_parent_key=%s">'
@@ -191,13 +223,47 @@ def Stats(request):
   return util.Render(request, 'admin/stats.html', params)
 
 
+DATA_DUMP_COLUMNS = {
+    'ResultParent': ('result_parent_key', 'category', 'user_agent_key', 'ip',
+                     'user_id', 'created', 'params_str', 'loader_id'),
+    'ResultTime': ('result_time_key', 'result_parent_key', 'test', 'score'),
+    'UserAgent': ('user_agent_key', 'string', 'family', 'v1', 'v2', 'v3',
+                  'confirmed', 'created', 'js_user_agent_string'),
+    }
+
+
+def RunResultTimeQueries(result_parent_keys):
+  """Start an ancestor ResultTime query for each ResultParent key.
+
+  With SDKs where Query.run starts fetching right away, all the queries are
+  in flight together. Older SDKs fetch each one as it is read.
+
+  Returns:
+    a list of iterables of ResultTime instances (one per key).
+  """
+  queries = [ResultTime.all().ancestor(k) for k in result_parent_keys]
+  try:
+    return [query.run(limit=1000, batch_size=1000) for query in queries]
+  except TypeError:
+    return [query.fetch(1000) for query in queries]
+
+
 @decorators.admin_required
 def DataDump(request):
-  """This is used by bin/data_dump.py to replicate the datastore."""
+  """This is used by bin/data_dump.py to replicate the datastore.
+
+  With "format=compact", rows are lists in the order of
+  DATA_DUMP_COLUMNS[model_class] headed by the model class, and the
+  response includes the column names. Lost and dirty keys stay as dicts.
+
+  With "model=ResultArchive", the archived results are returned as
+  ResultParent and ResultTime rows followed by an "archive_key" dict.
+  """
   model = request.REQUEST.get('model')
   key_prefix = request.REQUEST.get('key_prefix', '')
   keys_list = request.REQUEST.get('keys')
   time_limit = int(request.REQUEST.get('time_limit', 3))
+  is_compact = request.REQUEST.get('format') == 'compact'
 
   if keys_list:
     keys = ['%s%s' % (key_prefix, key) for key in keys_list.split(',')]
@@ -206,37 +272,29 @@ def DataDump(request):
 
   start_time = datetime.datetime.now()
 
-  if model == 'ResultParent':
-    query = pager.PagerQuery(ResultParent, keys_only=True)
-  elif model == 'UserAgent':
-    query = pager.PagerQuery(UserAgent)
-  else:
+  if model not in ('ResultParent', 'UserAgent', 'ResultArchive'):
     return http.HttpResponseBadRequest(
-        'model must be one of "ResultParent", "UserAgent".')
+        'model must be one of "ResultParent", "UserAgent", "ResultArchive".')
   data = []
   error = None
   if model == 'ResultParent':
-    result_time_query = ResultTime.gql('WHERE ANCESTOR IS :1')
-    for result_parent_key in keys:
-      if (datetime.datetime.now() - start_time).seconds > time_limit:
-        error = 'Over time limit'
-        break
-      try:
-        p = ResultParent.get(result_parent_key)
-      except db.Timeout:
-        error = 'db.Timeout: ResultParent'
-        break
+    try:
+      result_parents = ResultParent.get(keys)
+    except db.Timeout:
+      error = 'db.Timeout: ResultParent'
+      result_parents = []
+    result_times_list = iter(RunResultTimeQueries(
+        [p.key() for p in result_parents if p]))
+    for result_parent_key, p in zip(keys, result_parents):
       if not p:
         data.append({
           'model_class': 'ResultParent',
           'lost_key': result_parent_key,
           })
         continue
-      result_time_query.bind(p.key())
-      try:
-        result_times = result_time_query.fetch(1000)
-      except db.Timeout:
-        error = 'db.Timeout: ResultTime'
+      result_times = result_times_list.next()
+      if (datetime.datetime.now() - start_time).seconds > time_limit:
+        error = 'Over time limit'
         break
       row_data = [{
           'model_class': 'ResultParent',
@@ -251,21 +309,63 @@ def DataDump(request):
           'loader_id': hasattr(p, 'loader_id') and p.loader_id or None,
           }]
       is_dirty = False
-      for result_time in result_times:
-        if result_time.dirty:
-          is_dirty = True
-          break
-        row_data.append({
-            'model_class': 'ResultTime',
-            'result_time_key': str(result_time.key()),
-            'result_parent_key': str(result_parent_key),
-            'test': result_time.test,
-            'score': result_time.score,
-            })
+      try:
+        for result_time in result_times:
+          if result_time.dirty:
+            is_dirty = True
+            break
+          row_data.append({
+              'model_class': 'ResultTime',
+              'result_time_key': str(result_time.key()),
+              'result_parent_key': str(result_parent_key),
+              'test': result_time.test,
+              'score': result_time.score,
+              })
+      except db.Timeout:
+        error = 'db.Timeout: ResultTime'
+        break
       if is_dirty:
         data.append({'dirty_key': result_parent_key,})
       else:
         data.extend(row_data)
+  elif model == 'ResultArchive':
+    try:
+      archives = result_archive.ResultArchive.get(keys)
+    except db.Timeout:
+      error = 'db.Timeout: ResultArchive'
+      archives = []
+    for key, archive in zip(keys, archives):
+      if (datetime.datetime.now() - start_time).seconds > time_limit:
+        error = 'Over time limit'
+        break
+      if not archive:
+        data.append({
+            'model_class': 'ResultArchive',
+            'lost_key': key,
+            })
+        continue
+      for p in archive.GetResults():
+        result_parent_key = str(p.key())
+        data.append({
+            'model_class': 'ResultParent',
+            'result_parent_key': result_parent_key,
+            'category': p.category,
+            'user_agent_key': str(p.user_agent_key),
+            'ip': p.ip,
+            'user_id': p.user_id,
+            'created': p.created.isoformat(),
+            'params_str': p.params_str,
+            'loader_id': p.loader_id,
+            })
+        for result_time in p.GetResultTimes():
+          data.append({
+              'model_class': 'ResultTime',
+              'result_time_key': str(result_time.key()),
+              'result_parent_key': result_parent_key,
+              'test': result_time.test,
+              'score': result_time.score,
+              })
+      data.append({'archive_key': key})
   elif model == 'UserAgent':
     try:
       user_agents = UserAgent.get(keys)
@@ -292,18 +392,33 @@ def DataDump(request):
               'model_class': 'UserAgent',
               'lost_key': key,
               })
+  if is_compact:
+    compact_data = []
+    for row in data:
+      if 'lost_key' in row or 'dirty_key' in row or 'archive_key' in row:
+        compact_data.append(row)
+      else:
+        columns = DATA_DUMP_COLUMNS[row['model_class']]
+        compact_data.append([row['model_class']] + [row[c] for c in columns])
+    data = compact_data
   response_params = {
       'data': data,
       }
+  if is_compact:
+    response_params['columns'] = DATA_DUMP_COLUMNS
   if error:
     response_params['error'] = error
-  return http.HttpResponse(content=simplejson.dumps(response_params),
-                           content_type='application/json')
+  return http.HttpResponse(
+      content=simplejson.dumps(response_params, separators=(',', ':')),
+      content_type='application/json')
 
 
 @decorators.admin_required
 def DataDumpKeys(request):
-  """This is used by bin/data_dump.py to get ResultParent keys."""
+  """This is used by bin/data_dump.py to get ResultParent keys.
+
+  Archived results are listed with "model=ResultArchive".
+  """
   bookmark = request.REQUEST.get('bookmark')
   model_name = request.REQUEST.get('model')
   count = int(request.REQUEST.get('count', 0))
@@ -316,6 +431,7 @@ def DataDumpKeys(request):
       'UserAgent': UserAgent,
       'ResultParent': ResultParent,
       'ResultTime': ResultTime,
+      'ResultArchive': result_archive.ResultArchive,
       }
   model = models.get(model_name, UserAgent)
   query = pager.PagerQuery(model, keys_only=True)
@@ -394,6 +510,60 @@ def UpdateCategory(request):
     return http.HttpResponse('No user_agent with this key.')
 
 
+CATEGORY_UPDATE_LEASE_SECONDS = 120
+CATEGORY_UPDATE_BATCH_SIZE = 200
+CATEGORY_UPDATE_TIME_BUDGET = 20
+
+
+def UpdateCategories(request):
+  """Lease category update tasks in batches and apply them together.
+
+  Each task payload is "category user_agent_key" (see
+  manage_dirty.ScheduleCategoryUpdate). Tasks are deleted once their batch
+  is done; a failed batch is leased again after it expires.
+  """
+  queue = taskqueue.Queue(manage_dirty.CATEGORY_UPDATE_PULL_QUEUE)
+  start = time.time()
+  num_tasks = 0
+  while time.time() - start < CATEGORY_UPDATE_TIME_BUDGET:
+    tasks = queue.lease_tasks(CATEGORY_UPDATE_LEASE_SECONDS,
+                              CATEGORY_UPDATE_BATCH_SIZE)
+    if not tasks:
+      break
+    category_keys = []
+    for task in tasks:
+      # Bad tasks are logged and deleted with the rest of the batch.
+      try:
+        category, user_agent_key = task.payload.split(' ', 1)
+        user_agent_key = db.Key(user_agent_key)
+      except (ValueError, db.BadKeyError):
+        logging.warn('UpdateCategories: Bad payload: %r', task.payload)
+        continue
+      if all_test_sets.GetTestSet(category):
+        category_keys.append((category, user_agent_key))
+      else:
+        logging.info('UpdateCategories: Bad category: %s', category)
+    user_agents = UserAgent.get([key for category, key in category_keys])
+    result_stats.UpdateCategories(
+        [(category, user_agent) for (category, key), user_agent
+         in zip(category_keys, user_agents) if user_agent])
+    queue.delete_tasks(tasks)
+    num_tasks += len(tasks)
+  logging.info('UpdateCategories: %s tasks in %.1fs',
+               num_tasks, time.time() - start)
+  return http.HttpResponse('Done with %s tasks.' % num_tasks)
+
+
+@decorators.admin_required
+def ResetStaticDelta(request):
+  """Forget the live rows of a static category after a new snapshot."""
+  category = request.REQUEST.get('category')
+  if not category:
+    return http.HttpResponseServerError('Must set "category".')
+  result_stats.StaticDeltaLog.Clear(category)
+  return http.HttpResponse('Success.')
+
+
 @decorators.admin_required
 def UpdateSummaryBrowsers(request):
   """Update all the browsers for the summary category."""
@@ -422,25 +592,49 @@ def UpdateStatsCache(request):
         category, browsers)
     logging.debug('Uncached \'%s\' stats (count: %s out of %s): %s',
                   category, len(browsers), num_checked_browsers, browsers)
-  # Only process one browser in each task.
-  if len(browsers) > 1:
+  # Process chunks of browsers until the time budget runs out, then queue
+  # the rest. Each chunk is saved to memcache as it is done.
+  start = time.time()
+  num_browsers = 0
+  while browsers:
+    chunk = browsers[:UPDATE_STATS_CACHE_CHUNK_SIZE]
+    browsers = browsers[UPDATE_STATS_CACHE_CHUNK_SIZE:]
+    unhandled_browsers = result_stats.CategoryStatsManager.UpdateStatsCache(
+        category, chunk)
+    if unhandled_browsers:
+      num_browsers += len(chunk) - len(unhandled_browsers)
+      browsers = unhandled_browsers + browsers
+      break
+    num_browsers += len(chunk)
+    if time.time() - start > UPDATE_STATS_CACHE_TIME_BUDGET:
+      break
+  if browsers:
     attempt = 0
     while attempt < 3:
       try:
         taskqueue.Task(params={
             'category': category,
-            'browsers': ','.join(browsers[1:]),
+            'browsers': ','.join(browsers),
             }).add(queue_name='update-stats-cache')
         break
       except:
         attempt += 1
-  result_stats.CategoryStatsManager.UpdateStatsCache(category, browsers[:1])
+  elapsed = time.time() - start
+  logging.info('UpdateStatsCache: category=%s, %s browsers in %.1fs '
+               '(%.1f/s), %s queued', category, num_browsers, elapsed,
+               num_browsers / max(elapsed, 0.001), len(browsers))
   return http.HttpResponse('Success.')
 
 
 def UpdateAllStatsCache(request, batch_size=UPDATE_ALL_BATCH_SIZE,
                         is_uncached_update=False):
+  """Queue stats cache updates for the browsers of each category.
+
+  With "changed=1", only the browsers with new results since the last
+  changed-only refresh are updated (see result_stats.StatsRefreshLog).
+  """
   categories_str = request.REQUEST.get('categories')
+  is_changed_only = request.REQUEST.get('changed')
   if categories_str:
     categories = categories_str.split(',')
   else:
@@ -452,8 +646,10 @@ def UpdateAllStatsCache(request, batch_size=UPDATE_ALL_BATCH_SIZE,
       attempt = 0
       while attempt < 3:
         try:
-          task = taskqueue.Task(url=request.path,
-                                params={'categories': category})
+          params = {'categories': category}
+          if is_changed_only:
+            params['changed'] = 1
+          task = taskqueue.Task(url=request.path, params=params)
           task.add(queue_name='update-stats-cache')
           break
         except:
@@ -462,8 +658,12 @@ def UpdateAllStatsCache(request, batch_size=UPDATE_ALL_BATCH_SIZE,
                              categories)
   category = categories[0]
   test_set = all_test_sets.GetTestSet(category)
-  browsers = result_stats.CategoryBrowserManager.GetAllBrowsers(category)
-  logging.info('Update all stats cache: %s', category)
+  if is_changed_only:
+    browsers = result_stats.StatsRefreshLog.TakeBrowsers(category)
+  else:
+    browsers = result_stats.CategoryBrowserManager.GetAllBrowsers(category)
+  logging.info('Update all stats cache: %s (%s browsers)',
+               category, len(browsers))
   for i in range(0, len(browsers), batch_size):
     params={
         'category': category,
@@ -487,36 +687,257 @@ def UpdateAllUncachedStats(request, batch_size=UPDATE_ALL_UNCACHED_BATCH_SIZE):
   return UpdateAllStatsCache(request, batch_size, is_uncached_update=True)
 
 
+class ResultParentStringListMapper(mapper.Mapper):
+  """Copy a user agent's string list into its ResultParents."""
+  KIND = ResultParent
+
+  def __init__(self, user_agent):
+    self.FILTERS = [('user_agent', user_agent.key())]
+    self.string_list = user_agent.get_string_list()
+
+  def map(self, parent):
+    if parent.user_agent_string_list == self.string_list:
+      return [], []
+    parent.user_agent_string_list = self.string_list
+    return [parent], []
+
 
 def UpdateUserAgentStringListInResultParentForBrowse(request):
-    """Browse results uses this list and it can be out of sync."""
+    """Browse results uses this list and it can be out of sync.
+
+    Logs the matching user agents as changed and starts
+    UpdateUserAgentStringLists to fix their ResultParents.
+    """
     ua_string = request.REQUEST.get('ua')
-    category = request.REQUEST.get('category')
 
     family, v1, v2, v3 = UserAgent.parse_pretty(ua_string)
     logging.info('family %s, v1 %s, v2 %s, v3 %s' % (family, v1, v2, v3))
-    user_agent = db.Query(UserAgent)
+    user_agent = db.Query(UserAgent, keys_only=True)
     user_agent.filter('family =', family)
     user_agent.filter('v1 =', v1)
     user_agent.filter('v2 =', v2)
     user_agent.filter('v3 =', v3)
-
-    logging.info('UA COUNT: %s' % user_agent.count())
-    user_agents = user_agent.fetch(1000)
-    for user_agent in user_agents:
-      logging.info('-----------------------')
-      string_list = user_agent.get_string_list()
-      logging.info('UA: %s, %s', (user_agent.key(), string_list))
-      parents = db.Query(ResultParent)
-      parents.filter('user_agent =', user_agent.key())
-      if category:
-        parents.filter('category =', category)
-
-      logging.info('PARENTS COUNT: %s' % parents.count())
-      for parent in parents.fetch(1000):
-        logging.info('PARENT: %s' % parent.key())
-        parent.user_agent_string_list = string_list
-        parent.put()
-
-    return http.HttpResponse('All done MF')
-
+    user_agent_keys = user_agent.fetch(1000)
+    db.put([UserAgentChangeLog(key_name=str(key)) for key in user_agent_keys])
+    taskqueue.Task(url='/admin/update_ua_string_lists', method='GET').add()
+    return http.HttpResponse('Queued %s user agents.' % len(user_agent_keys))
+
+
+def UpdateUserAgentStringLists(request):
+  """Copy the string lists of changed user agents into their results.
+
+  Live ResultParents are updated by a mapper and archived results by
+  re-packing their archives (see result_archive.UpdateArchivedStringLists).
+
+  Works through UserAgentChangeLog for UPDATE_UA_STRING_LISTS_TIME_BUDGET
+  seconds and then queues itself to continue. The mapper of each user agent
+  saves its progress, so the next task resumes where this one stopped.
+
+  Only one chain of tasks runs at a time: a request without "chain" (cron or
+  a new change) starts one only if no other chain holds the memcache lease.
+  """
+  chain = request.GET.get('chain')
+  if not chain:
+    chain = str(time.time())
+    if not memcache.add(UPDATE_UA_STRING_LISTS_LEASE_KEY, chain,
+                        time=UPDATE_UA_STRING_LISTS_LEASE_SECONDS):
+      logging.info('UpdateUserAgentStringLists: a chain is already running.')
+      return http.HttpResponse('Already running.')
+  elif memcache.get(UPDATE_UA_STRING_LISTS_LEASE_KEY) not in (None, chain):
+    logging.info('UpdateUserAgentStringLists: chain %s was replaced.', chain)
+    return http.HttpResponse('Replaced by another chain.')
+  else:
+    memcache.set(UPDATE_UA_STRING_LISTS_LEASE_KEY, chain,
+                 time=UPDATE_UA_STRING_LISTS_LEASE_SECONDS)
+  start = time.time()
+  deadline = start + UPDATE_UA_STRING_LISTS_TIME_BUDGET
+  num_user_agents = num_parents = 0
+  is_done = False
+  while time.time() < deadline:
+    change_log = UserAgentChangeLog.all().order('__key__').get()
+    if change_log is None:
+      is_done = True
+      break
+    user_agent = db.get(change_log.GetUserAgentKey())
+    # A user agent logged again gets a fresh mapper run.
+    mapper_name = 'ua_string_list_%s_%s%06d' % (
+        change_log.GetUserAgentKey().id_or_name(),
+        change_log.created.strftime('%Y%m%d%H%M%S'),
+        change_log.created.microsecond)
+    if user_agent:
+      parent_mapper = ResultParentStringListMapper(user_agent)
+      num_parents += parent_mapper.run(
+          batch_size=UPDATE_UA_STRING_LISTS_BATCH_SIZE,
+          name=mapper_name, deadline=deadline)
+      if not parent_mapper.is_done:
+        break
+      result_archive.UpdateArchivedStringLists(user_agent)
+    change_log.DeleteIfUnchanged()
+    mapper.MapperShardState.ClearShards(mapper_name, 1)
+    num_user_agents += 1
+  if is_done:
+    if memcache.get(UPDATE_UA_STRING_LISTS_LEASE_KEY) == chain:
+      memcache.delete(UPDATE_UA_STRING_LISTS_LEASE_KEY)
+  else:
+    taskqueue.Task(url=request.path, method='GET',
+                   params={'chain': chain}).add()
+  elapsed = time.time() - start
+  logging.info('UpdateUserAgentStringLists: %s user agents, %s parents in '
+               '%.1fs (%.1f/s), done=%s', num_user_agents, num_parents,
+               elapsed, num_parents / max(elapsed, 0.001), is_done)
+  return http.HttpResponse('Updated %s user agents.' % num_user_agents)
+
+
+def ArchiveResults(request):
+  """Move old results into compressed ResultArchive entities.
+
+  Without a category, queues a task for each category and one that pages
+  through the user tests ("user_tests"), queuing a task for the category of
+  each. With a category, archives results older than "age_days" (default
+  result_archive.ARCHIVE_AGE_DAYS) for ARCHIVE_RESULTS_TIME_BUDGET seconds
+  and then queues itself to continue.
+  """
+  category = request.REQUEST.get('category')
+  age_days = int(request.REQUEST.get('age_days',
+                                     result_archive.ARCHIVE_AGE_DAYS))
+  if not category:
+    if request.REQUEST.get('user_tests'):
+      categories, user_test_key = NextUserTestCategories(
+          request.REQUEST.get('user_test_key'))
+      if user_test_key:
+        taskqueue.Task(url=request.path, method='GET', params={
+            'user_tests': 1,
+            'user_test_key': user_test_key,
+            'age_days': age_days,
+            }).add()
+    else:
+      categories = all_test_sets.ALL_CATEGORIES
+      taskqueue.Task(url=request.path, method='GET', params={
+          'user_tests': 1,
+          'age_days': age_days,
+          }).add()
+    manage_dirty.AddTasks(
+        [taskqueue.Task(url=request.path, method='GET', params={
+            'category': category,
+            'age_days': age_days,
+            }) for category in categories],
+        'default')
+    return http.HttpResponse('Queued %s categories.' % len(categories))
+  before_str = request.REQUEST.get('before')
+  if before_str:
+    before = result_archive.ParseCreated(before_str)
+  else:
+    # Fixed for the whole run so that the queued tasks agree on it.
+    before = datetime.datetime.now() - datetime.timedelta(days=age_days)
+  after_str = request.REQUEST.get('after')
+  after_key = request.REQUEST.get('after_key')
+  after = None
+  if after_str and after_key:
+    after = result_archive.ParseCreated(after_str), db.Key(after_key)
+
+  start = time.time()
+  num_archived = 0
+  while time.time() < start + ARCHIVE_RESULTS_TIME_BUDGET:
+    batch_archived, after = result_archive.ArchiveResults(
+        category, before, after)
+    num_archived += batch_archived
+    if after is None:
+      break
+  if after is not None:
+    taskqueue.Task(url=request.path, method='GET', params={
+        'category': category,
+        'before': before.isoformat(),
+        'after': after[0].isoformat(),
+        'after_key': str(after[1]),
+        }).add()
+  logging.info('ArchiveResults: category=%s, before=%s, archived %s in %.1fs, '
+               'done=%s', category, before, num_archived, time.time() - start,
+               after is None)
+  return http.HttpResponse('Archived %s results.' % num_archived)
+
+
+def NextUserTestCategories(user_test_key=None):
+  """Page through the user test categories in key order.
+
+  Args:
+    user_test_key: continue after this str() of a user_test.Test key
+  Returns:
+    (categories, next_user_test_key); next_user_test_key is None when done
+  """
+  query = user_test.Test.all(keys_only=True).order('__key__')
+  if user_test_key:
+    query.filter('__key__ >', db.Key(user_test_key))
+  keys = query.fetch(ARCHIVE_USER_TESTS_BATCH_SIZE)
+  categories = [user_test.Test.get_memcache_keyname_static(k) for k in keys]
+  next_user_test_key = None
+  if len(keys) == ARCHIVE_USER_TESTS_BATCH_SIZE:
+    next_user_test_key = str(keys[-1])
+  return categories, next_user_test_key
+
+
+class _FetchAdapter(object):
+  """Give a datastore.Query the fetch() that Mapper.run_shard calls."""
+
+  def __init__(self, query):
+    self.query = query
+
+  def fetch(self, limit):
+    return self.query.Get(limit)
+
+
+class DirtyResultTimeMarkerMapper(mapper.Mapper):
+  """Create ResultParentDirty markers for ResultTimes dirtied before them.
+
+  Such ResultTimes are only found through the index rows of the old indexed
+  ResultTime.dirty, so this must run before those rows are dropped.
+  """
+  KIND = ResultTime
+
+  def get_query(self, start_key=None, end_key=None):
+    # The model no longer indexes dirty, so db.Query refuses the filter.
+    query = datastore.Query(ResultTime.kind(), {'dirty =': True})
+    if start_key:
+      query['__key__ >'] = start_key
+    if end_key:
+      query['__key__ <='] = end_key
+    query.Order('__key__')
+    return _FetchAdapter(query)
+
+  def map_batch(self, entities):
+    parent_keys = []
+    for entity in entities:
+      parent_key = entity.key().parent()
+      if parent_key not in parent_keys:
+        parent_keys.append(parent_key)
+    markers = db.get([ResultParentDirty.KeyFor(k) for k in parent_keys])
+    parent_keys = [k for k, marker in zip(parent_keys, markers) if not marker]
+    for result_parent in db.get(parent_keys):
+      if result_parent is None:
+        continue
+      pending = [t.key() for t in result_parent.GetResultTimes() if t.dirty]
+      if pending:
+        # Dated like the results so that the next sweep picks them up.
+        ResultParentDirty.get_or_insert(
+            ResultParentDirty.KEY_NAME, parent=result_parent,
+            category=result_parent.category, created=result_parent.created,
+            pending=pending)
+    return [], []
+
+
+def MigrateDirtyResultTimes(request):
+  """Give ResultTimes dirtied before ResultParentDirty existed a marker.
+
+  Runs DirtyResultTimeMarkerMapper for MIGRATE_DIRTY_TIME_BUDGET seconds
+  and then queues itself to continue from the saved mapper progress.
+  manage_dirty.UpdateOldDirty schedules the marked parents.
+  """
+  deadline = time.time() + MIGRATE_DIRTY_TIME_BUDGET
+  marker_mapper = DirtyResultTimeMarkerMapper()
+  num_result_times = marker_mapper.run(
+      batch_size=MIGRATE_DIRTY_BATCH_SIZE, name=MIGRATE_DIRTY_MAPPER_NAME,
+      deadline=deadline)
+  if not marker_mapper.is_done:
+    taskqueue.Task(url=request.path, method='GET').add()
+  logging.info('MigrateDirtyResultTimes: %s dirty result times, done=%s',
+               num_result_times, marker_mapper.is_done)
+  return http.HttpResponse('Checked %s dirty result times.' % num_result_times)
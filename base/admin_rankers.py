@@ -28,6 +28,7 @@ from google.appengine.runtime import DeadlineExceededError
 from base import decorators
 from categories import all_test_sets
 import models
+from models import ranker_upload
 from models import result_ranker
 from models import result_stats
 
@@ -141,3 +142,63 @@ def UploadRankers(request):
     logging.info('message: %s', message)
     response_params['message'] = message
   return http.HttpResponse(simplejson.dumps(response_params))
+
+
+@decorators.admin_required
+def UploadPackedRankers(request):
+  """Rebuild rankers from a ranker_upload payload.
+
+  Rankers whose checksum is unchanged are skipped. The rest are written with
+  one memcache set and one datastore put. Past the time limit, the rankers
+  set so far are saved and 'num_done' tells the client where to resume.
+  """
+  time_limit = int(request.GET.get('time_limit', 8))
+  category = request.GET.get('category')
+  params_str = request.GET.get('params_str')
+  if not category:
+    return http.HttpResponseServerError('Must send "category".')
+
+  test_set = all_test_sets.GetTestSet(category)
+  if not test_set:
+    return http.HttpResponseServerError('Unknown category: %s' % category)
+
+  records = ranker_upload.UnpackRankers(request.raw_post_data)
+  test_browsers = [(test_set.GetTest(test_key), browser)
+                   for test_key, browser, num_scores, checksum, values_str
+                   in records]
+  # Records of unknown tests are skipped but still count as done.
+  known_test_browsers = [(t, b) for t, b in test_browsers if t]
+  known_rankers = iter(
+      result_ranker.GetRankers(known_test_browsers, params_str))
+  start_time = time.clock()
+
+  changed_rankers = []
+  num_done = 0
+  for (test, browser), record in zip(test_browsers, records):
+    if num_done and time.clock() - start_time > time_limit:
+      logging.info('Over time limit after %s of %s', num_done, len(records))
+      break
+    num_done += 1
+    if test is None:
+      logging.info('Skipping unknown test: %s', record[0])
+      continue
+    ranker = known_rankers.next()
+    num_scores, checksum, values_str = record[2:]
+    if ranker is None:
+      ranker = result_ranker.NewRanker(test, browser, params_str)
+    elif ranker.GetChecksum() == checksum:
+      continue
+    ranker.SetValues(ranker_upload.UnpackValues(values_str), num_scores,
+                     cache_put=False)
+    changed_rankers.append(ranker)
+  logging.info('Rankers changed: %s of %s', len(changed_rankers), len(records))
+
+  response_params = {}
+  try:
+    result_ranker.RankerCacher.CachePutMulti(changed_rankers)
+    response_params['num_changed'] = len(changed_rankers)
+    response_params['num_done'] = num_done
+  except db.Timeout:
+    response_params['message'] = 'db.Timeout'
+    logging.info('message: %s', response_params['message'])
+  return http.HttpResponse(simplejson.dumps(response_params))
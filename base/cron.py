@@ -23,6 +23,7 @@ import time
 import traceback
 
 from google.appengine.api import memcache
+from google.appengine.api import urlfetch
 from google.appengine.ext import db
 
 import django
@@ -92,3 +93,44 @@ def UpdateUserTestBeaconCounts(request):
       'mapreduce.input_readers.DatastoreInputReader',
       {'entity_kind': 'models.user_test.Test'})
   return http.HttpResponse('Started MR w/ ID:%s' % mr_id)
+
+
+WARM_STATS_MAX_VIEWS = 20
+WARM_STATS_CONCURRENCY = 5
+WARM_STATS_TIME_BUDGET = 20
+WARM_STATS_FETCH_DEADLINE = 10
+
+
+def WarmStatsViews(request):
+  """Refresh the most requested stats views that have gone stale.
+
+  Views are counted by util.RecordStatsView. Up to WARM_STATS_MAX_VIEWS are
+  fetched, WARM_STATS_CONCURRENCY at a time, until the time budget is spent.
+  """
+  max_views = int(request.GET.get('max_views', WARM_STATS_MAX_VIEWS))
+  view_keys = util.GetStatsViewsToWarm(max_views)
+  start = time.time()
+  warmed_view_keys = []
+  while view_keys and time.time() - start < WARM_STATS_TIME_BUDGET:
+    rpcs = []
+    for view_key in view_keys[:WARM_STATS_CONCURRENCY]:
+      rpc = urlfetch.create_rpc(deadline=WARM_STATS_FETCH_DEADLINE)
+      urlfetch.make_fetch_call(
+          rpc, 'http://%s%s' % (request.get_host(), util.StatsViewUrl(view_key)),
+          headers={'X-Browserscope-Warmer': '1'})
+      rpcs.append((view_key, rpc))
+    view_keys = view_keys[WARM_STATS_CONCURRENCY:]
+    for view_key, rpc in rpcs:
+      try:
+        result = rpc.get_result()
+        if result.status_code == 200:
+          warmed_view_keys.append(view_key)
+        else:
+          logging.info('WarmStatsViews: %s: status %s',
+                       view_key, result.status_code)
+      except urlfetch.Error, e:
+        logging.info('WarmStatsViews: %s: %s', view_key, e)
+  util.MarkStatsViewsWarmed(warmed_view_keys)
+  logging.info('WarmStatsViews: warmed %s views in %.1fs, %s left over',
+               len(warmed_view_keys), time.time() - start, len(view_keys))
+  return http.HttpResponse('Warmed %s views.' % len(warmed_view_keys))
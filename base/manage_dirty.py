@@ -34,6 +34,7 @@ import django
 from django import http
 
 from models.result import ResultParent
+from models.result import ResultParentDirty
 from models.result import ResultTime
 
 from base import decorators
@@ -45,26 +46,35 @@ from django.template import add_to_builtins
 add_to_builtins('base.custom_filters')
 
 
+CATEGORY_UPDATE_PULL_QUEUE = 'update-category-pull'
+
+
 def ScheduleCategoryUpdate(result_parent_key):
   """Add a task to update a category's statistics.
 
-  The task is handled by base.admin.UpdateCategory which then
-  calls UpdateCategory below.
+  Where pull queues are supported, the task is leased in batches by
+  base.admin.UpdateCategories. Otherwise, the task is handled by
+  base.admin.UpdateCategory which then calls UpdateCategory below.
   """
   # Give the task a name to ensure only one task for each ResultParent.
   result_parent = ResultParent.get(result_parent_key)
   category = result_parent.category
   name = 'categoryupdate-%s' % str(result_parent_key).replace('_', '-under-')
-  url = '/_ah/queue/update-category/%s/%s' % (category, result_parent_key)
-
-  task = taskqueue.Task(url=url, name=name, params={
-      'category': category,
-      'user_agent_key': result_parent.user_agent.key(),
-      })
+  if hasattr(taskqueue.Queue, 'lease_tasks'):
+    task = taskqueue.Task(method='PULL', name=name, payload='%s %s' % (
+        category, result_parent.user_agent.key()))
+    queue_name = CATEGORY_UPDATE_PULL_QUEUE
+  else:
+    url = '/_ah/queue/update-category/%s/%s' % (category, result_parent_key)
+    task = taskqueue.Task(url=url, name=name, params={
+        'category': category,
+        'user_agent_key': result_parent.user_agent.key(),
+        })
+    queue_name = 'update-category'
   attempt = 0
   while attempt < 3:
     try:
-      task.add(queue_name='update-category')
+      task.add(queue_name=queue_name)
       break
     except:
       attempt += 1
@@ -80,12 +90,15 @@ def UpdateDirty(request):
   result_time_key = request.REQUEST.get('result_time_key')
   category = request.REQUEST.get('category')
   count = int(request.REQUEST.get('count', 0))
+  done_result_time_key = None
   if result_time_key:
     result_time = ResultTime.get(result_time_key)
     try:
       ResultTime.UpdateStats(result_time)
     except:
       logging.info('UpdateStats: %s:%s' % (sys.exc_type, sys.exc_value))
+    if not result_time.dirty:
+      done_result_time_key = result_time.key()
     result_parent_key = result_time.parent_key()
   else:
     result_parent_key = request.REQUEST.get('result_parent_key')
@@ -96,10 +109,8 @@ def UpdateDirty(request):
       return http.HttpResponse('Done scheduling old results.')
 
   # Create a task for the next dirty ResultTime to update.
-  dirty_query = ResultTime.all(keys_only=True)
-  dirty_query.filter('dirty =', True)
-  dirty_query.ancestor(result_parent_key)
-  next_result_time_key = dirty_query.get()
+  next_result_time_key = ResultParentDirty.UpdatePending(
+      result_parent_key, done_result_time_key)
   if next_result_time_key:
     logging.debug('Schedule next ResultTime: %s', next_result_time_key)
     ResultParent.ScheduleUpdateDirty(
@@ -112,37 +123,91 @@ def UpdateDirty(request):
 
 
 MAX_RESULT_TIMES = 500
-MAX_SCHEDULED = 8
+MAX_TASKS_PER_ADD = 100  # the most tasks in one queue add
 OLD_SECONDS = 5 * 60  # code assumes this is less than one day
+OLD_DIRTY_MEMCACHE_NS = 'update_old_dirty'
+
+
+def AddTasks(tasks, queue_name):
+  """Add tasks to a queue, in batches where the SDK supports it.
+
+  Tasks that already exist (e.g. scheduled by an earlier sweep) are skipped.
+  """
+  queue = taskqueue.Queue(queue_name)
+  for i in range(0, len(tasks), MAX_TASKS_PER_ADD):
+    batch = tasks[i:i + MAX_TASKS_PER_ADD]
+    try:
+      queue.add(batch)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      pass  # The rest of the batch was added.
+    except:
+      logging.info('Batch add failed, adding one at a time: %s:%s',
+                   sys.exc_type, sys.exc_value)
+      for task in batch:
+        try:
+          queue.add(task)
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+          pass
+
+
 def UpdateOldDirty():
-  """Update dirty queries from the past."""
-  num_scheduled = 0
-  seen_result_parent_keys = set()
-  dirty_query = ResultTime.all(keys_only=True).filter('dirty =', True)
-  for i, result_time_key in enumerate(dirty_query.fetch(500)):
-    result_parent_key = result_time_key.parent()
-    if result_parent_key not in seen_result_parent_keys:
-      seen_result_parent_keys.add(result_parent_key)
-      result_parent = ResultParent.get(result_parent_key)
-      category = result_parent.category
-      age = datetime.datetime.now() - result_parent.created
-      if age.days > 0 or age.seconds > OLD_SECONDS:
-        logging.info(
-            'Schedule old dirty:%d:%d: %s, age=%s, result_parent=%s, result_time=%s',
-            i, num_scheduled, category, age, result_parent_key, result_time_key)
-        if ResultParent.ScheduleUpdateDirty(
-            result_time_key, category, count=-1):
-          num_scheduled += 1
-          if num_scheduled == 10:
-            break
+  """Schedule dirty results older than OLD_SECONDS.
+
+  Each call scans the next MAX_RESULT_TIMES ResultParentDirty markers after
+  the last key of the previous call (saved in memcache), so the sweep can run
+  from cron without scanning the same keys again. At the end of the kind, the
+  next call starts over.
+
+  Markers carry the category and the time of their chain's last step, so
+  the age is checked in memory. Old parents are leased in a transaction so
+  that a chain still in flight is not started twice, and one task per
+  leased parent is added with one queue add. Young parents are left for
+  their own update.
+  """
+  last_key = memcache.get('last_key', namespace=OLD_DIRTY_MEMCACHE_NS)
+  dirty_query = ResultParentDirty.all()
+  if last_key:
+    dirty_query.filter('__key__ >', db.Key(last_key))
+  dirty_query.order('__key__')
+  markers = dirty_query.fetch(MAX_RESULT_TIMES)
+  if len(markers) == MAX_RESULT_TIMES:
+    memcache.set('last_key', str(markers[-1].key()),
+                 namespace=OLD_DIRTY_MEMCACHE_NS)
+  else:
+    memcache.delete('last_key', namespace=OLD_DIRTY_MEMCACHE_NS)
+
+  stalled_before = datetime.datetime.now() - datetime.timedelta(
+      seconds=OLD_SECONDS)
+  # Tasks of a sweep get their own names so that later sweeps can retry.
+  task_name_prefix = 'old%d-' % (time.time() / OLD_SECONDS)
+  tasks = []
+  for marker in markers:
+    if marker.pending and marker.LastActive() < stalled_before:
+      # The first pending ResultTime starts the parent's chain.
+      result_time_key = ResultParentDirty.LeaseStalled(
+          marker.key(), stalled_before)
+      if result_time_key:
+        tasks.append(ResultParent.UpdateDirtyTask(
+            result_time_key, marker.category, count=-1,
+            task_name_prefix=task_name_prefix))
+  AddTasks(tasks, 'update-dirty')
+  logging.info('UpdateOldDirty: %s dirty parents, %s old',
+               len(markers), len(tasks))
+  return len(tasks)
+
 
 def MakeDirty(request):
   """For testing purposes, make some tests dirty."""
   query = ResultParent.all()
   result_times = []
+  markers = []
   for result_parent in query.fetch(10):
-    for result_time in ResultTime.all().ancestor(result_parent).fetch(1000):
+    parent_result_times = ResultTime.all().ancestor(result_parent).fetch(1000)
+    for result_time in parent_result_times:
       result_time.dirty = True
       result_times.append(result_time)
-  db.put(result_times)
+    markers.append(ResultParentDirty.Create(
+        result_parent, [rt.key() for rt in parent_result_times]))
+  db.put(result_times + markers)
   return http.HttpResponse('Made %s result_times dirty' % len(result_times))
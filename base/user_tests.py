@@ -42,6 +42,7 @@ from django import shortcuts
 from django.template import loader, Context
 from django.utils import simplejson
 
+import models.result_archive
 import models.user_test
 from base import decorators
 from base import util
@@ -237,11 +238,9 @@ def RawTestData(request, key):
   else:
     test_keys = test.test_keys
 
-  result_parents = db.Query(models.result.ResultParent)
-  result_parents.filter('category', test.get_memcache_keyname())
-  result_parents.order('created')
   lines = []
-  for result_parent in result_parents:
+  for result_parent in models.result_archive.IterResults(
+      test.get_memcache_keyname()):
     line = [
       '"%s"' % result_parent.created,
       '"%s"' % result_parent.user_agent.string,
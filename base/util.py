@@ -46,11 +46,13 @@ from django import http
 from django import shortcuts
 from django.template import loader, Context
 from django.utils import simplejson
+from django.utils.http import http_date
 
 import settings
 
 import models.user_test
 import models.result
+import models.result_archive
 import models.user_agent
 from models import result_stats
 from models import user_agent_release_dates
@@ -67,6 +69,7 @@ from django.template import add_to_builtins
 add_to_builtins('base.custom_filters')
 
 RESULTS_STRING_MEMCACHE_NS = 'results_str'
+RENDERED_STATS_MEMCACHE_NS = 'rendered_stats'
 MULTI_TEST_DRIVER_TEST_PAGE = '/multi_test_frameset'
 ABOUT_TPL = 'about.html'
 TEST_DRIVER_TPL = 'test_driver.html'
@@ -76,6 +79,25 @@ MULTI_TEST_DRIVER_TPL = 'multi_test_driver.html'
 VALID_STATS_OUTPUTS = ('html', 'pickle', 'xhr', 'csv', 'js', 'json', 'jsonp',
                        'gviz_table', 'gviz_table_data', 'gviz_timeline_data')
 
+# GetStats outputs that are kept fully rendered in memcache.
+RENDERED_STATS_OUTPUTS = ('html', 'xhr', 'csv', 'json', 'jsonp',
+                          'gviz_table_data')
+# Memcache values must stay under 1MB.
+RENDERED_STATS_MAX_SIZE = 1000000
+# Rendered gviz responses hold this in place of the request's reqId.
+GVIZ_REQ_ID_PLACEHOLDER = '__bs_req_id__'
+GVIZ_DEFAULT_REQ_ID = '0'
+# Stats views are counted here so the warmer knows what to keep fresh.
+STATS_VIEWS_MEMCACHE_NS = 'stats_views'
+STATS_VIEWS_KEY = 'views'
+# The view index keeps at most this many views; the least hit one makes room.
+STATS_VIEWS_MAX = 200
+STATS_VIEWS_CAS_RETRIES = 3
+# Requests from the warmer carry this header and are not counted.
+STATS_WARMER_HEADER = 'HTTP_X_BROWSERSCOPE_WARMER'
+# Views unwarmed for longer than this are all equally stale.
+STATS_VIEW_MAX_STALE_SECONDS = 3600
+
 
 def Render(request, template, params={}, category=None):
     """Wrapper function to render templates with global and category vars."""
@@ -358,6 +380,45 @@ def GetResultUriString(request, category):
     return results_uri_string
 
 
+def GetContentValidators(request, test_set):
+    """Returns the ETag and Last-Modified values for a stats response.
+
+    The ETag covers the category content version, the full request path and
+    everything else that changes the rendered output for the same path.
+    Args:
+        request: The request object.
+        test_set: The TestSet of the response.
+    Returns:
+        (etag, last_modified)
+    """
+    version = result_stats.CategoryContentVersion.Get(
+        test_set.user_test_category or test_set.category)
+    etag = hashlib.md5('|'.join([
+        repr(version),
+        request.get_full_path(),
+        request.META.get('HTTP_USER_AGENT', ''),
+        request.REQUEST.get('js_ua', ''),
+        str(users.is_current_user_admin()),
+        os.environ['CURRENT_VERSION_ID'],
+    ])).hexdigest()
+    return '"%s"' % etag, http_date(int(version))
+
+
+def IsNotModified(request, etag):
+    """Returns True if the client already has the response for this ETag."""
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match:
+        return False
+    return (if_none_match.strip() == '*' or
+            etag in [t.strip() for t in if_none_match.split(',')])
+
+
+def SetContentValidators(response, etag, last_modified):
+    response['ETag'] = etag
+    response['Last-Modified'] = last_modified
+    return response
+
+
 def GetResults(request, template=None, params={}, test_set=None,
                do_sparse_filter=False):
     """This is the main results handler for returning the results table."""
@@ -402,6 +463,14 @@ def GetResults(request, template=None, params={}, test_set=None,
         if not test_set:
             test_set = all_test_sets.GetTestSet('summary')
 
+    # Data outputs can be answered with a 304 before computing any stats.
+    etag = None
+    if not template and output in ('json', 'jsonp', 'csv'):
+        etag, last_modified = GetContentValidators(request, test_set)
+        if IsNotModified(request, etag):
+            return SetContentValidators(
+                http.HttpResponseNotModified(), etag, last_modified)
+
     params.update({
         'stats_table_category': test_set.category,
         'stats_table_category_name': test_set.category_name,
@@ -440,7 +509,10 @@ def GetResults(request, template=None, params={}, test_set=None,
         mimetype = None
         if 'mimetype' in params:
             mimetype = params['mimetype']
-        return http.HttpResponse(stats_table, mimetype)
+        response = http.HttpResponse(stats_table, mimetype)
+        if etag:
+            SetContentValidators(response, etag, last_modified)
+        return response
 
 
 def GvizTableData(request):
@@ -460,8 +532,125 @@ def GvizTableData(request):
         return http.HttpResponseBadRequest(
             'No test set was found for category=%s' % category)
 
+    etag, last_modified = GetContentValidators(request, test_set)
+    if IsNotModified(request, etag):
+        return SetContentValidators(
+            http.HttpResponseNotModified(), etag, last_modified)
+    if not request.META.get(STATS_WARMER_HEADER):
+        RecordStatsView(request, test_set)
     formatted_gviz_table_data = GetStats(request, test_set, 'gviz_table_data')
-    return http.HttpResponse(formatted_gviz_table_data)
+    return SetContentValidators(http.HttpResponse(formatted_gviz_table_data),
+                                etag, last_modified)
+
+
+def StatsViewKey(category, version_level, test_keys_str=''):
+    return '%s|%s|%s' % (category, version_level, test_keys_str)
+
+
+def StatsViewUrl(view_key):
+    """Returns the gviz_table_data path of a view key (see StatsViewKey)."""
+    category, version_level, test_keys_str = view_key.split('|', 2)
+    params = [('category', category), ('v', version_level), ('o', 'gviz_data')]
+    if test_keys_str:
+        params.append(('f', test_keys_str))
+    return '/gviz_table_data?%s' % urllib.urlencode(params)
+
+
+def RecordStatsView(request, test_set):
+    """Count a request for a (category, v, f) stats view.
+
+    The counts are hits since the view was last warmed (see WarmStatsViews
+    in base/cron.py). Only views with a known version level and visible test
+    keys are counted, so made-up URLs cannot fill the view index.
+    """
+    version_level = request.GET.get('v', 'top')
+    test_keys_str = request.GET.get('f', '')
+    if version_level not in dict(result_stats.BROWSER_NAV):
+        return
+    if test_keys_str:
+        visible_test_keys = set(t.key for t in test_set.VisibleTests())
+        if not set(test_keys_str.split(',')).issubset(visible_test_keys):
+            return
+    view_key = StatsViewKey(test_set.category, version_level, test_keys_str)
+    if memcache.incr(view_key, namespace=STATS_VIEWS_MEMCACHE_NS) is not None:
+        return
+    memcache.add(view_key, 1, namespace=STATS_VIEWS_MEMCACHE_NS)
+
+    def AddView(views):
+        if view_key in views:
+            return None
+        if len(views) >= STATS_VIEWS_MAX:
+            view_hits = memcache.get_multi(views.keys(),
+                                           namespace=STATS_VIEWS_MEMCACHE_NS)
+            least_hit_view_key = min(
+                views, key=lambda k: int(view_hits.get(k) or 0))
+            del views[least_hit_view_key]
+        views[view_key] = 0  # never warmed
+        return views
+    _UpdateStatsViews(AddView)
+
+
+def _UpdateStatsViews(update):
+    """Change the view index with compare-and-set.
+
+    Args:
+        update: a function that takes the view index dict and returns it
+            changed, or None to leave it alone.
+    Returns:
+        False if the index kept changing under us and the update was dropped.
+    """
+    client = memcache.Client()
+    for i in range(STATS_VIEWS_CAS_RETRIES):
+        views = client.gets(STATS_VIEWS_KEY, namespace=STATS_VIEWS_MEMCACHE_NS)
+        if views is None:
+            views = update({})
+            if views is None or client.add(
+                    STATS_VIEWS_KEY, views, namespace=STATS_VIEWS_MEMCACHE_NS):
+                return True
+        else:
+            views = update(views)
+            if views is None or client.cas(
+                    STATS_VIEWS_KEY, views, namespace=STATS_VIEWS_MEMCACHE_NS):
+                return True
+    logging.info('_UpdateStatsViews: gave up after %s tries',
+                 STATS_VIEWS_CAS_RETRIES)
+    return False
+
+
+def GetStatsViewsToWarm(max_views, now=None):
+    """Returns the view keys that most need warming.
+
+    Views are ranked by their hits since the last warm times how long ago
+    that was. Views without hits are left alone.
+    """
+    if now is None:
+        now = time.time()
+    views = memcache.get(STATS_VIEWS_KEY, namespace=STATS_VIEWS_MEMCACHE_NS) or {}
+    view_hits = memcache.get_multi(views.keys(),
+                                   namespace=STATS_VIEWS_MEMCACHE_NS)
+    ranked_views = []
+    for view_key, warmed in views.items():
+        hits = int(view_hits.get(view_key) or 0)
+        if hits:
+            staleness = min(now - warmed, STATS_VIEW_MAX_STALE_SECONDS)
+            ranked_views.append((hits * staleness, view_key))
+    ranked_views.sort(reverse=True)
+    return [view_key for rank, view_key in ranked_views[:max_views]]
+
+
+def MarkStatsViewsWarmed(view_keys, now=None):
+    """Record the warm time of views and restart their hit counts."""
+    if not view_keys:
+        return
+    if now is None:
+        now = time.time()
+    memcache.delete_multi(view_keys, namespace=STATS_VIEWS_MEMCACHE_NS)
+
+    def SetWarmed(views):
+        for view_key in view_keys:
+            views[view_key] = now
+        return views
+    _UpdateStatsViews(SetWarmed)
 
 
 DEFAULT_TIMELINE_DICT = {
@@ -595,24 +784,50 @@ def BrowseResults(request):
     test_set = all_test_sets.GetTestSet(category)
     if not category and test_set:
         return http.HttpResponseBadRequest('You must pass category=something')
+    # No ETag: new results show up here before the category version changes.
     test_keys = [t.key for t in test_set.VisibleTests()]
     logging.info('Browse %s, %s' % (test_set, test_keys))
 
     bookmark = request.GET.get('bookmark')
     fetch_limit = int(request.GET.get('limit', 20))
-    order = request.GET.get('order', 'desc')
+    order = request.GET.get('order') == 'asc' and 'asc' or 'desc'
     user_agent = request.GET.get('ua', '')
 
-    query = pager.PagerQuery(models.result.ResultParent, keys_only=False)
-    query.filter('category =', test_set.user_test_category or category)
-    if user_agent:
-        query.filter('user_agent_string_list =', user_agent)
-    if order == 'desc':
-        query.order('-created')
+    result_category = test_set.user_test_category or category
+    archive_prefix = models.result_archive.BOOKMARK_PREFIX
+    if (not bookmark and order != 'desc' and
+        models.result_archive.HasArchives(result_category, user_agent)):
+        # Oldest first starts with the archives.
+        bookmark = archive_prefix
+    if bookmark and bookmark.startswith(archive_prefix):
+        # Past the live results when newest first, before them otherwise.
+        prev_bookmark = None
+        try:
+            results, next_bookmark = (
+                models.result_archive.FetchArchivedResults(
+                    result_category, user_agent, fetch_limit, bookmark,
+                    order))
+        except ValueError:
+            return http.HttpResponseBadRequest('Bad bookmark.')
+        if not next_bookmark and order != 'desc':
+            next_bookmark = models.result_archive.LIVE_BOOKMARK
     else:
-        query.order('created')
+        if bookmark == models.result_archive.LIVE_BOOKMARK:
+            bookmark = None
+        query = pager.PagerQuery(models.result.ResultParent, keys_only=False)
+        query.filter('category =', result_category)
+        if user_agent:
+            query.filter('user_agent_string_list =', user_agent)
+        if order == 'desc':
+            query.order('-created')
+        else:
+            query.order('created')
 
-    prev_bookmark, results, next_bookmark = query.fetch(fetch_limit, bookmark)
+        prev_bookmark, results, next_bookmark = query.fetch(
+            fetch_limit, bookmark)
+        if (not next_bookmark and order == 'desc' and
+            models.result_archive.HasArchives(result_category, user_agent)):
+            next_bookmark = archive_prefix
     params = {
         'prev_bookmark': prev_bookmark,
         'next_bookmark': next_bookmark,
@@ -622,6 +837,7 @@ def BrowseResults(request):
         'category': category,
         'user_agent': user_agent,
         'limit': fetch_limit,
+        'order': order,
     }
     return Render(request, 'browse.html', params)
 
@@ -935,6 +1151,101 @@ def Return204Script(request):
 SPARSE_GAP_COUNT = 2
 
 
+def HasResultsParams(request):
+    """Returns True if the request overlays the user's own results."""
+    for key, value in request.GET.items():
+        if ((key == 'results' or key.endswith('_results')) and
+                value and value != 'None'):
+            return True
+    return False
+
+
+def SplitGvizReqId(tqx):
+    """Swaps the reqId in a gviz tqx param for a placeholder.
+
+    Args:
+        tqx: The value of 'tqx' request parameter, e.g. 'reqId:1;out:json'.
+    Returns:
+        (tqx with GVIZ_REQ_ID_PLACEHOLDER as reqId, the reqId or None)
+        A reqId that is not a number is replaced by GVIZ_DEFAULT_REQ_ID.
+    """
+    req_id = None
+    parts = []
+    for part in tqx.split(';'):
+        if part.startswith('reqId:'):
+            req_id = part[len('reqId:'):]
+            if not req_id.isdigit():
+                # The reqId goes into a javascript response unescaped.
+                req_id = GVIZ_DEFAULT_REQ_ID
+            part = 'reqId:%s' % GVIZ_REQ_ID_PLACEHOLDER
+        parts.append(part)
+    return ';'.join(parts), req_id
+
+
+def GetRequestBrowser(request):
+    """Returns the pretty browser of a request, e.g. 'Firefox 3.5'.
+
+    The js_ua param overrides the User-Agent header. The browser comes from
+    the stored UserAgent, so the rendered stats cache key and the highlighted
+    current browser always agree. It is looked up once per request.
+    """
+    if not hasattr(request, '_browserscope_browser'):
+        js_user_agent_string = request.REQUEST.get('js_ua')
+        user_agent_string = (js_user_agent_string or
+                             request.META.get('HTTP_USER_AGENT', ''))
+        request._browserscope_browser = models.user_agent.UserAgent.factory(
+            user_agent_string,
+            js_user_agent_string=js_user_agent_string,
+            js_user_agent_family=request.REQUEST.get('js_user_agent_family'),
+            js_user_agent_v1=request.REQUEST.get('js_user_agent_v1'),
+            js_user_agent_v2=request.REQUEST.get('js_user_agent_v2'),
+            js_user_agent_v3=request.REQUEST.get('js_user_agent_v3')).pretty()
+    return request._browserscope_browser
+
+
+def GetRenderedStatsKey(request, test_set, output, user_agents, version_level,
+                        do_sparse_filter, tqx):
+    """Returns the memcache key of a fully rendered GetStats response.
+
+    The key includes the category content version, so any update of the
+    category's stats rows retires the rendered responses built from them.
+    """
+    version = result_stats.CategoryContentVersion.Get(
+        test_set.user_test_category or test_set.category)
+    key_parts = [
+        repr(version),
+        os.environ['CURRENT_VERSION_ID'],
+        test_set.category,
+        output,
+        request.GET.get('v', version_level),
+        request.GET.get('ua', ','.join(user_agents)),
+        request.GET.get('ua_o', ''),
+        request.GET.get('ua_l', ''),
+        request.GET.get('f', ''),
+        request.GET.get('sc', ''),
+        request.REQUEST.get('highlight', ''),
+        request.REQUEST.get('score', ''),
+        request.REQUEST.get('callback', ''),
+        tqx,
+        str(do_sparse_filter),
+        str(users.is_current_user_admin()),
+        GetServer(request),
+        GetRequestBrowser(request),
+        ]
+    if output in ('html', 'xhr'):
+        key_parts.append(request.get_full_path())
+    return hashlib.md5('|'.join(key_parts)).hexdigest()
+
+
+def RenderedStatsResponse(output, rendered, req_id=None):
+    """Returns what GetStats returns for a rendered output."""
+    if output == 'gviz_table_data':
+        if req_id is not None:
+            rendered = rendered.replace(GVIZ_REQ_ID_PLACEHOLDER, req_id)
+        return http.HttpResponse(rendered, mimetype='text/javascript')
+    return rendered
+
+
 def GetStats(request, test_set, output='html', user_agents=[],
              version_level='top', do_sparse_filter=False):
     """Returns the stats table.
@@ -949,6 +1260,21 @@ def GetStats(request, test_set, output='html', user_agents=[],
 
     category = test_set.category
     logging.info('GetStats for %s' % category)
+
+    # Repeat requests are copied straight out of memcache.
+    tqx, req_id = SplitGvizReqId(request.GET.get('tqx', ''))
+    rendered_key = None
+    if (output in RENDERED_STATS_OUTPUTS and request.GET.get('mem') != '0'
+            and not HasResultsParams(request)):
+        rendered_key = GetRenderedStatsKey(
+            request, test_set, output, user_agents, version_level,
+            do_sparse_filter, tqx)
+        rendered = memcache.get(rendered_key,
+                                namespace=RENDERED_STATS_MEMCACHE_NS)
+        if rendered is not None:
+            logging.info('GetStats found rendered %s for %s', output, category)
+            return RenderedStatsResponse(output, rendered, req_id)
+
     version_level = request.GET.get('v', version_level)
     is_skip_static = request.GET.get('sc')  # 'sc' for skip cache
     browser_param = request.GET.get('ua', ','.join(user_agents))
@@ -974,6 +1300,7 @@ def GetStats(request, test_set, output='html', user_agents=[],
         use_memcache = False
 
     visible_test_keys = [t.key for t in test_set.VisibleTests()]
+    incomplete_browsers = []
 
     browsers = browser_param and browser_param.split(',') or None
     if browsers and '*' in browser_param:
@@ -992,11 +1319,28 @@ def GetStats(request, test_set, output='html', user_agents=[],
             response = urlfetch.fetch(static_source)
             stats_data = pickle.loads(response.content)
         else:
-            stats_data = pickle.load(open(static_source))
-        if not browsers:
-            browsers = stats_data.keys()
+            stats_data = pickle.load(open(static_source, 'rb'))
+        is_level_browsers = not browsers
+        if is_level_browsers:
+            browsers = [b for b in stats_data.keys() if b != 'total_runs']
             result_stats.CategoryBrowserManager.SortBrowsers(browsers)
         logging.info('Retrieved static stats: category=%s', category)
+
+        # Serve rows with results newer than the snapshot live.
+        changed_browsers = result_stats.StaticDeltaLog.GetBrowsers(
+            category, version_level)
+        if is_level_browsers and version_level in ('0', '1', '2', '3'):
+            for browser in changed_browsers:
+                if browser not in browsers:
+                    result_stats.CategoryBrowserManager.InsortBrowser(
+                        browsers, browser)
+        delta_browsers = [b for b in changed_browsers if b in browsers]
+        if delta_browsers:
+            stats_data = result_stats.StaticDeltaLog.MergeStats(
+                test_set, stats_data, delta_browsers, visible_test_keys,
+                incomplete_browsers)
+            logging.info('Merged live stats for %s browsers: category=%s',
+                         len(delta_browsers), category)
     else:
         if not browsers:
             browsers = result_stats.CategoryBrowserManager.GetBrowsers(
@@ -1005,9 +1349,13 @@ def GetStats(request, test_set, output='html', user_agents=[],
             stats_data = result_stats.SummaryStatsManager.GetStats(browsers)
         else:
             # This is the most likely scenario.
+            # Only fetch the columns of the tests that will be shown.
+            stats_test_keys = [k for k in request.GET.get('f', '').split(',')
+                               if k in visible_test_keys]
             stats_data = result_stats.CategoryStatsManager.GetStats(
-                test_set, browsers, visible_test_keys,
-                use_memcache=use_memcache)
+                test_set, browsers, stats_test_keys or visible_test_keys,
+                use_memcache=use_memcache,
+                incomplete_browsers=incomplete_browsers)
     # If the output is pickle, we are done and need to return a string.
     if output == 'pickle':
         return pickle.dumps(stats_data)
@@ -1036,28 +1384,10 @@ def GetStats(request, test_set, output='html', user_agents=[],
             (test_key, result['raw_score'])
             for test_key, result in results.items())
 
-    # Allow request params to set the UA string.
-    current_user_agent_string = request.META.get('HTTP_USER_AGENT')
-    js_user_agent_string = request.REQUEST.get('js_ua')
-    js_user_agent_family = request.REQUEST.get('js_user_agent_family')
-    js_user_agent_v1 = request.REQUEST.get('js_user_agent_v1')
-    js_user_agent_v2 = request.REQUEST.get('js_user_agent_v2')
-    js_user_agent_v3 = request.REQUEST.get('js_user_agent_v3')
-
-    # Allows the js_ua to override the META value.
-    if js_user_agent_string:
-        current_user_agent_string = js_user_agent_string
-
-    current_browser = models.user_agent.UserAgent.factory(
-        current_user_agent_string,
-        js_user_agent_string=js_user_agent_string,
-        js_user_agent_family=js_user_agent_family,
-        js_user_agent_v1=js_user_agent_v1,
-        js_user_agent_v2=js_user_agent_v2,
-        js_user_agent_v3=js_user_agent_v3).pretty()
+    # Request params can set the UA string (see GetRequestBrowser).
+    current_browser = GetRequestBrowser(request)
 
-    #logging.info('CURRENT BROWSER: "%s", "%s", "%s"' % (current_browser,
-    #    js_user_agent_string, current_user_agent_string))
+    #logging.info('CURRENT BROWSER: "%s"' % current_browser)
 
     # Make a dict of the user agent info
     user_agents_dict = {}
@@ -1115,7 +1445,6 @@ def GetStats(request, test_set, output='html', user_agents=[],
         browser_stats['current_display'] = current_stats['summary_display']
 
     # The tests here are what determines that which we display in output.
-    # TODO(elsigh): we could shard stats memcache by test_keys.
     tests = []
     test_keys = visible_test_keys
     result_test_keys = request.GET.get('f')
@@ -1149,15 +1478,23 @@ def GetStats(request, test_set, output='html', user_agents=[],
     }
     #logging.info("GetStats got params: %s", str(params))
     if output in ['html', 'xhr']:
-        return GetStatsDataTemplatized(params, 'table')
+        rendered = GetStatsDataTemplatized(params, 'table')
     elif output in ['csv', 'json', 'jsonp']:
-        return GetStatsDataTemplatized(params, output)
+        rendered = GetStatsDataTemplatized(params, output)
     elif output == 'gviz_table_data':
-        return FormatStatsDataAsGviz(params, request.GET.get('tqx', ''))
+        rendered = FormatStatsDataAsGviz(params, tqx).content
     elif output == 'gviz_timeline_data':
         return FormatStatsDataAsGvizTimeLine(params, request.GET.get('tqx', ''))
     else:
         return params
+    if incomplete_browsers:
+        # Do not cache a table with rows left out after a deadline.
+        logging.info('GetStats left out %s rows for %s',
+                     len(incomplete_browsers), category)
+    elif rendered_key and len(rendered) < RENDERED_STATS_MAX_SIZE:
+        memcache.set(rendered_key, rendered,
+                     namespace=RENDERED_STATS_MEMCACHE_NS)
+    return RenderedStatsResponse(output, rendered, req_id)
 
 
 def FormatStatsDataAsGviz(params, tqx):
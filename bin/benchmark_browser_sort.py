@@ -0,0 +1,134 @@
+#!/usr/bin/python
+#
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark sorting and inserting into 'All Versions' browser lists.
+
+Large user tests collect thousands of level 3 browsers. This compares parsing
+each browser string on every call with the memoized CategoryBrowserManager
+sort keys. Browser strings are read from a file (one per line) or generated.
+
+  $ ./benchmark_browser_sort.py -b 5000 -r 3
+  $ ./benchmark_browser_sort.py -f all_versions.txt
+"""
+
+__author__ = 'slamm@google.com (Stephen Lamm)'
+
+import getopt
+import random
+import sys
+import time
+
+AE_SDK_PATH = '../../google_appengine/'
+sys.path.extend(['..', AE_SDK_PATH, AE_SDK_PATH + 'lib/django'])
+
+from models import result_stats
+
+FAMILIES = ('Android', 'Chrome', 'Chrome Mobile', 'Firefox', 'IE', 'IEMobile',
+            'iPhone', 'Opera', 'Opera Mini', 'Safari', 'Firefox (Minefield)')
+
+Manager = result_stats.CategoryBrowserManager
+
+
+def RandomBrowsers(num_browsers):
+  browsers = set()
+  while len(browsers) < num_browsers:
+    browsers.add('%s %d.%d.%d' % (random.choice(FAMILIES),
+                                  random.randint(0, 40),
+                                  random.randint(0, 20),
+                                  random.randint(0, 2000)))
+  return list(browsers)
+
+
+def ParsedSort(browsers):
+  browsers.sort(key=Manager.ParseBrowserKey)
+
+
+def ParsedInsort(browsers, browser):
+  """The old InsortBrowser: parse the middle browser at each step."""
+  browser_key = Manager.ParseBrowserKey(browser)
+  low, high = 0, len(browsers)
+  while low < high:
+    mid = (low + high) / 2
+    if browser_key < Manager.ParseBrowserKey(browsers[mid]):
+      high = mid
+    else:
+      low = mid + 1
+  browsers.insert(low, browser)
+
+
+def Time(function, repeat):
+  best = None
+  for i in range(repeat):
+    start = time.time()
+    result = function()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best, result
+
+
+def SortAndInsort(browsers, new_browsers, sort, insort):
+  sorted_browsers = browsers[:]
+  sort(sorted_browsers)
+  for browser in new_browsers:
+    insort(sorted_browsers, browser)
+  return sorted_browsers
+
+
+def main(argv):
+  options, args = getopt.getopt(argv[1:], 'f:b:i:r:',
+                                ['file=', 'browsers=', 'inserts=', 'repeat='])
+  filename = None
+  num_browsers = 5000
+  num_inserts = 500
+  repeat = 3
+  for option_key, option_value in options:
+    if option_key in ('-f', '--file'):
+      filename = option_value
+    elif option_key in ('-b', '--browsers'):
+      num_browsers = int(option_value)
+    elif option_key in ('-i', '--inserts'):
+      num_inserts = int(option_value)
+    elif option_key in ('-r', '--repeat'):
+      repeat = int(option_value)
+
+  if filename:
+    browsers = [line.strip() for line in open(filename) if line.strip()]
+  else:
+    browsers = RandomBrowsers(num_browsers + num_inserts)
+  random.shuffle(browsers)
+  new_browsers = browsers[-num_inserts:]
+  browsers = browsers[:-num_inserts]
+
+  parsed_time, parsed_browsers = Time(lambda: SortAndInsort(
+      browsers, new_browsers, ParsedSort, ParsedInsort), repeat)
+  Manager._browser_keys.clear()
+  cold_time, memo_browsers = Time(lambda: SortAndInsort(
+      browsers, new_browsers, Manager.SortBrowsers, Manager.InsortBrowser), 1)
+  warm_time, memo_browsers = Time(lambda: SortAndInsort(
+      browsers, new_browsers, Manager.SortBrowsers, Manager.InsortBrowser),
+      repeat)
+  if parsed_browsers != memo_browsers:
+    print 'Memoized sort does not match!'
+  print '%d browsers, %d inserts' % (len(browsers), len(new_browsers))
+  print 'parsed: %8.3fs' % parsed_time
+  print 'cold:   %8.3fs' % cold_time
+  print 'warm:   %8.3fs (%.1fx)' % (
+      warm_time, parsed_time / max(warm_time, 1e-6))
+
+
+if __name__ == '__main__':
+  main(sys.argv)
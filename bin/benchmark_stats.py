@@ -0,0 +1,106 @@
+#!/usr/bin/python
+#
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark TestSet.GetStatsMatrix against a GetStats call per browser.
+
+Medians are random values in each test's range, with a few missing.
+
+  $ ./benchmark_stats.py -c network,selectors,richtext2 -b 500 -r 3
+"""
+
+__author__ = 'slamm@google.com (Stephen Lamm)'
+
+import getopt
+import random
+import sys
+import time
+
+AE_SDK_PATH = '../../google_appengine/'
+sys.path.extend(['..', AE_SDK_PATH, AE_SDK_PATH + 'lib/django'])
+
+import settings
+from categories import all_test_sets
+
+
+def RandomMatrices(test_set, num_browsers):
+  medians_matrix = []
+  num_scores_matrix = []
+  for i in range(num_browsers):
+    medians_row = []
+    for test in test_set.tests:
+      if random.random() < 0.05:
+        medians_row.append(None)
+      else:
+        medians_row.append(random.randint(test.min_value, test.max_value))
+    medians_matrix.append(medians_row)
+    num_scores_matrix.append(
+        [random.randint(0, 1000) for t in test_set.tests])
+  return medians_matrix, num_scores_matrix
+
+
+def LoopStats(test_set, test_keys, medians_matrix, num_scores_matrix):
+  all_test_keys = [t.key for t in test_set.tests]
+  return [test_set.GetStats(test_keys,
+                            dict(zip(all_test_keys, medians_row)),
+                            dict(zip(all_test_keys, num_scores_row)))
+          for medians_row, num_scores_row in zip(medians_matrix,
+                                                 num_scores_matrix)]
+
+
+def Time(function, repeat):
+  best = None
+  for i in range(repeat):
+    start = time.time()
+    result = function()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best, result
+
+
+def main(argv):
+  options, args = getopt.getopt(argv[1:], 'c:b:r:',
+                                ['categories=', 'browsers=', 'repeat='])
+  categories = [c for c in settings.CATEGORIES if c != 'summary']
+  num_browsers = 300
+  repeat = 3
+  for option_key, option_value in options:
+    if option_key in ('-c', '--categories'):
+      categories = option_value.split(',')
+    elif option_key in ('-b', '--browsers'):
+      num_browsers = int(option_value)
+    elif option_key in ('-r', '--repeat'):
+      repeat = int(option_value)
+
+  print '%-12s %8s %6s %10s %10s %8s' % (
+      'category', 'browsers', 'tests', 'loop (s)', 'matrix (s)', 'speedup')
+  for category in categories:
+    test_set = all_test_sets.GetTestSet(category)
+    test_keys = [t.key for t in test_set.VisibleTests()]
+    medians_matrix, num_scores_matrix = RandomMatrices(test_set, num_browsers)
+    loop_time, loop_stats = Time(lambda: LoopStats(
+        test_set, test_keys, medians_matrix, num_scores_matrix), repeat)
+    matrix_time, matrix_stats = Time(lambda: test_set.GetStatsMatrix(
+        test_keys, medians_matrix, num_scores_matrix), repeat)
+    if loop_stats != matrix_stats:
+      print '%s: GetStatsMatrix does not match GetStats!' % category
+    print '%-12s %8d %6d %10.3f %10.3f %7.1fx' % (
+        category, num_browsers, len(test_keys), loop_time, matrix_time,
+        loop_time / max(matrix_time, 1e-6))
+
+
+if __name__ == '__main__':
+  main(sys.argv)
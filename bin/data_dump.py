@@ -37,6 +37,16 @@ password=XXXX
 pager=less
 default_character_set=utf8
 
+
+Entities are downloaded by a pool of workers (-w). Progress is saved to a
+state file (-s, default: one per host and MySQL default file in /tmp) so an
+interrupted dump picks up where it stopped. To measure throughput without
+App Engine, run against data_dump_standin.py:
+  $ ./data_dump_standin.py -p 8081 -n 100000 -l 0.5 &
+  $ ./data_dump.py -h localhost:8081 -e test@example.com -f ~/bs.cnf -w 8
+
+With -r, rankers are rebuilt by a pool of processes (-p, default: one per
+CPU) and uploaded a category at a time.
 """
 
 __author__ = 'slamm@google.com (Stephen Lamm)'
@@ -48,18 +58,25 @@ import getpass
 import logging
 import MySQLdb
 import os
+import Queue
+import re
 import simplejson
 import sys
+import threading
 import urllib
 
 import local_scores
 
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 from third_party.appengine_tools import appengine_rpc
+from models import ranker_upload
 
-MAX_ENTITIES_REQUESTED = 100
-MAX_RANKERS_UPLOADED = 40
+MAX_ENTITIES_REQUESTED = 500
+MAX_RANKERS_UPLOADED = 500  # the most entities in one datastore put
 RESTART_OVERLAP_MINUTES=15
+NUM_DUMP_WORKERS = 4
+MAX_DUMP_TRIES = 3
+DUMP_STATE_FILE_PATTERN = '/tmp/data_dump_state.%s.%s.json'
 
 CREATE_TABLES_SQL = (
     """CREATE TABLE IF NOT EXISTS result_parent_key (
@@ -77,6 +94,10 @@ CREATE_TABLES_SQL = (
       loader_id INT(10)
     ) ENGINE=MyISAM DEFAULT CHARACTER SET utf8 COLLATE utf8_bin
     ;""",
+    """CREATE TABLE IF NOT EXISTS result_archive_key (
+      result_archive_key VARCHAR(255) NOT NULL PRIMARY KEY
+    ) ENGINE=MyISAM DEFAULT CHARACTER SET utf8 COLLATE utf8_bin
+    ;""",
     """CREATE TABLE IF NOT EXISTS result_time (
       result_time_key VARCHAR(100) NOT NULL PRIMARY KEY,
       result_parent_key VARCHAR(100) NOT NULL,
@@ -122,34 +143,29 @@ CREATE_TABLES_SQL = (
 INSERT_SQL = {
     'result_parent_key': """INSERT IGNORE result_parent_key SET
         result_parent_key=%s;""",
-    'ResultParent': """REPLACE result_parent SET
-        result_parent_key=%(result_parent_key)s,
-        category=%(category)s,
-        user_agent_key=%(user_agent_key)s,
-        ip=%(ip)s,
-        user_id=%(user_id)s,
-        created=%(created)s,
-        params_str=%(params_str)s,
-        loader_id=%(loader_id)s;""",
-    'ResultTime': """REPLACE result_time SET
-        result_time_key=%(result_time_key)s,
-        result_parent_key=%(result_parent_key)s,
-        test=%(test)s,
-        score=%(score)s;""",
-    'UserAgent': """REPLACE user_agent SET
-        user_agent_key=%(user_agent_key)s,
-        string=%(string)s,
-        family=%(family)s,
-        v1=%(v1)s,
-        v2=%(v2)s,
-        v3=%(v3)s,
-        confirmed=%(confirmed)s,
-        created=%(created)s,
-        js_user_agent_string=%(js_user_agent_string)s;""",
+    'result_archive_key': """INSERT IGNORE result_archive_key SET
+        result_archive_key=%s;""",
     'lost-UserAgent': """REPLACE user_agent SET
         user_agent_key=%s;"""
     }
 
+TABLE_NAMES = {
+    'ResultParent': 'result_parent',
+    'ResultTime': 'result_time',
+    'UserAgent': 'user_agent',
+    }
+
+
+def BulkInsertSql(model_class, columns):
+  """Return a multi-row insert for rows given in the order of columns.
+
+  MySQLdb's executemany sends all the rows in one statement for this form.
+  """
+  return 'REPLACE INTO %s (%s) VALUES (%s)' % (
+      TABLE_NAMES[model_class], ','.join(columns),
+      ','.join(['%s'] * len(columns)))
+
+
 UPDATE_SCORES = """
     INSERT IGNORE scores
     SELECT
@@ -178,20 +194,82 @@ MAX_CREATED_SQL = {
     'UserAgent': 'SELECT MAX(created) FROM user_agent',
     }
 
+class DumpState(object):
+  """Progress of DumpEntities saved in a local file to resume from.
+
+  Rows already in MySQL are not requested again. The state adds the keys
+  that never make it into MySQL (lost ResultParents).
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.lost_keys = {}
+    if filename and os.path.exists(filename):
+      state = simplejson.load(open(filename))
+      self.lost_keys = dict((model, set(keys))
+                            for model, keys in state['lost_keys'].items())
+
+  def IsLost(self, model, key):
+    return key in self.lost_keys.get(model, ())
+
+  def AddLost(self, model, key):
+    self.lost_keys.setdefault(model, set()).add(key)
+
+  def Save(self):
+    if not self.filename:
+      return
+    tmp_filename = '%s.tmp' % self.filename
+    f = open(tmp_filename, 'w')
+    simplejson.dump({
+        'lost_keys': dict((model, sorted(keys))
+                          for model, keys in self.lost_keys.items()),
+        }, f)
+    f.close()
+    os.rename(tmp_filename, self.filename)
+
+
+def DefaultStateFile(host, mysql_default_file):
+  """Returns a state file name for one App Engine host and MySQL database."""
+  return DUMP_STATE_FILE_PATTERN % tuple(
+      re.sub(r'[^\w.-]+', '_', part)
+      for part in (host, os.path.abspath(mysql_default_file or 'default')))
+
+
 class DataDumpRpcServer(object):
 
-  def __init__(self, host, user):
+  def __init__(self, host, user, num_workers=NUM_DUMP_WORKERS,
+               state_file=None):
     self.user = user
     self.host = host
-    self.rpc_server = appengine_rpc.HttpRpcServer(
+    self.password = None
+    self.password_lock = threading.Lock()
+    self.num_workers = num_workers
+    self.state = DumpState(state_file)
+    self.rpc_server = self.NewRpcServer()
+
+  def NewRpcServer(self):
+    return appengine_rpc.HttpRpcServer(
         self.host, self.GetCredentials, user_agent=None, source='',
         save_cookies=True)
 
   def GetCredentials(self):
     # TODO: Grab email/password from config
-    return self.user, getpass.getpass('Password for %s: ' % self.user)
+    # Workers share the password so it is only asked for once.
+    self.password_lock.acquire()
+    try:
+      if self.password is None:
+        self.password = getpass.getpass('Password for %s: ' % self.user)
+    finally:
+      self.password_lock.release()
+    return self.user, self.password
 
-  def Send(self, path, params, method='POST', json_response=True):
+  def Send(self, path, params, method='POST', json_response=True,
+           rpc_server=None, payload=None):
+    """Send a request and check the response for a server bail out.
+
+    With a payload, it is POSTed as is and params go in the query string.
+    """
+    rpc_server = rpc_server or self.rpc_server
     # Drop parameters with value=None. Otherwise, the string 'None' gets sent.
     rpc_params = dict((str(k), v) for k, v in params.items() if v is not None)
     logging.info(
@@ -199,9 +277,11 @@ class DataDumpRpcServer(object):
         ['%s=%s' % (k, v) for k, v in sorted(rpc_params.items())]) or '')
     # "payload=None" would a GET instead a POST.
     if method == 'GET':
-      response_data = self.rpc_server.Send(path, payload=None, **rpc_params)
+      response_data = rpc_server.Send(path, payload=None, **rpc_params)
+    elif payload is not None:
+      response_data = rpc_server.Send(path, payload=payload, **rpc_params)
     else:
-      response_data = self.rpc_server.Send(
+      response_data = rpc_server.Send(
           path, payload=urllib.urlencode(rpc_params))
     if response_data.startswith('bailing'):
       logging.fatal(response_data)
@@ -228,54 +308,140 @@ class DataDumpRpcServer(object):
         break
 
   def DumpEntities(self, db, model, keys):
-    logging.info('DumpEntities: model=%s, num_entities=%s', model, len(keys))
+    """Download entities into MySQL with a pool of workers.
+
+    Workers each request a range of sorted keys at a time. Only the main
+    thread writes to MySQL. Ranges cut short by the server's time limit are
+    queued again for the keys that are left.
+    """
+    keys = sorted(k for k in keys if not self.state.IsLost(model, k))
+    logging.info('DumpEntities: model=%s, num_entities=%s, num_workers=%s',
+                 model, len(keys), self.num_workers)
+    range_queue = Queue.Queue()
+    result_queue = Queue.Queue()
+    num_pending = 0
+    for i in range(0, len(keys), MAX_ENTITIES_REQUESTED):
+      range_queue.put(keys[i:i + MAX_ENTITIES_REQUESTED])
+      num_pending += 1
+    workers = [threading.Thread(target=self.DumpWorker,
+                                args=(model, range_queue, result_queue))
+               for i in range(min(self.num_workers, num_pending))]
+    for worker in workers:
+      worker.setDaemon(True)
+      worker.start()
+
     cursor = db.cursor()
-    index = 0
-    needed_keys = set(keys)
-    while needed_keys:
-      logging.info('DumpEntities: model=%s, num_needed=%s', model, len(needed_keys))
-      next_keys = []
-      for i, key in enumerate(sorted(needed_keys)):
-        next_keys.append(key)
-        if i == MAX_ENTITIES_REQUESTED:
+    start = datetime.datetime.now()
+    num_rows = 0
+    try:
+      while num_pending:
+        key_range, response_params = result_queue.get()
+        num_pending -= 1
+        if response_params is None:
+          logging.info('DumpEntities: giving up on %s keys from %s',
+                       len(key_range), key_range[0])
+          continue
+        needed_keys = set(key_range)
+        num_rows += self.WriteRows(cursor, model, response_params, needed_keys)
+        if needed_keys and len(needed_keys) < len(key_range):
+          range_queue.put(sorted(needed_keys))
+          num_pending += 1
+        else:
+          if needed_keys:
+            logging.info('DumpEntities: no progress on %s keys from %s',
+                         len(needed_keys), key_range[0])
+          self.state.Save()
+        elapsed = datetime.datetime.now() - start
+        logging.info('DumpEntities: model=%s, rows=%s, pending=%s, '
+                     'rows/s=%.1f', model, num_rows, num_pending,
+                     num_rows / max(elapsed.seconds + elapsed.days * 86400, 1))
+    finally:
+      for worker in workers:
+        range_queue.put(None)
+
+  def DumpWorker(self, model, range_queue, result_queue):
+    """Fetch key ranges until a None range arrives."""
+    rpc_server = self.NewRpcServer()
+    while 1:
+      key_range = range_queue.get()
+      if key_range is None:
+        break
+      response_params = None
+      for attempt in range(MAX_DUMP_TRIES):
+        try:
+          response_params = self.Send(
+              '/admin/data_dump', self.DumpParams(model, key_range),
+              rpc_server=rpc_server)
           break
-      if len(next_keys) == 1:
-        params = {
-            'model': model,
-            'keys': next_keys[0],
-            }
-      else:
-        key_prefix = os.path.commonprefix(next_keys)
-        prefix_len = len(key_prefix)
-        params = {
-            'model': model,
-            'key_prefix': key_prefix,
-            'keys': ','.join([key[prefix_len:] for key in next_keys]),
-            }
-      start = datetime.datetime.now()
-      params = self.Send('/admin/data_dump', params)
-      logging.info('request_time=%s', str(datetime.datetime.now() - start)[:-7])
-
-      for row in params['data']:
+        except Exception, e:
+          logging.info('DumpWorker: try #%s failed: %s', attempt + 1, e)
+      result_queue.put((key_range, response_params))
+
+  def DumpParams(self, model, keys):
+    if len(keys) == 1:
+      return {
+          'model': model,
+          'keys': keys[0],
+          'format': 'compact',
+          }
+    key_prefix = os.path.commonprefix(keys)
+    prefix_len = len(key_prefix)
+    return {
+        'model': model,
+        'key_prefix': key_prefix,
+        'keys': ','.join([key[prefix_len:] for key in keys]),
+        'format': 'compact',
+        }
+
+  def WriteRows(self, cursor, model, response_params, needed_keys):
+    """Write the rows of a compact data_dump response to MySQL.
+
+    Args:
+      cursor: a MySQLdb cursor
+      model: the model whose keys were requested
+      response_params: the decoded response of /admin/data_dump
+      needed_keys: a set of requested keys; the ones handled are removed
+    Returns:
+      the number of rows written
+    """
+    columns = response_params['columns']
+    model_rows = {}
+    lost_user_agent_keys = []
+    done_archive_keys = []
+    for row in response_params['data']:
+      if isinstance(row, dict):
         if 'lost_key' in row:
           lost_key = row['lost_key']
-          lost_model = row['model_class']
           logging.info('Skipping unfound key: %s, model=%s',
-                       lost_key, lost_model)
+                       lost_key, row['model_class'])
           needed_keys.discard(lost_key)
-          if lost_model == 'UserAgent':
-            cursor.execute(INSERT_SQL['lost-UserAgent'], lost_key)
+          if row['model_class'] == 'UserAgent':
+            lost_user_agent_keys.append(lost_key)
+          else:
+            self.state.AddLost(row['model_class'], lost_key)
         elif 'dirty_key' in row:
-          dirty_key = row['dirty_key']
-          logging.info('Skipping dirty ResultParent: %s')
-          needed_keys.discard(dirty_key)
-        else:
-          cursor.execute(INSERT_SQL[row['model_class']], row)
-          if 'result_parent_key' in row:
-            needed_keys.discard(row['result_parent_key'])
-          elif 'user_agent_key' in row:
-            needed_keys.discard(row['user_agent_key'])
-      del params['data']
+          logging.info('Skipping dirty ResultParent: %s', row['dirty_key'])
+          needed_keys.discard(row['dirty_key'])
+        elif 'archive_key' in row:
+          needed_keys.discard(row['archive_key'])
+          done_archive_keys.append(row['archive_key'])
+      else:
+        model_class = row[0]
+        model_rows.setdefault(model_class, []).append(row[1:])
+        if model_class == model:
+          # The first column is the entity's own key.
+          needed_keys.discard(row[1])
+    if lost_user_agent_keys:
+      cursor.executemany(INSERT_SQL['lost-UserAgent'], lost_user_agent_keys)
+    num_rows = 0
+    for model_class, rows in model_rows.items():
+      cursor.executemany(
+          BulkInsertSql(model_class, columns[model_class]), rows)
+      num_rows += len(rows)
+    if done_archive_keys:
+      # Written after the archive's rows so a failed write is retried.
+      cursor.executemany(INSERT_SQL['result_archive_key'], done_archive_keys)
+    return num_rows
 
   def NeededResultParentKeys(self, db):
     cursor = db.cursor()
@@ -298,6 +464,14 @@ class DataDumpRpcServer(object):
         ORDER BY result_parent.user_agent_key;""")
     return [row[0] for row in cursor.fetchall()]
 
+  def NeededResultArchiveKeys(self, db):
+    """Return the keys of archives that have not been dumped yet."""
+    cursor = db.cursor()
+    cursor.execute('SELECT result_archive_key FROM result_archive_key;')
+    done_keys = set(row[0] for row in cursor.fetchall())
+    return [key for keys in self.GetKeys('ResultArchive') for key in keys
+            if key not in done_keys]
+
   def UpdateResultParentKeys(self, db):
     cursor = db.cursor()
     cursor.execute(MAX_CREATED_SQL['ResultParent'])
@@ -324,6 +498,11 @@ class DataDumpRpcServer(object):
       self.DumpEntities(db, 'ResultParent', needed_result_parent_keys)
       is_score_updated_needed = True
 
+    needed_result_archive_keys = self.NeededResultArchiveKeys(db)
+    if needed_result_archive_keys:
+      self.DumpEntities(db, 'ResultArchive', needed_result_archive_keys)
+      is_score_updated_needed = True
+
     needed_user_agent_keys = self.NeededUserAgentKeys(db)
     if needed_user_agent_keys:
       self.DumpEntities(db, 'UserAgent', needed_user_agent_keys)
@@ -345,52 +524,52 @@ class DataDumpRpcServer(object):
       ranker_batch = []
       for browser in rankers:
         for test_key, ranker in rankers[browser].items():
-          if len(ranker_batch) < batch_size:
-            ranker_batch.append((browser, test_key, ranker))
-          else:
+          if len(ranker_batch) == batch_size:
             yield ranker_batch
             ranker_batch = []
+          ranker_batch.append((browser, test_key, ranker))
       if ranker_batch:
         yield ranker_batch
 
     num_to_upload = sum(len(x) for x in rankers.values())
     num_uploaded = {}
+    # Browsers with rankers in a batch that was given up on keep their stats.
+    failed_browsers = set()
     for ranker_batch in GetRankerBatches(rankers, MAX_RANKERS_UPLOADED):
       logging.info('Rankers to update: %s', num_to_upload)
-      test_key_browsers = []
-      ranker_values = []
+      packed_rankers = []
       completed_browsers = []
       for browser, test_key, ranker in ranker_batch:
-        test_key_browsers.append([
-            test_key,
-            browser])
         median, num_scores = ranker.GetMedianAndNumScores()
-        ranker_values.append([
-            median,
-            num_scores,
-            '|'.join(map(str, ranker.GetValues())),
-            ])
+        packed_rankers.append(
+            (test_key, browser, ranker.GetValues(), num_scores))
         num_to_upload -= 1
         num_uploaded.setdefault(browser, 0)
         num_uploaded[browser] += 1
         if num_uploaded[browser] == len(rankers[browser]):
           completed_browsers.append(browser)
-      params = {
-          'category': category,
-          'test_key_browsers_json': simplejson.dumps(test_key_browsers),
-          'ranker_values_json': simplejson.dumps(ranker_values),
-          }
       num_retries = 0
-      while 1:
-        response_params = self.Send('/admin/rankers/upload', params)
+      while packed_rankers:
+        response_params = self.Send(
+            '/admin/rankers/upload_packed', {'category': category},
+            payload=ranker_upload.PackRankers(packed_rankers))
         if 'message' not in response_params:
-          break
+          num_done = response_params['num_done']
+          logging.info('Rankers changed: %s of %s',
+                       response_params['num_changed'], num_done)
+          # The server stops at its time limit; send the rest again.
+          packed_rankers = packed_rankers[num_done:]
+          continue
         logging.info('Server message: %s', response_params['message'])
         if num_retries == 2:
           logging.info('Giving up after two retries.')
+          failed_browsers.update(browser for browser, test_key, ranker
+                                 in ranker_batch)
           break
         logging.info('Retrying.')
         num_retries += 1
+      completed_browsers = [b for b in completed_browsers
+                            if b not in failed_browsers]
       if completed_browsers:
         self.Send('/admin/update_stats_cache', {
             'category': category,
@@ -408,14 +587,18 @@ class DataDumpRpcServer(object):
 def ParseArgs(argv):
   options, args = getopt.getopt(
       argv[1:],
-      'h:e:f:rc',
+      'h:e:f:rcw:s:p:',
       ['host=', 'email=', 'mysql_default_file=',
-       'release', 'category_browsers_only'])
+       'release', 'category_browsers_only', 'workers=', 'state_file=',
+       'processes='])
   host = None
   gae_user = None
   mysql_default_file = None
   is_release = False
   is_category_browsers_only = False
+  num_workers = NUM_DUMP_WORKERS
+  state_file = None
+  num_processes = None
   for option_key, option_value in options:
     if option_key in ('-h', '--host'):
       host = option_value
@@ -427,13 +610,23 @@ def ParseArgs(argv):
       is_release = True
     elif option_key in ('-c', '--category_browsers_only'):
       is_category_browsers_only = True
-  return host, gae_user, mysql_default_file, is_release, is_category_browsers_only, args
+    elif option_key in ('-w', '--workers'):
+      num_workers = int(option_value)
+    elif option_key in ('-s', '--state_file'):
+      state_file = option_value
+    elif option_key in ('-p', '--processes'):
+      num_processes = int(option_value)
+  return (host, gae_user, mysql_default_file, is_release,
+          is_category_browsers_only, num_workers, state_file, num_processes,
+          args)
 
 
 def main(argv):
   categories = local_scores.GetCategories()
-  (host, user, mysql_default_file,
-   is_release, is_category_browsers_only, argv) = ParseArgs(argv)
+  (host, user, mysql_default_file, is_release, is_category_browsers_only,
+   num_workers, state_file, num_processes, argv) = ParseArgs(argv)
+  if state_file is None:
+    state_file = DefaultStateFile(host, mysql_default_file)
   start = datetime.datetime.now()
   db = MySQLdb.connect(read_default_file=mysql_default_file)
   if is_category_browsers_only:
@@ -444,15 +637,14 @@ def main(argv):
         server.UploadCategoryBrowsers(category, version_level, browsers)
   elif is_release:
     try:
-      server = DataDumpRpcServer(host, user)
+      server = DataDumpRpcServer(host, user, num_workers, state_file)
       # logging.info("Pause Dirty Manager")
       # server.PauseDirtyManager()
       logging.info("Download Entities for all categories.")
       server.DownloadEntities(db, start)
-      for category in categories:
-        logging.info("Build Rankers: %s", category)
-        rankers = local_scores.BuildRankers(db, category)
-
+      logging.info("Build Rankers: %s", ', '.join(categories))
+      for category, rankers in local_scores.IterCategoryRankers(
+          categories, mysql_default_file, num_processes=num_processes):
         logging.info("Upload Rankers: %s", category)
         server.UploadRankers(category, rankers)
 
@@ -468,7 +660,7 @@ def main(argv):
       pass
       #      server.UnpauseDirtyManager()
   else:
-    server = DataDumpRpcServer(host, user)
+    server = DataDumpRpcServer(host, user, num_workers, state_file)
     server.DownloadEntities(db, start)
   end = datetime.datetime.now()
   print '  start: %s' % start
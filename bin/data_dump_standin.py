@@ -0,0 +1,174 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License')
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local stand-in for the data dump handlers of the app.
+
+Serves /admin/data_dump_keys and /admin/data_dump (compact format) from
+generated entities, with a fixed delay per request, so that data_dump.py
+throughput can be measured offline.
+
+  $ ./data_dump_standin.py -p 8081 -n 100000 -t 12 -l 0.5
+"""
+
+__author__ = 'slamm@google.com (Stephen Lamm)'
+
+import BaseHTTPServer
+import cgi
+import getopt
+import logging
+import SocketServer
+import sys
+import time
+
+import simplejson
+
+COLUMNS = {
+    'ResultParent': ('result_parent_key', 'category', 'user_agent_key', 'ip',
+                     'user_id', 'created', 'params_str', 'loader_id'),
+    'ResultTime': ('result_time_key', 'result_parent_key', 'test', 'score'),
+    'UserAgent': ('user_agent_key', 'string', 'family', 'v1', 'v2', 'v3',
+                  'confirmed', 'created', 'js_user_agent_string'),
+    }
+KEYS_PAGE_SIZE = 1000
+NUM_USER_AGENTS = 500
+
+
+class Entities(object):
+  """Generated ResultParents, their ResultTimes and UserAgents."""
+
+  def __init__(self, num_parents, num_tests):
+    self.num_parents = num_parents
+    self.num_tests = num_tests
+
+  def ParentKey(self, index):
+    return 'rp%09d' % index
+
+  def UserAgentKey(self, index):
+    return 'ua%06d' % (index % NUM_USER_AGENTS)
+
+  def Keys(self, model, offset, limit):
+    if model == 'UserAgent':
+      end = min(offset + limit, NUM_USER_AGENTS)
+      return [self.UserAgentKey(i) for i in range(offset, end)]
+    end = min(offset + limit, self.num_parents)
+    return [self.ParentKey(i) for i in range(offset, end)]
+
+  def Rows(self, model, key):
+    index = int(key[2:])
+    if model == 'UserAgent':
+      return [['UserAgent', key, 'Mozilla/5.0 Standin/%d' % index, 'Standin',
+               str(index % 10), str(index % 7), None, 1,
+               '2009-09-09T09:09:09', None]]
+    if index >= self.num_parents:
+      return None
+    rows = [['ResultParent', key, 'network', self.UserAgentKey(index),
+             '1.2.3.4', None, '2009-09-09T09:09:09', None, None]]
+    for test_index in range(self.num_tests):
+      rows.append(['ResultTime', '%s-t%02d' % (key, test_index), key,
+                   'test%02d' % test_index, (index + test_index) % 100])
+    return rows
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    path, query = (self.path.split('?', 1) + [''])[:2]
+    self.Respond(path, cgi.parse_qs(query))
+
+  def do_POST(self):
+    path = self.path.split('?', 1)[0]
+    length = int(self.headers.getheader('content-length') or 0)
+    self.Respond(path, cgi.parse_qs(self.rfile.read(length)))
+
+  def Respond(self, path, params):
+    params = dict((k, v[0]) for k, v in params.items())
+    time.sleep(self.server.latency)
+    if path == '/admin/data_dump_keys':
+      response_params = self.DumpKeys(params)
+    elif path == '/admin/data_dump':
+      response_params = self.Dump(params)
+    else:
+      self.send_error(404)
+      return
+    content = simplejson.dumps(response_params, separators=(',', ':'))
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+  def DumpKeys(self, params):
+    model = params['model']
+    offset = int(params.get('bookmark') or 0)
+    keys = self.server.entities.Keys(model, offset, KEYS_PAGE_SIZE)
+    bookmark = None
+    if len(keys) == KEYS_PAGE_SIZE:
+      bookmark = str(offset + KEYS_PAGE_SIZE)
+    return {
+        'bookmark': bookmark,
+        'model': model,
+        'count': int(params.get('count', 0)) + len(keys),
+        'keys': keys,
+        }
+
+  def Dump(self, params):
+    model = params['model']
+    key_prefix = params.get('key_prefix', '')
+    data = []
+    for key in params['keys'].split(','):
+      key = key_prefix + key
+      rows = self.server.entities.Rows(model, key)
+      if rows is None:
+        data.append({'model_class': model, 'lost_key': key})
+      else:
+        data.extend(rows)
+    return {'data': data, 'columns': COLUMNS}
+
+  def log_message(self, format, *args):
+    logging.debug(format, *args)
+
+
+class StandinServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+def main(argv):
+  options, args = getopt.getopt(
+      argv[1:], 'p:n:t:l:', ['port=', 'parents=', 'tests=', 'latency='])
+  port = 8081
+  num_parents = 10000
+  num_tests = 10
+  latency = 0.5
+  for option_key, option_value in options:
+    if option_key in ('-p', '--port'):
+      port = int(option_value)
+    elif option_key in ('-n', '--parents'):
+      num_parents = int(option_value)
+    elif option_key in ('-t', '--tests'):
+      num_tests = int(option_value)
+    elif option_key in ('-l', '--latency'):
+      latency = float(option_value)
+  server = StandinServer(('localhost', port), Handler)
+  server.entities = Entities(num_parents, num_tests)
+  server.latency = latency
+  logging.info('Serving %s parents with %s tests each on port %s',
+               num_parents, num_tests, port)
+  server.serve_forever()
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  main(sys.argv)
@@ -0,0 +1,227 @@
+#!/usr/bin/python
+#
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Generates static stats tables from a local data dump.
+
+Unlike gen_static_stats_tables.py, which asks the live app to compute every
+table, this computes the tables from the MySQL tables that data_dump.py
+downloads. Scores come from the real TestSet.GetStats code. Each category and
+category is computed in a separate process, one version level after another.
+
+  $ ./data_dump.py -h www.browserscope.org -e you@example.com -f ~/bs.cnf
+  $ ./gen_static_stats_offline.py -f ~/bs.cnf -c acid3,network -p 4
+"""
+
+__author__ = 'slamm@google.com (Stephen Lamm)'
+
+import datetime
+import getopt
+import logging
+import multiprocessing
+import MySQLdb
+import pickle
+import sys
+
+import local_scores
+
+AE_SDK_PATH = '../../google_appengine/'
+sys.path.extend(['..', AE_SDK_PATH])
+
+import settings
+from categories import all_test_sets
+from models import result_stats
+
+VERSION_LEVELS = ['top', '0', '1', '2', '3']
+
+TOP_LEVEL_BROWSERS = {
+    'top': result_stats.TOP_BROWSERS,
+    'top-d': result_stats.TOP_DESKTOP_BROWSERS,
+    'top-m': result_stats.TOP_MOBILE_BROWSERS,
+    'top-d-e': result_stats.TOP_DESKTOP_EDGE_BROWSERS,
+    }
+
+STATIC_FILENAME_FORMAT = '../static_mode/%(category)s_%(version_level)s.py'
+
+# Per-process state. Each worker keeps its own MySQL connection. Rankers are
+# reused across the version levels of one category and then dropped.
+_db = None
+_category_rankers = {}
+_category_browsers = {}
+
+
+def _GetDb(mysql_default_file):
+  global _db
+  if _db is None:
+    _db = MySQLdb.connect(read_default_file=mysql_default_file)
+  return _db
+
+
+def GetRankers(db, category):
+  if category not in _category_rankers:
+    _category_rankers[category] = local_scores.BuildRankers(db, category)
+  return _category_rankers[category]
+
+
+def GetBrowsers(db, category, version_level):
+  """Return the sorted browsers for a category and version level."""
+  if version_level in TOP_LEVEL_BROWSERS:
+    return list(TOP_LEVEL_BROWSERS[version_level])
+  if category == 'summary':
+    categories = [t.category for t in all_test_sets.GetVisibleTestSets()]
+  else:
+    categories = [category]
+  browsers = set()
+  for category in categories:
+    if category not in _category_browsers:
+      _category_browsers[category] = local_scores.GetCategoryBrowsers(
+          db, category)
+    browsers.update(_category_browsers[category][int(version_level)])
+  browsers = list(browsers)
+  result_stats.CategoryBrowserManager.SortBrowsers(browsers)
+  return browsers
+
+
+def GetCategoryStats(db, test_set, browsers):
+  """Compute the same stats as result_stats.CategoryStatsManager.GetStats."""
+  rankers = GetRankers(db, test_set.category)
+  test_keys = [t.key for t in test_set.VisibleTests()]
+  stats = {}
+  total_runs = 0
+  for browser in browsers:
+    browser_rankers = rankers.get(browser, {})
+    medians, num_scores = {}, {}
+    for test in test_set.tests:
+      ranker = browser_rankers.get(test.key)
+      if ranker:
+        medians[test.key], num_scores[test.key] = (
+            ranker.GetMedianAndNumScores())
+      else:
+        medians[test.key], num_scores[test.key] = None, 0
+    stats[browser] = test_set.GetStats(test_keys, medians, num_scores)
+    total_runs += stats[browser].get('total_runs', 0)
+  stats['total_runs'] = total_runs
+  return stats
+
+
+def GetSummaryStats(db, browsers):
+  """Compute the same stats as result_stats.SummaryStatsManager.GetStats."""
+  summary_stats = dict((b, {'results': {}}) for b in browsers)
+  for test_set in all_test_sets.GetVisibleTestSets():
+    category = test_set.category
+    stats = GetCategoryStats(db, test_set, browsers)
+    for browser in browsers:
+      summary_stats[browser]['results'][category] = {
+          'score': stats[browser]['summary_score'],
+          'display': stats[browser]['summary_display'],
+          'total_runs': stats[browser]['total_runs'],
+          }
+      if category == 'acid3':
+        summary_stats[browser]['results'][category]['display'] = (
+            stats[browser]['results']['score']['display'])
+  result_stats.SummaryStatsManager._AddSummaryOfSummaries(summary_stats)
+  return summary_stats
+
+
+def BuildStaticStats(db, category, version_level):
+  """Compute one static stats table.
+
+  Returns:
+    the pickled stats
+  """
+  start = datetime.datetime.now()
+  browsers = GetBrowsers(db, category, version_level)
+  if category == 'summary':
+    stats = GetSummaryStats(db, browsers)
+  else:
+    stats = GetCategoryStats(db, all_test_sets.GetTestSet(category), browsers)
+  logging.info('Built %s_%s: %s browsers in %s', category, version_level,
+               len(browsers), datetime.datetime.now() - start)
+  return pickle.dumps(stats, pickle.HIGHEST_PROTOCOL)
+
+
+def BuildCategoryStaticStats(args):
+  """Pool worker: compute the static stats tables of one category.
+
+  All the version levels of a category run in the same worker so that its
+  rankers are built once. They are dropped afterwards to keep each worker's
+  memory to about one category.
+
+  Args:
+    args: a tuple of (mysql_default_file, category, version_levels)
+  Returns:
+    a list of (category, version_level, pickled_stats)
+  """
+  mysql_default_file, category, version_levels = args
+  db = _GetDb(mysql_default_file)
+  try:
+    return [(category, version_level,
+             BuildStaticStats(db, category, version_level))
+            for version_level in version_levels]
+  finally:
+    _category_rankers.clear()
+
+
+def ParseArgs(argv):
+  options, args = getopt.getopt(
+      argv[1:],
+      'f:c:v:p:',
+      ['mysql_default_file=', 'categories=', 'version_levels=', 'processes='])
+  mysql_default_file = None
+  categories = settings.CATEGORIES
+  version_levels = VERSION_LEVELS
+  processes = multiprocessing.cpu_count()
+  for option_key, option_value in options:
+    if option_key in ('-f', '--mysql_default_file'):
+      mysql_default_file = option_value
+    elif option_key in ('-c', '--categories'):
+      categories = option_value.split(',')
+    elif option_key in ('-v', '--version_levels'):
+      version_levels = option_value.split(',')
+    elif option_key in ('-p', '--processes'):
+      processes = int(option_value)
+  return mysql_default_file, categories, version_levels, processes, args
+
+
+def main(argv):
+  mysql_default_file, categories, version_levels, processes, argv = (
+      ParseArgs(argv))
+  start = datetime.datetime.now()
+  jobs = [(mysql_default_file, category, version_levels)
+          for category in categories]
+  pool = multiprocessing.Pool(processes)
+  try:
+    for tables in pool.imap_unordered(BuildCategoryStaticStats, jobs):
+      for category, version_level, stats_str in tables:
+        filename = STATIC_FILENAME_FORMAT % {
+            'category': category,
+            'version_level': version_level,
+            }
+        f = open(filename, 'wb')
+        f.write(stats_str)
+        f.close()
+        logging.info('Wrote %s (%s bytes)', filename, len(stats_str))
+  finally:
+    pool.close()
+    pool.join()
+  for category in categories:
+    logging.info('Once deployed, reset the live delta: '
+                 '/admin/reset_static_delta?category=%s', category)
+  logging.info('elapsed: %s', str(datetime.datetime.now() - start)[:-7])
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  main(sys.argv)
@@ -102,6 +102,9 @@ def main(argv):
         f.write(html)
         f.close()
         print 'Done.\n'
+    # Rows newer than the snapshot are served live until the log is reset.
+    print ('Once deployed, reset the live delta: '
+           'http://%s/admin/reset_static_delta?category=%s' % (HOST, category))
 
 
 if __name__ == '__main__':
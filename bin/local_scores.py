@@ -17,6 +17,15 @@
 """Compute scores from locally downloaded data.
 
 Compare local numbers with online numbers.
+
+The scores can also be copied once from MySQL into an SQLite file. After
+that, rankers are built without a MySQL server:
+  $ ./local_scores.py -f ~/bs.cnf -x -s /tmp/scores.sqlite
+  $ ./local_scores.py -s /tmp/scores.sqlite > rankers.csv
+
+With -n, rankers are built by a pool of processes, one category and test at a
+time:
+  $ ./local_scores.py -s /tmp/scores.sqlite -n 4 > rankers.csv
 """
 
 # Each level
@@ -26,11 +35,18 @@ import bisect
 import datetime
 import getopt
 import logging
-import MySQLdb
+import multiprocessing
 import os
 import re
+import sqlite3
 import sys
 
+try:
+  import MySQLdb
+  import MySQLdb.cursors
+except ImportError:
+  MySQLdb = None  # Only SQLite files can be used.
+
 sys.path.append('/usr/local/google/google_appengine')
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 from categories import all_test_sets
@@ -76,6 +92,78 @@ SCORES_SQL = """
       %(limit_clause)s
     ;"""
 
+RANKER_SCORES_SQL = """
+    SELECT %(columns)s
+    FROM scores
+    WHERE %(category_clause)s test IS NOT NULL AND family IS NOT NULL
+    ORDER BY %(order_columns)s
+    ;"""
+
+SQLITE_CREATE_SCORES_SQL = """
+    CREATE TABLE scores (
+      category TEXT,
+      test TEXT,
+      family TEXT,
+      v1 TEXT,
+      v2 TEXT,
+      v3 TEXT,
+      score INTEGER
+    );"""
+
+SQLITE_CREATE_INDEX_SQL = """
+    CREATE INDEX scores_category ON scores (category, test, family, v1, v2, v3)
+    ;"""
+
+TEST_SCORES_SQL = """
+    SELECT family, v1, v2, v3, score
+    FROM scores
+    WHERE category=%%s AND test=%%s AND family IS NOT NULL
+    ORDER BY %(order_columns)s
+    ;"""
+
+EXPORT_BATCH_SIZE = 10000
+
+# Per-process connection for BuildTestRankers pool workers.
+_db = None
+
+
+def IsSqlite(db):
+  return isinstance(db, sqlite3.Connection)
+
+
+def Execute(db, sql, params=()):
+  """Run SQL written with MySQLdb placeholders (%s) on MySQL or SQLite."""
+  if IsSqlite(db):
+    sql = sql.replace('%s', '?')
+  cursor = db.cursor()
+  cursor.execute(sql, params)
+  return cursor
+
+
+def RankerScoresSql(db, category=None):
+  """Return SQL for scores in the order rankers are built from.
+
+  SQLite rows keep the order they were exported in (rowid), which is the
+  order MySQL returned them; LastNRanker results depend on it.
+  """
+  order_columns = 'category, test, family, v1, v2, v3'
+  if IsSqlite(db):
+    order_columns += ', rowid'
+  category_clause = ''
+  if category:
+    category_clause = 'category=%s AND'
+  return RANKER_SCORES_SQL % {
+      'columns': 'category, test, family, v1, v2, v3, score',
+      'category_clause': category_clause,
+      'order_columns': order_columns,
+      }
+
+
+def Connect(mysql_default_file=None, sqlite_file=None):
+  if sqlite_file:
+    return sqlite3.connect(sqlite_file)
+  return MySQLdb.connect(read_default_file=mysql_default_file)
+
 
 class UserAgent(object):
   @staticmethod
@@ -188,6 +276,14 @@ class CountRanker(object):
       self.counts.extend([0] * slots_needed)
     self.counts[score] += 1
 
+  def Merge(self, other):
+    """Add the counts of another CountRanker."""
+    slots_needed = len(other.counts) - len(self.counts)
+    if slots_needed > 0:
+      self.counts.extend([0] * slots_needed)
+    for score, count in enumerate(other.counts):
+      self.counts[score] += count
+
   def GetValues(self):
     return self.counts
 
@@ -213,40 +309,197 @@ def DumpRankers(fh, rankers):
     fields.append('|'.join(map(str, ranker.GetValues())))
     print >>fh, ','.join(fields)
 
-def BuildRankers(db, category):
-  cursor = db.cursor()
-  cursor.execute('''
-      SELECT test, family, v1, v2, v3, score
-      FROM scores
-      WHERE category=%s AND test IS NOT NULL AND family IS NOT NULL
-      ORDER by test, family, v1, v2, v3
-      ;''', category)
-  test_set = all_test_sets.GetTestSet(category)
-  last_test_key = None
+
+def AddScores(rankers, rows):
+  """Add score rows to rankers, creating rankers as needed.
+
+  Args:
+    rankers: {(category, browser, test_key): ranker, ...}
+    rows: an iterable of (category, test_key, family, v1, v2, v3, score)
+        sorted by category, test_key, family, v1, v2, v3.
+  """
+  last_category_test = None
   last_parts = None
-  rankers = {}
-  for test_key, family, v1, v2, v3, score in cursor.fetchall():
-    if test_key != last_test_key:
-      last_test_key = test_key
-      test = test_set.GetTest(test_key)
+  for category, test_key, family, v1, v2, v3, score in rows:
+    if (category, test_key) != last_category_test:
+      last_category_test = category, test_key
+      test_set = all_test_sets.GetTestSet(category)
+      test = test_set and test_set.GetTest(test_key)
     if test is None:
       continue
     parts = family, v1, v2, v3
     if parts != last_parts:
+      last_parts = parts
       browsers = UserAgent.parts_to_string_list(family, v1, v2, v3)
     for browser in browsers:
-      browser_rankers = rankers.setdefault(browser, {})
-      if test_key not in browser_rankers:
-        ranker = browser_rankers[test_key] = CreateRanker(test, browser)
-      else:
-        ranker = browser_rankers[test_key]
+      key = category, browser, test_key
+      ranker = rankers.get(key)
+      if ranker is None:
+        ranker = rankers[key] = CreateRanker(test, browser)
       ranker.Add(score)
+
+
+def FetchRows(cursor, batch_size=EXPORT_BATCH_SIZE):
+  """Yield the rows of a cursor a batch at a time."""
+  while 1:
+    rows = cursor.fetchmany(batch_size)
+    if not rows:
+      break
+    for row in rows:
+      yield row
+
+
+def StreamRows(db, sql, params=(), batch_size=EXPORT_BATCH_SIZE):
+  """Yield rows without holding the whole result in memory.
+
+  MySQL rows stay on the server (SSCursor) until they are fetched.
+  """
+  if IsSqlite(db):
+    cursor = Execute(db, sql, params)
+  else:
+    cursor = db.cursor(MySQLdb.cursors.SSCursor)
+    cursor.execute(sql, params)
+  try:
+    for row in FetchRows(cursor, batch_size):
+      yield row
+  finally:
+    cursor.close()
+
+
+def BuildRankers(db, category):
+  """Build the rankers of a category.
+
+  Args:
+    db: a MySQLdb or sqlite3 connection
+    category: a category string like 'network'
+  Returns:
+    {browser: {test_key: ranker, ...}, ...}
+  """
+  rankers = {}
+  AddScores(rankers, StreamRows(db, RankerScoresSql(db, category),
+                                (category,)))
+  browser_rankers = {}
+  for (category, browser, test_key), ranker in rankers.items():
+    browser_rankers.setdefault(browser, {})[test_key] = ranker
+  return browser_rankers
+
+
+def BuildAllRankers(db):
+  """Build the rankers of all categories in one sorted pass over the scores.
+
+  Returns:
+    {(category, browser, test_key): ranker, ...}  # see DumpRankers
+  """
+  rankers = {}
+  AddScores(rankers, StreamRows(db, RankerScoresSql(db)))
   return rankers
 
 
+def BuildTestRankers(args):
+  """Pool worker: build the rankers of one category and test.
+
+  CountRanker scores are counted once per user agent (family, v1, v2, v3).
+  Those count vectors are then merged into each of the user agent's browsers.
+  LastNRanker results depend on score order, so those scores are added to
+  each browser as they stream by.
+
+  Args:
+    args: a tuple of (mysql_default_file, sqlite_file, category, test_key)
+  Returns:
+    (category, test_key, [(browser, ranker), ...])
+  """
+  global _db
+  mysql_default_file, sqlite_file, category, test_key = args
+  if _db is None:
+    _db = Connect(mysql_default_file, sqlite_file)
+  test = all_test_sets.GetTestSet(category).GetTest(test_key)
+  order_columns = 'family, v1, v2, v3'
+  if IsSqlite(_db):
+    order_columns += ', rowid'
+  rows = StreamRows(_db, TEST_SCORES_SQL % {'order_columns': order_columns},
+                    (category, test_key))
+  rankers = {}
+  if isinstance(CreateRanker(test, None), CountRanker):
+    ua_rankers = {}
+    for family, v1, v2, v3, score in rows:
+      parts = family, v1, v2, v3
+      ua_ranker = ua_rankers.get(parts)
+      if ua_ranker is None:
+        ua_ranker = ua_rankers[parts] = CountRanker()
+      ua_ranker.Add(score)
+    for parts, ua_ranker in ua_rankers.iteritems():
+      for browser in UserAgent.parts_to_string_list(*parts):
+        key = category, browser, test_key
+        if key not in rankers:
+          rankers[key] = CountRanker()
+        rankers[key].Merge(ua_ranker)
+  else:
+    AddScores(rankers, ((category, test_key) + tuple(row) for row in rows))
+  return category, test_key, [(browser, ranker) for (c, browser, t), ranker
+                              in rankers.iteritems()]
+
+
+def IterCategoryRankers(categories, mysql_default_file=None, sqlite_file=None,
+                        num_processes=None):
+  """Build rankers in a process pool partitioned by category and test.
+
+  Categories are yielded in order as soon as all of their tests are done, so
+  only a few categories of rankers are in memory at once.
+
+  Yields:
+    (category, {browser: {test_key: ranker, ...}, ...})  # like BuildRankers
+  """
+  jobs = []
+  for category in categories:
+    for test in all_test_sets.GetTestSet(category).tests:
+      jobs.append((mysql_default_file, sqlite_file, category, test.key))
+  pool = multiprocessing.Pool(num_processes)
+  try:
+    last_category = None
+    browser_rankers = {}
+    for category, test_key, test_rankers in pool.imap(BuildTestRankers, jobs):
+      if category != last_category:
+        if last_category is not None:
+          yield last_category, browser_rankers
+        last_category = category
+        browser_rankers = {}
+      for browser, ranker in test_rankers:
+        browser_rankers.setdefault(browser, {})[test_key] = ranker
+    if last_category is not None:
+      yield last_category, browser_rankers
+  finally:
+    pool.close()
+    pool.join()
+
+
+def ExportSqlite(db, sqlite_filename):
+  """Copy the scores table from MySQL into a new SQLite file.
+
+  Rows are copied in ranker order so that SQLite rankers match MySQL ones.
+  """
+  if os.path.exists(sqlite_filename):
+    os.remove(sqlite_filename)
+  sqlite_db = sqlite3.connect(sqlite_filename)
+  sqlite_db.execute(SQLITE_CREATE_SCORES_SQL)
+  cursor = db.cursor(MySQLdb.cursors.SSCursor)
+  cursor.execute(RankerScoresSql(db))
+  num_rows = 0
+  while 1:
+    rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+    if not rows:
+      break
+    sqlite_db.executemany('INSERT INTO scores VALUES (?, ?, ?, ?, ?, ?, ?)',
+                          rows)
+    num_rows += len(rows)
+    logging.info('Exported %s scores', num_rows)
+  cursor.close()
+  sqlite_db.execute(SQLITE_CREATE_INDEX_SQL)
+  sqlite_db.commit()
+  return sqlite_db
+
+
 def GetCategoryBrowsers(db, category):
-  cursor = db.cursor()
-  cursor.execute(CATEGORY_BROWSERS_SQL, category)
+  cursor = Execute(db, CATEGORY_BROWSERS_SQL, (category,))
   level_browsers = [set() for version_level in range(4)]
   for family, v1, v2, v3 in cursor.fetchall():
     ua_browsers = UserAgent.parts_to_string_list(family, v1, v2, v3)
@@ -337,12 +590,16 @@ def DumpScores(db):
 def ParseArgs(argv):
   options, args = getopt.getopt(
       argv[1:],
-      'h:e:p:f:',
-      ['host=', 'email=', 'params=', 'mysql_default_file='])
+      'h:e:p:f:s:xn:',
+      ['host=', 'email=', 'params=', 'mysql_default_file=', 'sqlite_file=',
+       'export_sqlite', 'processes='])
   host = None
   gae_user = None
   params = None
   mysql_default_file = None
+  sqlite_file = None
+  is_export_sqlite = False
+  num_processes = None
   for option_key, option_value in options:
     if option_key in ('-h', '--host'):
       host = option_value
@@ -352,15 +609,34 @@ def ParseArgs(argv):
       params = option_value
     elif option_key in ('-f', '--mysql_default_file'):
       mysql_default_file = option_value
-  return host, gae_user, params, mysql_default_file, args
+    elif option_key in ('-s', '--sqlite_file'):
+      sqlite_file = option_value
+    elif option_key in ('-x', '--export_sqlite'):
+      is_export_sqlite = True
+    elif option_key in ('-n', '--processes'):
+      num_processes = int(option_value)
+  return (host, gae_user, params, mysql_default_file, sqlite_file,
+          is_export_sqlite, num_processes, args)
 
 
 def main(argv):
-  host, user, params, mysql_default_file, argv = ParseArgs(argv)
+  (host, user, params, mysql_default_file, sqlite_file, is_export_sqlite,
+   num_processes, argv) = ParseArgs(argv)
   start = datetime.datetime.now()
-  db = MySQLdb.connect(read_default_file=mysql_default_file)
+  if is_export_sqlite:
+    db = ExportSqlite(Connect(mysql_default_file), sqlite_file)
+  else:
+    db = Connect(mysql_default_file, sqlite_file)
   #DumpScores(db)
-  rankers = BuildRankers(db)
+  if num_processes:
+    rankers = {}
+    for category, browser_rankers in IterCategoryRankers(
+        GetCategories(), mysql_default_file, sqlite_file, num_processes):
+      for browser, test_rankers in browser_rankers.iteritems():
+        for test_key, ranker in test_rankers.iteritems():
+          rankers[(category, browser, test_key)] = ranker
+  else:
+    rankers = BuildAllRankers(db)
   DumpRankers(sys.stdout, rankers)
   #CheckTests(db)
   end = datetime.datetime.now()
@@ -14,14 +14,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Generates static stats tables HTML files."""
+"""Warms the stats tables of categories.
+
+Fetches gviz_table_data for each category, version level and optional test
+filter with a bounded number of parallel requests and retries.
+
+  $ ./warm_category.py --c network,acid3 --v 1,2,3 --p 8
+"""
 
 _author__ = 'elsigh@google.com (Lindsey Simon)'
 
 import getopt
 import logging
-import os
+import Queue
 import sys
+import threading
+import time
+import urllib
 import urllib2
 
 AE_SDK_PATH = '../../google_appengine/'
@@ -33,23 +42,62 @@ HOST = 'www.browserscope.org'
 # Switches for this script.
 # c = categories
 # v = version_level
+# f = test keys filters (one per run, e.g. 'f=a,b' 'f=c')
+# p = number of parallel requests
+# r = retries per URL
 CLI_OPTS = ['c=',
             'v=',
-            'o=']
+            'f=',
+            'p=',
+            'r=',
+            'h=']
 
 logging.getLogger().setLevel(logging.INFO)
 
+
+def WarmUrl(url, max_tries):
+  """Fetch a URL, retrying errors with a growing pause. Returns success."""
+  for attempt in range(1, max_tries + 1):
+    try:
+      urllib2.urlopen(urllib2.Request(
+          url, headers={'X-Browserscope-Warmer': '1'})).read()
+      return True
+    except urllib2.HTTPError, e:
+      logging.info('%s error in try #%s: %s', e.code, attempt, url)
+    except urllib2.URLError, e:
+      logging.info('Cannot reach server in try #%s (%s): %s',
+                   attempt, e.reason, url)
+    time.sleep(min(2 ** attempt, 30))
+  return False
+
+
+def Worker(url_queue, max_tries, failed_urls):
+  while True:
+    try:
+      url = url_queue.get_nowait()
+    except Queue.Empty:
+      return
+    start = time.time()
+    if WarmUrl(url, max_tries):
+      logging.info('Warmed in %.1fs: %s', time.time() - start, url)
+    else:
+      failed_urls.append(url)
+
+
 def main(argv):
   try:
-    opts, args = getopt.getopt(argv, 'hg:d', CLI_OPTS)
+    opts, args = getopt.getopt(argv, 'd', CLI_OPTS)
   except getopt.GetoptError:
     print 'Cannot parse your flags.'
     sys.exit(2)
 
   # Defaults to do everything.
-  categories = None
+  categories = []
   version_levels = ['top', '0', '1', '2', '3']
-  output_types = ['xhr'] # 'xhr' for html
+  test_filters = ['']
+  num_workers = 4
+  max_tries = 3
+  host = HOST
 
   # Parse the arguments.
   for opt, arg in opts:
@@ -57,36 +105,39 @@ def main(argv):
       categories = arg.split(',')
     elif opt in ['--v', '-v']:
       version_levels = arg.split(',')
-    elif opt in ['--o', '-o']:
-      output_types = arg.split(',')
-  logging.info('Switches processed, now c=%s, v=%s' %
-               (categories, version_levels))
+    elif opt in ['--f', '-f']:
+      test_filters = arg.split(' ')
+    elif opt in ['--p', '-p']:
+      num_workers = int(arg)
+    elif opt in ['--r', '-r']:
+      max_tries = int(arg)
+    elif opt in ['--h', '-h']:
+      host = arg
+  logging.info('Switches processed, now c=%s, v=%s, f=%s' %
+               (categories, version_levels, test_filters))
 
+  url_queue = Queue.Queue()
   for category in categories:
     for version_level in version_levels:
-      for output in output_types:
-        url = ('http://%s/gviz_table_data?category=%s&v=%s&o=gviz_data' %
-               (HOST, category, version_level))
-        # Putting this in a retry-able function so that memcache can happen.
-        def get_response_until_200(try_response_count):
-          print 'Opening URL: %s' % url
-          try:
-            response = urllib2.urlopen(url)
-          except urllib2.HTTPError, e:
-            print ('Darn, %s Error in try #%s, retrying...' %
-                   (e.code, try_response_count))
-            try_response_count += 1
-            return get_response_until_200(try_response_count)
-          except urllib2.URLError, e:
-            print 'Death! We failed to reach a server.'
-            print 'Reason: ', e.reason
-            sys.exit(0)
-          else:
-            return response
-
-        response = get_response_until_200(1)
-
-        print 'Done.\n'
+      for test_filter in test_filters:
+        params = [('category', category), ('v', version_level),
+                  ('o', 'gviz_data')]
+        if test_filter:
+          params.append(('f', test_filter))
+        url_queue.put('http://%s/gviz_table_data?%s' % (
+            host, urllib.urlencode(params)))
+
+  failed_urls = []
+  workers = [threading.Thread(target=Worker,
+                              args=(url_queue, max_tries, failed_urls))
+             for i in range(num_workers)]
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+  for url in failed_urls:
+    print 'Failed: %s' % url
+  print 'Done.\n'
 
 
 if __name__ == '__main__':
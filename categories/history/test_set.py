@@ -122,6 +122,7 @@ _TESTS = (
 
 
 class HistoryTestSet(test_set_base.TestSet):
+  independent_test_scores = True
 
   def GetTestScoreAndDisplayValue(self, test_key, raw_scores):
     """Get a normalized score (0 to 100) and a value to output to the display.
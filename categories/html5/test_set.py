@@ -72,6 +72,8 @@ _TESTS = (
 
 
 class Html5TestSet(test_set_base.TestSet):
+  independent_test_scores = True
+
   def __init__(self):
     test_set_base.TestSet.__init__(self,
       category=_CATEGORY,
@@ -102,7 +104,7 @@ class Html5TestSet(test_set_base.TestSet):
       else:
         score = 0
         display = ''
-      logging.info('Bonus points: %s, %s %s' % (test_score, score, display))
+      logging.debug('Bonus points: %s, %s %s' % (test_score, score, display))
     else:
       if test_score > 0:
         score = int(round(float(test_score / float('%d.0' % test.out_of_total)) * 100))
@@ -110,7 +112,7 @@ class Html5TestSet(test_set_base.TestSet):
       else:
         score = 0
         display = ''
-      logging.info('%s: %s, %s %s' % (test_key, test_score, score, display))
+      logging.debug('%s: %s, %s %s' % (test_key, test_score, score, display))
 
     return score, display
 
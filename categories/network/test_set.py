@@ -186,6 +186,7 @@ This test checks if an image inserted using a "data:" URL is rendered correctly.
 
 
 class NetworkTestSet(test_set_base.TestSet):
+  independent_test_scores = True
 
   def GetTestScoreAndDisplayValue(self, test_key, raw_scores):
     """Get a normalized score (0 to 100) and a value to output to the display.
@@ -116,6 +116,7 @@ _TESTS = (
 
 BASELINE_TEST_NAME = 'testDisplay'
 class ReflowTestSet(test_set_base.TestSet):
+  independent_test_scores = True
 
   def AdjustResults(self, results):
     """Re-scores the actual value against a baseline score for reflow.
@@ -254,6 +254,7 @@ _CATEGORIES_SET = [
 
 
 class RichText2TestSet(test_set_base.TestSet):
+  independent_test_scores = True
 
   def GetTestScoreAndDisplayValue(self, test_key, raw_scores):
     """Get a score and a text string to output to the display.
@@ -140,6 +140,7 @@ _TESTS = (
 
 
 class SecurityTestSet(test_set_base.TestSet):
+  independent_test_scores = True
 
   def GetRowScoreAndDisplayValue(self, results):
     """Get the overall score for this row of results data.
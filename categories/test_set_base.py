@@ -82,7 +82,47 @@ class TestBase(object):
   def IsVisible(self):
     return not hasattr(self, 'is_hidden_stat') or not self.is_hidden_stat
 
+
+def GetMediansAndNumScoresMulti(test_set_browsers):
+  """Return the raw scores for any test sets and browsers at once.
+
+  The rankers of all the test sets are fetched with one batch of memcache
+  and datastore calls.
+
+  Args:
+    test_set_browsers: a list of (test_set, browser, tests) tuples where
+        tests is a list of test instances or None for all tests.
+  Returns:
+    [(medians, num_scores), ...]  # in the order of test_set_browsers
+  """
+  test_browser_params = []
+  all_tests = []
+  for test_set, browser, tests in test_set_browsers:
+    tests = tests or test_set.tests
+    params_str = test_set.default_params and str(test_set.default_params) or None
+    test_browser_params.extend((t, browser, params_str) for t in tests)
+    all_tests.append(tests)
+  rankers = iter(result_ranker.GetRankersMulti(test_browser_params))
+  medians_and_num_scores = []
+  for tests in all_tests:
+    medians, num_scores = {}, {}
+    for test in tests:
+      ranker = rankers.next()
+      if ranker:
+        medians[test.key], num_scores[test.key] = ranker.GetMedianAndNumScores()
+      else:
+        medians[test.key], num_scores[test.key] = None, 0
+    medians_and_num_scores.append((medians, num_scores))
+  return medians_and_num_scores
+
+
 class TestSet(object):
+  # True if GetTestScoreAndDisplayValue only looks at the test's own raw score.
+  # Stats for some of the tests can then be computed without the others.
+  independent_test_scores = False
+  # Tests with at most this many raw score values get a score lookup table.
+  MAX_SCORE_TABLE_SIZE = 2500
+
   def __init__(self, category, category_name, summary_doc, tests,
                default_params=None, test_page=None):
     """Initialize a test set.
@@ -110,6 +150,7 @@ class TestSet(object):
       test.test_set = self  # add back pointer to each test
       self._test_dict[test.key] = test
     self._test_keys = sorted(self._test_dict)
+    self._score_tables = {}
 
   def GetTest(self, test_key):
     """Gets the test from the tests dict. If a key is passed in and there's
@@ -198,18 +239,20 @@ class TestSet(object):
     params_str = self.default_params and str(self.default_params) or None
     return result_ranker.GetRankers(test_browsers, params_str)
 
-  def GetMediansAndNumScores(self, browser):
+  def GetMediansAndNumScores(self, browser, tests=None):
     """Return the raw scores for a given browser.
 
     Args:
       browser: a browser/version string like 'Firefox 3.0'.
+      tests: a list of test instances (optional, defaults to all tests)
     Returns:
       ({test_key_1: median_1, test_key_2: median_2},
        {test_key_1: num_scores_1, test_key_2: num_scores_2})
     """
     logging.info('test_set_base.GetMediansAndNumScores browser=%s' % browser)
+    tests = tests or self.tests
     medians, num_scores = {}, {}
-    for test, ranker in zip(self.tests, self.GetRankers(browser)):
+    for test, ranker in zip(tests, self.GetRankers(browser, tests)):
       if ranker:
         medians[test.key], num_scores[test.key] = ranker.GetMedianAndNumScores()
       else:
@@ -219,6 +262,18 @@ class TestSet(object):
     #             (self.category, medians, num_scores))
     return medians, num_scores
 
+  def GetMediansAndNumScoresMulti(self, browsers, tests=None):
+    """Return the raw scores for many browsers with one ranker fetch.
+
+    Args:
+      browsers: a list of browser/version strings like ['Firefox 3.0'].
+      tests: a list of test instances (optional, defaults to all tests)
+    Returns:
+      {browser: (medians, num_scores), ...}  (see GetMediansAndNumScores)
+    """
+    return dict(zip(browsers, GetMediansAndNumScoresMulti(
+        [(self, browser, tests) for browser in browsers])))
+
   def GetStats(self, test_keys, raw_scores, num_scores=None):
     """Get normalized scores, display values including summary values.
 
@@ -272,7 +327,7 @@ class TestSet(object):
           score, display = 1, settings.STATS_SCORE_FALSE
       else:
         score, display = (
-            self.GetTestScoreAndDisplayValue(test_key, raw_scores))
+            self.LookupTestScoreAndDisplayValue(test_key, raw_scores))
       results[test_key] = {
           'raw_score': raw_score,
           'score': score,
@@ -289,6 +344,143 @@ class TestSet(object):
     return stats
 
 
+  def GetStatsMatrix(self, test_keys, medians_matrix, num_scores_matrix=None):
+    """Get the stats for many browsers at once.
+
+    Gives the same stats as calling GetStats for each row, but the tests are
+    scored a column at a time with GetColumnScoresAndDisplayValues.
+
+    Args:
+      test_keys: the test keys to include in the 'results'.
+      medians_matrix: a list with a row for each browser. Each row is a list
+          of raw scores in the order of self.tests.
+      num_scores_matrix: a list of num_scores rows like medians_matrix.
+    Returns:
+      [stats_1, stats_2, ...]  # a stats dict (see GetStats) for each row
+    """
+    all_test_keys = [t.key for t in self.tests]
+    test_indexes = dict((k, i) for i, k in enumerate(all_test_keys))
+    columns = {}
+    row_raw_scores = None
+    for test_key in test_keys:
+      index = test_indexes[test_key]
+      column = [row[index] for row in medians_matrix]
+      column_scores = self.GetColumnScoresAndDisplayValues(test_key, column)
+      if column_scores is None:
+        # Fall back to scoring each row with all of its raw scores.
+        if row_raw_scores is None:
+          row_raw_scores = [dict(zip(all_test_keys, row))
+                            for row in medians_matrix]
+        column_scores = [self.GetTestScoreAndDisplayValue(test_key, raw_scores)
+                         for raw_scores in row_raw_scores]
+      columns[test_key] = zip(column, column_scores)
+
+    stats_matrix = []
+    for row_index in range(len(medians_matrix)):
+      results = {}
+      for test_key in test_keys:
+        raw_score, (score, display) = columns[test_key][row_index]
+        results[test_key] = {
+            'raw_score': raw_score,
+            'score': score,
+            'display': display,
+            }
+      summary_score, summary_display = self.GetRowScoreAndDisplayValue(results)
+      stats = {
+          'summary_score': summary_score,
+          'summary_display': summary_display,
+          'results': results,
+          }
+      if num_scores_matrix is not None:
+        num_scores = dict(zip(all_test_keys, num_scores_matrix[row_index]))
+        total_runs = 0
+        for test_key in test_keys:
+          total_runs = max(total_runs,
+                           self.GetTotalRunsForTestKey(test_key, num_scores))
+        stats['total_runs'] = total_runs
+      stats_matrix.append(stats)
+    return stats_matrix
+
+  def GetColumnScoresAndDisplayValues(self, test_key, raw_scores_column):
+    """Score one test for many browsers.
+
+    Boolean tests and test sets with independent_test_scores are scored
+    once per distinct raw score. Test sets may override this with kernels
+    of their own.
+
+    Args:
+      test_key: a key for a test_set test.
+      raw_scores_column: a list of raw scores for test_key, one per browser.
+    Returns:
+      [(score_1, display_1), ...] or None to score each row with
+      GetTestScoreAndDisplayValue.
+    """
+    if self.IsBooleanTest(test_key) and self.user_test_category is None:
+      scores = {None: (0, '')}
+      for raw_score in raw_scores_column:
+        if raw_score not in scores:
+          if raw_score:
+            scores[raw_score] = 100, settings.STATS_SCORE_TRUE
+          else:
+            scores[raw_score] = 1, settings.STATS_SCORE_FALSE
+    elif self.independent_test_scores:
+      scores = {}
+      for raw_score in raw_scores_column:
+        if raw_score not in scores:
+          scores[raw_score] = self.LookupTestScoreAndDisplayValue(
+              test_key, {test_key: raw_score})
+    else:
+      return None
+    return [scores[raw_score] for raw_score in raw_scores_column]
+
+  def GetScoreTable(self, test_key):
+    """Return a table of the scores and display values of a test.
+
+    Tables are only built for test sets with independent_test_scores and for
+    tests with a small integer range. A table is built on its first use and
+    kept for the life of the test set.
+
+    Args:
+      test_key: a key for a test_set test.
+    Returns:
+      {raw_score: (score, display), ...} or None
+    """
+    if test_key not in self._score_tables:
+      table = None
+      test = self.GetTest(test_key)
+      if (self.independent_test_scores and test is not None and
+          type(test.min_value) is int and type(test.max_value) is int and
+          test.max_value - test.min_value < self.MAX_SCORE_TABLE_SIZE):
+        table = {}
+        for raw_score in [None] + range(test.min_value, test.max_value + 1):
+          try:
+            table[raw_score] = self.GetTestScoreAndDisplayValue(
+                test_key, {test_key: raw_score})
+          except KeyError:
+            # The score needs raw scores of other tests; leave it to
+            # GetTestScoreAndDisplayValue on real data.
+            pass
+          except TypeError:
+            # Not every test set can score a missing result.
+            if raw_score is not None:
+              raise
+      self._score_tables[test_key] = table
+    return self._score_tables[test_key]
+
+  def LookupTestScoreAndDisplayValue(self, test_key, raw_scores):
+    """Like GetTestScoreAndDisplayValue, but use the score table if possible.
+
+    Raw scores that are missing from the table (e.g. out of range) are
+    scored by GetTestScoreAndDisplayValue.
+    """
+    if test_key in raw_scores:
+      raw_score = raw_scores[test_key]
+      if raw_score is None or type(raw_score) is int:
+        table = self.GetScoreTable(test_key)
+        if table is not None and raw_score in table:
+          return table[raw_score]
+    return self.GetTestScoreAndDisplayValue(test_key, raw_scores)
+
   def GetTotalRunsForTestKey(self, test_key, num_scores):
       return num_scores[test_key]
 
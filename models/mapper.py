@@ -14,6 +14,76 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+"""Map a function over the entities of a kind.
+
+Mapper.run splits the key space into shards, runs the shards in threads and
+overlaps each batch's writes with the next fetch. With a name, the last key of
+each shard is saved in MapperShardState so that an interrupted run resumes.
+"""
+
+import logging
+import threading
+import time
+
+from google.appengine.ext import db
+
+
+class MapperShardState(db.Model):
+  """Progress of one shard of a named mapper run.
+
+  key_name: '<mapper name>_<shard>'
+  """
+  start_key = db.StringProperty(indexed=False)
+  end_key = db.StringProperty(indexed=False)
+  last_key = db.StringProperty(indexed=False)
+  num_entities = db.IntegerProperty(default=0, indexed=False)
+  is_done = db.BooleanProperty(default=False, indexed=False)
+
+  @classmethod
+  def KeyName(cls, name, shard):
+    return '%s_%s' % (name, shard)
+
+  @classmethod
+  def GetShards(cls, name, num_shards):
+    return cls.get_by_key_name(
+        [cls.KeyName(name, shard) for shard in range(num_shards)])
+
+  @classmethod
+  def ClearShards(cls, name, num_shards):
+    db.delete([db.Key.from_path(cls.kind(), cls.KeyName(name, shard))
+               for shard in range(num_shards)])
+
+
+def _KeyStr(key):
+  return key and str(key) or None
+
+
+def _StrKey(key_str):
+  return key_str and db.Key(key_str) or None
+
+
+def _WriteAsync(to_put, to_delete):
+  """Start datastore writes; return a function that waits for them.
+
+  Without async calls in the SDK, the writes finish before this returns.
+  """
+  rpcs = []
+  if hasattr(db, 'put_async'):
+    if to_put:
+      rpcs.append(db.put_async(to_put))
+    if to_delete:
+      rpcs.append(db.delete_async(to_delete))
+  else:
+    if to_put:
+      db.put(to_put)
+    if to_delete:
+      db.delete(to_delete)
+  def Wait():
+    for rpc in rpcs:
+      rpc.get_result()
+  return Wait
+
+
 class Mapper(object):
   """For remote_api calls.
   See http://code.google.com/appengine/articles/remote_api.html for examples.
@@ -24,6 +94,9 @@ class Mapper(object):
   # Subclasses can replace this with a list of (property, value) tuples to filter by.
   FILTERS = []
 
+  # Log throughput after this many seconds.
+  PROGRESS_INTERVAL = 10
+
   def map(self, entity):
     """Updates a single entity.
 
@@ -31,29 +104,144 @@ class Mapper(object):
     """
     return ([], [])
 
-  def get_query(self):
-    """Returns a query over the specified kind, with any appropriate filters applied."""
+  def get_query(self, start_key=None, end_key=None):
+    """Returns a query over the specified kind, with any appropriate filters applied.
+
+    Keys are greater than start_key and less than or equal to end_key.
+    """
     q = self.KIND.all()
     for prop, value in self.FILTERS:
       q.filter("%s =" % prop, value)
+    if start_key:
+      q.filter("__key__ >", start_key)
+    if end_key:
+      q.filter("__key__ <=", end_key)
     q.order("__key__")
     return q
 
-  def run(self, batch_size=100):
-    """Executes the map procedure over all matching entities."""
-    q = self.get_query()
-    entities = q.fetch(batch_size)
+  def get_keys_query(self, order="__key__"):
+    q = self.KIND.all(keys_only=True)
+    for prop, value in self.FILTERS:
+      q.filter("%s =" % prop, value)
+    q.order(order)
+    return q
+
+  def split_key_ranges(self, num_shards):
+    """Split the kind into up to num_shards (start_key, end_key) ranges.
+
+    Root entities with numeric ids are split evenly between the lowest and
+    highest id. Otherwise, there is one range for everything.
+    """
+    if num_shards < 2:
+      return [(None, None)]
+    first_key = self.get_keys_query().get()
+    last_key = self.get_keys_query("-__key__").get()
+    if (not first_key or first_key.parent() or last_key.parent() or
+        not first_key.id() or not last_key.id()):
+      return [(None, None)]
+    first_id, last_id = first_key.id(), last_key.id()
+    step = max(1, (last_id - first_id) / num_shards)
+    end_keys = [db.Key.from_path(self.KIND.kind(), i)
+                for i in range(first_id + step, last_id, step)]
+    end_keys = end_keys[:num_shards - 1]
+    return zip([None] + end_keys, end_keys + [None])
+
+  def map_batch(self, entities):
+    to_put = []
+    to_delete = []
+    for entity in entities:
+      map_updates, map_deletes = self.map(entity)
+      to_put.extend(map_updates)
+      to_delete.extend(map_deletes)
+    return to_put, to_delete
+
+  def run(self, batch_size=100, num_shards=1, name=None, deadline=None):
+    """Executes the map procedure over all matching entities.
+
+    Args:
+      batch_size: the number of entities fetched at a time.
+      num_shards: the number of key ranges mapped concurrently.
+      name: if given, progress is saved under this name and a later run
+          with the same name and num_shards resumes from it.
+      deadline: if given, a time.time() value after which shards stop
+          fetching. self.is_done tells whether everything was mapped.
+    Returns:
+      the number of entities mapped
+    """
+    shard_states = []
+    if name:
+      shard_states = [s for s in MapperShardState.GetShards(name, num_shards)
+                      if s]
+    if shard_states:
+      logging.info('Resuming %s: %s of %s shards done.', name,
+                   len([s for s in shard_states if s.is_done]),
+                   len(shard_states))
+    else:
+      for shard, (start_key, end_key) in enumerate(
+          self.split_key_ranges(num_shards)):
+        shard_states.append(MapperShardState(
+            key_name=MapperShardState.KeyName(name, shard),
+            start_key=_KeyStr(start_key), end_key=_KeyStr(end_key)))
+      if name:
+        db.put(shard_states)
+    self.progress_lock = threading.Lock()
+    self.num_mapped = 0
+    self.start_time = self.last_progress_time = time.time()
+    if len(shard_states) == 1:
+      self.run_shard(shard_states[0], batch_size, name, deadline)
+    else:
+      threads = [threading.Thread(target=self.run_shard,
+                                  args=(shard_state, batch_size, name,
+                                        deadline))
+                 for shard_state in shard_states]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+    elapsed = time.time() - self.start_time
+    logging.info('Mapped %s entities in %.1fs (%.1f entities/s).',
+                 self.num_mapped, elapsed, self.num_mapped / max(elapsed, 1e-6))
+    self.is_done = not [s for s in shard_states if not s.is_done]
+    if name and self.is_done:
+      MapperShardState.ClearShards(name, len(shard_states))
+    return self.num_mapped
+
+  def run_shard(self, shard_state, batch_size, name, deadline=None):
+    """Map one key range, writing each batch while the next is fetched."""
+    if shard_state.is_done:
+      return
+    end_key = _StrKey(shard_state.end_key)
+    last_key = _StrKey(shard_state.last_key or shard_state.start_key)
+    wait_for_writes = lambda: None
+    entities = self.get_query(last_key, end_key).fetch(batch_size)
     while entities:
-      to_put = []
-      to_delete = []
-      for entity in entities:
-        map_updates, map_deletes = self.map(entity)
-        to_put.extend(map_updates)
-        to_delete.extend(map_deletes)
-      if to_put:
-        db.put(to_put)
-      if to_delete:
-        db.delete(to_delete)
-      q = self.get_query()
-      q.filter("__key__ >", entities[-1].key())
-      entities = q.fetch(batch_size)
+      to_put, to_delete = self.map_batch(entities)
+      last_key = entities[-1].key()
+      shard_state.last_key = str(last_key)
+      shard_state.num_entities += len(entities)
+      if name:
+        to_put.append(shard_state)
+      wait_for_writes()
+      wait_for_writes = _WriteAsync(to_put, to_delete)
+      self.add_progress(len(entities))
+      if deadline and time.time() > deadline:
+        break
+      entities = self.get_query(last_key, end_key).fetch(batch_size)
+    wait_for_writes()
+    if entities:
+      return  # Out of time; the saved last_key is where to resume.
+    shard_state.is_done = True
+    if name:
+      shard_state.put()
+
+  def add_progress(self, num_entities):
+    self.progress_lock.acquire()
+    try:
+      self.num_mapped += num_entities
+      now = time.time()
+      if now - self.last_progress_time >= self.PROGRESS_INTERVAL:
+        self.last_progress_time = now
+        logging.info('Mapped %s entities (%.1f entities/s).', self.num_mapped,
+                     self.num_mapped / max(now - self.start_time, 1e-6))
+    finally:
+      self.progress_lock.release()
@@ -0,0 +1,104 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License')
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Binary format for uploading rankers in bulk.
+
+This module has no App Engine imports so that bin/data_dump.py can pack
+what base/admin_rankers.py unpacks.
+
+An upload is a zlib compressed sequence of records:
+  !HH         lengths of the UTF-8 test_key and browser
+  (strings)   test_key, browser
+  !qIi        num_scores, number of values, checksum
+  !%dq        values
+"""
+
+__author__ = 'slamm@google.com (Stephen Lamm)'
+
+import struct
+import zlib
+
+NAME_LENGTHS_FORMAT = '!HH'
+NAME_LENGTHS_SIZE = struct.calcsize(NAME_LENGTHS_FORMAT)
+COUNTS_FORMAT = '!qIi'
+COUNTS_SIZE = struct.calcsize(COUNTS_FORMAT)
+VALUE_SIZE = struct.calcsize('!q')
+
+
+def ValuesChecksum(values, num_scores):
+  """Return a CRC-32 of a ranker's values and number of scores."""
+  return zlib.crc32(struct.pack('!q%dq' % len(values), num_scores, *values))
+
+
+def _Utf8(value):
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  return value
+
+
+def PackRankers(rankers):
+  """Pack rankers for upload.
+
+  Args:
+    rankers: a list of (test_key, browser, values, num_scores) tuples.
+  Returns:
+    a compressed binary string
+  """
+  parts = []
+  for test_key, browser, values, num_scores in rankers:
+    test_key = _Utf8(test_key)
+    browser = _Utf8(browser)
+    parts.append(struct.pack(NAME_LENGTHS_FORMAT, len(test_key), len(browser)))
+    parts.append(test_key)
+    parts.append(browser)
+    parts.append(struct.pack(COUNTS_FORMAT, num_scores, len(values),
+                             ValuesChecksum(values, num_scores)))
+    parts.append(struct.pack('!%dq' % len(values), *values))
+  return zlib.compress(''.join(parts))
+
+
+def UnpackRankers(data):
+  """Unpack the records of an upload, leaving the values packed.
+
+  Values are only needed for rankers whose checksum changed, so they are
+  unpacked separately with UnpackValues.
+
+  Returns:
+    a list of (test_key, browser, num_scores, checksum, values_str) tuples
+  """
+  data = zlib.decompress(data)
+  records = []
+  offset = 0
+  while offset < len(data):
+    test_key_length, browser_length = struct.unpack(
+        NAME_LENGTHS_FORMAT, data[offset:offset + NAME_LENGTHS_SIZE])
+    offset += NAME_LENGTHS_SIZE
+    test_key = data[offset:offset + test_key_length]
+    offset += test_key_length
+    browser = data[offset:offset + browser_length].decode('utf-8')
+    offset += browser_length
+    num_scores, num_values, checksum = struct.unpack(
+        COUNTS_FORMAT, data[offset:offset + COUNTS_SIZE])
+    offset += COUNTS_SIZE
+    values_str = data[offset:offset + num_values * VALUE_SIZE]
+    offset += num_values * VALUE_SIZE
+    records.append((test_key, browser, num_scores, checksum, values_str))
+  return records
+
+
+def UnpackValues(values_str):
+  return list(struct.unpack('!%dq' % (len(values_str) / VALUE_SIZE),
+                            values_str))
@@ -14,6 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
 import logging
 import sys
 
@@ -29,7 +30,8 @@ from models.user_agent import UserAgent
 class ResultTime(db.Model):
   test = db.StringProperty()
   score = db.IntegerProperty()
-  dirty = db.BooleanProperty(default=True)
+  # Not indexed; pending work is found through ResultParentDirty.
+  dirty = db.BooleanProperty(default=True, indexed=False)
 
   def UpdateStats(self):
     logging.info('ResultTime.UpdateStats for test: %s, score: %s, dirty: %s' %
@@ -53,6 +55,83 @@ class ResultTime(db.Model):
       return []
 
 
+class ResultParentDirty(db.Model):
+  """The ResultTimes of a ResultParent that are not in the rankers yet.
+
+  A child of the ResultParent, so it is created in the same transaction as
+  the results. It is deleted when the last pending ResultTime is updated.
+  Pending work is found by querying this small kind instead of an index on
+  ResultTime, the largest kind.
+
+  Each step of a parent's update chain renews 'leased', so a sweep for
+  stalled parents can tell a chain in flight from one that was lost.
+  """
+  KEY_NAME = 'dirty'
+
+  category = db.StringProperty()
+  created = db.DateTimeProperty(auto_now_add=True)
+  pending = db.ListProperty(db.Key, indexed=False)
+  leased = db.DateTimeProperty(indexed=False)
+
+  @classmethod
+  def KeyFor(cls, result_parent_key):
+    return db.Key.from_path(cls.kind(), cls.KEY_NAME, parent=result_parent_key)
+
+  @classmethod
+  def Create(cls, result_parent, result_time_keys):
+    return cls(parent=result_parent, key_name=cls.KEY_NAME,
+               category=result_parent.category, pending=result_time_keys)
+
+  @classmethod
+  def UpdatePending(cls, result_parent_key, done_result_time_key=None):
+    """Remove a finished ResultTime and return the next one to update.
+
+    Args:
+      result_parent_key: the parent of the ResultTimes
+      done_result_time_key: a ResultTime key that is no longer dirty
+    Returns:
+      the next pending ResultTime key or None when all are done
+    """
+    def _UpdatePendingInTransaction():
+      marker = cls.get(cls.KeyFor(result_parent_key))
+      if marker is None:
+        return None
+      if done_result_time_key in marker.pending:
+        marker.pending.remove(done_result_time_key)
+        if marker.pending:
+          marker.leased = datetime.datetime.now()
+          marker.put()
+      if not marker.pending:
+        marker.delete()
+        return None
+      return marker.pending[0]
+    return db.run_in_transaction(_UpdatePendingInTransaction)
+
+  def LastActive(self):
+    return self.leased or self.created
+
+  @classmethod
+  def LeaseStalled(cls, key, stalled_before):
+    """Take over a parent whose chain made no progress since a given time.
+
+    Args:
+      key: a ResultParentDirty key
+      stalled_before: a datetime
+    Returns:
+      the first pending ResultTime key, or None if the marker is gone or
+      a chain renewed it in the meantime.
+    """
+    def _LeaseInTransaction():
+      marker = cls.get(key)
+      if (marker is None or not marker.pending or
+          marker.LastActive() >= stalled_before):
+        return None
+      marker.leased = datetime.datetime.now()
+      marker.put()
+      return marker.pending[0]
+    return db.run_in_transaction(_LeaseInTransaction)
+
+
 class ResultParent(db.Expando):
   """A parent entity for a test run.
 
@@ -139,7 +218,9 @@ class ResultParent(db.Expando):
                                  dirty=not is_import)
                       for test_key, values in results.items()]
       #logging.info('_AddResultInTransaction result_times(%s)' % result_times)
-      db.put(result_times)
+      result_time_keys = db.put(result_times)
+      if not is_import:
+        ResultParentDirty.Create(parent, result_time_keys).put()
       return result_times
     result_times = db.run_in_transaction(_AddResultInTransaction)
     if not skip_dirty_update:
@@ -160,16 +241,10 @@ class ResultParent(db.Expando):
       count: index of ResultTime for logging purposes
       task_name_prefix: change a task name to retry tombstoned tasks
     """
-    result_parent_key = result_time_key.parent()
     if not category:
-      category = cls.get(result_parent_key).category
-    task = taskqueue.Task(
-        url='/admin/update_dirty/%s/%s/%d/%s' % (
-            category, result_parent_key, count, result_time_key),
-        name='%supdatedirty-%s' % (
-            task_name_prefix, str(result_time_key).replace('_', '-under-')),
-        params={'result_time_key': result_time_key, 'category': category,
-                'count': count})
+      category = cls.get(result_time_key.parent()).category
+    task = cls.UpdateDirtyTask(
+        result_time_key, category, count, task_name_prefix)
 
     attempt = 0
     while attempt < 3:
@@ -184,11 +259,24 @@ class ResultParent(db.Expando):
       return False
     return True
 
+  @staticmethod
+  def UpdateDirtyTask(result_time_key, category, count=0, task_name_prefix=''):
+    """Return the task that ScheduleUpdateDirty adds (without adding it)."""
+    result_parent_key = result_time_key.parent()
+    return taskqueue.Task(
+        url='/admin/update_dirty/%s/%s/%d/%s' % (
+            category, result_parent_key, count, result_time_key),
+        name='%supdatedirty-%s' % (
+            task_name_prefix, str(result_time_key).replace('_', '-under-')),
+        params={'result_time_key': result_time_key, 'category': category,
+                'count': count})
+
   def UpdateStatsNonProduction(self):
     """This is not efficient enough to be used in prod."""
     result_times = self.GetResultTimes()
     for result_time in result_times:
       result_time.UpdateStats()
+    db.delete(ResultParentDirty.KeyFor(self.key()))
     result_stats.UpdateCategory(self.category, self.user_agent)
 
   def ResultTimesQuery(self):
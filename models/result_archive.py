@@ -0,0 +1,396 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License')
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cold storage for old results.
+
+ResultParents older than ARCHIVE_AGE_DAYS are packed with their ResultTimes
+into compressed ResultArchive entities, one or more per category and month,
+and the originals are deleted. The rankers already hold their scores, so
+only the dump, export and browse paths read archives. ArchivedResult stands
+in for a ResultParent so those paths can read live and archived results
+alike.
+"""
+
+__author__ = 'slamm@google.com (Stephen Lamm)'
+
+import datetime
+import logging
+import zlib
+
+from google.appengine.ext import db
+
+from django.utils import simplejson
+
+from models.result import ResultParent
+from models.result import ResultParentDirty
+from models.result import ResultTime
+from models.user_agent import UserAgent
+
+ARCHIVE_AGE_DAYS = 365
+# ResultParents per archive; keeps the blob well under the entity size limit.
+MAX_ARCHIVE_RESULTS = 100
+BOOKMARK_PREFIX = 'archive:'
+# Ascending browse reads archives first and then continues with the live
+# results from their first page.
+LIVE_BOOKMARK = 'live:'
+
+
+def ParseCreated(created_str):
+  """Parse datetime.isoformat() output (strptime has no %f in Python 2.5)."""
+  created_str, microseconds = (created_str.split('.') + ['0'])[:2]
+  created = datetime.datetime.strptime(created_str, '%Y-%m-%dT%H:%M:%S')
+  return created.replace(microsecond=int(microseconds.ljust(6, '0')))
+
+
+class ArchivedResultTime(object):
+  """A read-only ResultTime from an archive."""
+  dirty = False
+
+  def __init__(self, result_parent_key, id_or_name, test, score):
+    self._key = db.Key.from_path(
+        ResultTime.kind(), id_or_name, parent=result_parent_key)
+    self.test = test
+    self.score = score
+
+  def key(self):
+    return self._key
+
+
+class ArchivedResult(object):
+  """A read-only ResultParent from an archive.
+
+  Has the attributes and methods that templates and dumps use on a
+  ResultParent.
+  """
+
+  def __init__(self, row):
+    self._key = db.Key(row['key'])
+    self.category = row['category']
+    self.created = ParseCreated(row['created'])
+    self.user_agent_key = db.Key(row['user_agent_key'])
+    self.user_agent_string_list = row['string_list']
+    self.ip = row['ip']
+    self.user_id = row['user_id']
+    self.params_str = row['params_str']
+    self.loader_id = row['loader_id']
+    self._times = row['times']
+    self._user_agent = None
+
+  def key(self):
+    return self._key
+
+  @property
+  def user_agent(self):
+    if self._user_agent is None:
+      self._user_agent = UserAgent.get(self.user_agent_key)
+    return self._user_agent
+
+  def GetResultTimes(self):
+    return [ArchivedResultTime(self._key, id_or_name, test, score)
+            for id_or_name, test, score in self._times]
+
+  def GetResults(self):
+    """Return a dict of scores indexed by test key names."""
+    return dict((test, score) for id_or_name, test, score in self._times)
+
+  def GetBrowsers(self):
+    return self.user_agent_string_list
+
+
+class ResultArchive(db.Model):
+  """Compressed ResultParents and ResultTimes of one category and month.
+
+  key_name: '<category>_<YYYY-MM>_<created of the first result>_<its id>'
+  so that key order is created order within a category, and batches that
+  start at the same time still get their own entities. Re-archiving the same
+  batch after a failed delete overwrites the same entity.
+  """
+  category = db.StringProperty()
+  month = db.StringProperty()
+  first_created = db.DateTimeProperty(indexed=False)
+  last_created = db.DateTimeProperty(indexed=False)
+  num_results = db.IntegerProperty(indexed=False)
+  # The union of the results' string lists, to browse by user agent.
+  user_agent_string_list = db.StringListProperty()
+  # str() of the results' UserAgent keys, to find the archives to re-pack
+  # when a user agent's string list changes.
+  user_agent_keys = db.StringListProperty()
+  created = db.DateTimeProperty(auto_now_add=True)
+  data = db.BlobProperty()
+
+  @staticmethod
+  def KeyName(category, first_created, first_key):
+    return '%s_%s%06d_%s' % (category,
+                             first_created.strftime('%Y-%m_%Y%m%d%H%M%S'),
+                             first_created.microsecond,
+                             first_key.id_or_name())
+
+  @staticmethod
+  def ResultRow(result_parent, result_times):
+    user_agent_key = ResultParent.user_agent.get_value_for_datastore(
+        result_parent)
+    user = result_parent.user
+    return {
+        'key': str(result_parent.key()),
+        'category': result_parent.category,
+        'created': result_parent.created.isoformat(),
+        'user_agent_key': str(user_agent_key),
+        'string_list': result_parent.user_agent_string_list,
+        'ip': result_parent.ip,
+        'user_id': user and user.user_id() or None,
+        'params_str': result_parent.params_str,
+        'loader_id': getattr(result_parent, 'loader_id', None),
+        # ResultTime keys are stored as ids relative to the parent.
+        'times': [(t.key().id_or_name(), t.test, t.score)
+                  for t in result_times],
+        }
+
+  @classmethod
+  def Pack(cls, category, results):
+    """Pack results into one archive per month.
+
+    Args:
+      category: the category of the results
+      results: a list of (result_parent, result_times) ordered by created
+    Returns:
+      a list of unsaved ResultArchive entities
+    """
+    months = {}
+    for result_parent, result_times in results:
+      month = result_parent.created.strftime('%Y-%m')
+      months.setdefault(month, []).append((result_parent, result_times))
+    archives = []
+    for month, month_results in sorted(months.items()):
+      first_parent = month_results[0][0]
+      first_created = first_parent.created
+      archive = cls(
+          key_name=cls.KeyName(category, first_created, first_parent.key()),
+          category=category,
+          month=month,
+          first_created=first_created,
+          last_created=month_results[-1][0].created)
+      archive.SetRows([cls.ResultRow(p, t) for p, t in month_results])
+      archives.append(archive)
+    return archives
+
+  def GetRows(self):
+    return simplejson.loads(zlib.decompress(self.data))
+
+  def SetRows(self, rows):
+    """Compress rows into data and update the properties derived from them."""
+    string_lists = set()
+    for row in rows:
+      string_lists.update(row['string_list'])
+    self.num_results = len(rows)
+    self.user_agent_string_list = sorted(string_lists)
+    self.user_agent_keys = sorted(set(row['user_agent_key'] for row in rows))
+    self.data = db.Blob(zlib.compress(
+        simplejson.dumps(rows, separators=(',', ':'))))
+
+  def GetResults(self, user_agent=None):
+    """Return the archived results as ArchivedResults ordered by created.
+
+    Args:
+      user_agent: only include results with this string in their list
+    """
+    results = [ArchivedResult(row) for row in self.GetRows()]
+    if user_agent:
+      results = [r for r in results if user_agent in r.user_agent_string_list]
+    return results
+
+
+def ArchiveResults(category, before, after=None,
+                   batch_size=MAX_ARCHIVE_RESULTS):
+  """Archive a batch of a category's results created before a given time.
+
+  ResultParents still waiting on rankers (with a ResultParentDirty marker or
+  a dirty ResultTime) stay live and are archived by a later run.
+
+  Args:
+    category: a category string
+    before: archive results created before this datetime
+    after: continue after this (created, key) of a ResultParent
+    batch_size: the number of ResultParents to look at
+  Returns:
+    (num_archived, (last_created, last_key)); the tuple is None when done
+  """
+  result_parents = []
+  if after:
+    after_created, after_key = after
+    # First the rest of the parents that share the boundary time.
+    query = ResultParent.all().filter('category =', category)
+    query.filter('created =', after_created)
+    query.filter('__key__ >', after_key)
+    query.order('__key__')
+    result_parents = query.fetch(batch_size)
+  if len(result_parents) < batch_size:
+    query = ResultParent.all().filter('category =', category)
+    query.filter('created <', before)
+    if after:
+      query.filter('created >', after_created)
+    # Equal created times come back in key order.
+    query.order('created')
+    result_parents.extend(query.fetch(batch_size - len(result_parents)))
+  if not result_parents:
+    return 0, None
+  markers = db.get([ResultParentDirty.KeyFor(p.key()) for p in result_parents])
+  results = []
+  for result_parent, marker in zip(result_parents, markers):
+    if marker is None:
+      result_times = result_parent.GetResultTimes()
+      # Results dirtied before ResultParentDirty existed have no marker.
+      if not [t for t in result_times if t.dirty]:
+        results.append((result_parent, result_times))
+  if results:
+    db.put(ResultArchive.Pack(category, results))
+    delete_keys = []
+    for result_parent, result_times in results:
+      delete_keys.extend(t.key() for t in result_times)
+      delete_keys.append(result_parent.key())
+    db.delete(delete_keys)
+  logging.info('ArchiveResults: category=%s, archived %s of %s results',
+               category, len(results), len(result_parents))
+  last_parent = result_parents[-1]
+  return len(results), (last_parent.created, last_parent.key())
+
+
+def UpdateArchivedStringLists(user_agent):
+  """Re-pack the archived results of a user agent with its new string list.
+
+  Args:
+    user_agent: a UserAgent whose string list changed
+  Returns:
+    the number of archives re-packed
+  """
+  user_agent_key = str(user_agent.key())
+  string_list = user_agent.get_string_list()
+  query = ResultArchive.all(keys_only=True)
+  query.filter('user_agent_keys =', user_agent_key)
+  num_archives = 0
+  for archive_key in query:
+    if db.run_in_transaction(_UpdateStringListsInTransaction, archive_key,
+                             user_agent_key, string_list):
+      num_archives += 1
+  return num_archives
+
+
+def _UpdateStringListsInTransaction(archive_key, user_agent_key, string_list):
+  archive = ResultArchive.get(archive_key)
+  if archive is None:
+    return False
+  rows = archive.GetRows()
+  is_changed = False
+  for row in rows:
+    if (row['user_agent_key'] == user_agent_key and
+        row['string_list'] != string_list):
+      row['string_list'] = string_list
+      is_changed = True
+  if is_changed:
+    archive.SetRows(rows)
+    archive.put()
+  return is_changed
+
+
+def ArchiveQuery(category, user_agent=None):
+  query = ResultArchive.all().filter('category =', category)
+  if user_agent:
+    query.filter('user_agent_string_list =', user_agent)
+  return query
+
+
+def IterResults(category):
+  """Yield a category's archived and then live results, oldest first.
+
+  Archived results are older than live ones except for the few that were
+  still dirty when their month was archived.
+  """
+  for archive in ArchiveQuery(category).order('__key__'):
+    for result in archive.GetResults():
+      yield result
+  query = ResultParent.all().filter('category =', category).order('created')
+  for result_parent in query:
+    yield result_parent
+
+
+def HasArchives(category, user_agent=None):
+  query = ArchiveQuery(category, user_agent)
+  return query.get() is not None
+
+
+def ParseBookmark(bookmark):
+  """Parse an archive bookmark (see FetchArchivedResults).
+
+  Returns:
+    (archive key name, number of results already shown); the key name is
+    None for the first page
+  Raises:
+    ValueError: the bookmark is malformed
+  """
+  if not bookmark.startswith(BOOKMARK_PREFIX):
+    raise ValueError('Not an archive bookmark: %r' % bookmark)
+  position = bookmark[len(BOOKMARK_PREFIX):]
+  if not position:
+    return None, 0
+  key_name, separator, offset = position.rpartition(':')
+  # Key names starting with '__' are reserved and rejected by the datastore.
+  if not key_name or key_name.startswith('__') or not offset.isdigit():
+    raise ValueError('Bad archive bookmark: %r' % bookmark)
+  return key_name, int(offset)
+
+
+def FetchArchivedResults(category, user_agent, limit, bookmark,
+                         order='desc'):
+  """Page through archived results.
+
+  Newest first, browsing continues here once the live results run out.
+  Oldest first ('asc'), browsing starts here and continues with the live
+  results (see LIVE_BOOKMARK).
+
+  Args:
+    category: a category string
+    user_agent: an optional user agent string list entry to filter by
+    limit: the number of results to return
+    bookmark: BOOKMARK_PREFIX, optionally followed by
+        '<archive key name>:<number of results already shown>'
+    order: 'desc' for newest first, 'asc' for oldest first
+  Returns:
+    (results, next_bookmark)
+  Raises:
+    ValueError: the bookmark is malformed (see ParseBookmark)
+  """
+  is_descending = order == 'desc'
+  query = ArchiveQuery(category, user_agent)
+  query.order(is_descending and '-__key__' or '__key__')
+  key_name, offset = ParseBookmark(bookmark)
+  if key_name:
+    query.filter(is_descending and '__key__ <=' or '__key__ >=',
+                 db.Key.from_path(ResultArchive.kind(), key_name))
+  results = []
+  next_bookmark = None
+  for archive in query:
+    if len(results) == limit:
+      next_bookmark = '%s%s:0' % (BOOKMARK_PREFIX, archive.key().name())
+      break
+    archive_results = archive.GetResults(user_agent)
+    if is_descending:
+      archive_results.reverse()
+    end = offset + limit - len(results)
+    results.extend(archive_results[offset:end])
+    if len(archive_results) > end:
+      next_bookmark = '%s%s:%d' % (BOOKMARK_PREFIX, archive.key().name(), end)
+      break
+    offset = 0
+  return results, next_bookmark
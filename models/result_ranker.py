@@ -24,9 +24,13 @@ import logging
 from google.appengine.api import memcache
 from google.appengine.ext import db
 
+from models import ranker_upload
+
 class RankerCacher(object):
 
   MEMCACHE_NAMESPACE = 'result_ranker'
+  # The most keys in one datastore get.
+  MAX_DB_GET_KEYS = 1000
 
   @classmethod
   def CachePut(cls, ranker):
@@ -34,24 +38,55 @@ class RankerCacher(object):
                  namespace=cls.MEMCACHE_NAMESPACE)
     ranker.put()
 
+  @classmethod
+  def CachePutMulti(cls, rankers):
+    """Write rankers with one memcache set and one datastore put."""
+    if not rankers:
+      return
+    memcache.set_multi(dict((r.key().name(), r.ToString()) for r in rankers),
+                       namespace=cls.MEMCACHE_NAMESPACE)
+    db.put(rankers)
+
   @classmethod
   def CacheGet(cls, key_names, ranker_classes):
+    """Get rankers from memcache and then the datastore.
+
+    Rankers of all kinds that are not in memcache are fetched together.
+
+    Args:
+      key_names: a list of ranker key names
+      ranker_classes: a dict of ranker classes indexed by key name
+    Returns:
+      {key_name: ranker, ...}  (rankers that do not exist are left out)
+    """
     serialized_rankers = memcache.get_multi(
         key_names, namespace=cls.MEMCACHE_NAMESPACE)
     rankers = dict((k, ranker_classes[k].FromString(k, v))
                    for k, v in serialized_rankers.items())
-    db_key_names = {}
-    for key_name in key_names:
-      if key_name not in rankers:
-        db_key_names.setdefault(ranker_classes[key_name], []).append(key_name)
+    db_key_names = [k for k in key_names if k not in rankers]
     if db_key_names:
-      for ranker_class, key_names in db_key_names.items():
-        for key_name, ranker in zip(
-            key_names, ranker_class.get_by_key_name(key_names)):
-          if ranker:
-            rankers[key_name] = ranker
+      db_keys = [db.Key.from_path(ranker_classes[k].kind(), k)
+                 for k in db_key_names]
+      for key_name, ranker in zip(db_key_names, cls._DbGet(db_keys)):
+        if ranker:
+          rankers[key_name] = ranker
     return rankers
 
+  @classmethod
+  def _DbGet(cls, keys):
+    """Datastore get in batches, all in flight at once where supported."""
+    batches = [keys[i:i + cls.MAX_DB_GET_KEYS]
+               for i in range(0, len(keys), cls.MAX_DB_GET_KEYS)]
+    if len(batches) > 1 and hasattr(db, 'get_async'):
+      rpcs = [db.get_async(batch) for batch in batches]
+      batch_results = [rpc.get_result() for rpc in rpcs]
+    else:
+      batch_results = [db.get(batch) for batch in batches]
+    entities = []
+    for batch_result in batch_results:
+      entities.extend(batch_result)
+    return entities
+
 
 class CountRanker(db.Model):
   """Maintain a list of score counts.
@@ -91,9 +126,16 @@ class CountRanker(db.Model):
     self.counts[score] += 1
     RankerCacher.CachePut(self)
 
-  def SetValues(self, counts, num_scores):
+  def SetValues(self, counts, num_scores, cache_put=True):
     self.counts = counts
-    RankerCacher.CachePut(self)
+    if cache_put:
+      RankerCacher.CachePut(self)
+
+  def GetValues(self):
+    return self.counts
+
+  def GetChecksum(self):
+    return ranker_upload.ValuesChecksum(self.counts, sum(self.counts))
 
   def ToString(self):
     return array.array('L', self.counts).tostring()
@@ -140,10 +182,17 @@ class LastNRanker(db.Model):
     self.num_scores += 1
     RankerCacher.CachePut(self)
 
-  def SetValues(self, scores, num_scores):
+  def SetValues(self, scores, num_scores, cache_put=True):
     self.scores = scores
     self.num_scores = num_scores
-    RankerCacher.CachePut(self)
+    if cache_put:
+      RankerCacher.CachePut(self)
+
+  def GetValues(self):
+    return self.scores
+
+  def GetChecksum(self):
+    return ranker_upload.ValuesChecksum(self.scores, self.num_scores)
 
   def ToString(self):
     return array.array('l', self.scores + [self.num_scores]).tostring()
@@ -171,6 +220,23 @@ def RankerClass(min_value, max_value):
     return LastNRanker
 
 
+def TestRankerKeyName(test, browser, params_str=None):
+  category = test.test_set.category
+
+  # If this is an aliased UserTest (like HTML5), use its key instead.
+  if test.test_set.user_test_category is not None:
+    category = test.test_set.user_test_category
+    #logging.info('GetRankers Special Category: %s:%s' % (category, test.key))
+
+  return RankerKeyName(category, test.key, browser, params_str)
+
+
+def NewRanker(test, browser, params_str=None):
+  """Return an unsaved ranker for the given args."""
+  ranker_class = RankerClass(test.min_value, test.max_value)
+  return ranker_class(key_name=TestRankerKeyName(test, browser, params_str))
+
+
 def GetRanker(test, browser, params_str=None):
   """Get a ranker that matches the given args.
 
@@ -196,17 +262,28 @@ def GetRankers(test_browsers, params_str=None, use_insert=False):
     a list of instances derived from RankerBase
     (None for each ranker that does not exist).
   """
-  key_names = []
-  ranker_classes = {}
-  for test, browser in test_browsers:
-    category = test.test_set.category
+  return GetRankersMulti([(test, browser, params_str)
+                          for test, browser in test_browsers], use_insert)
+
+
+def GetRankersMulti(test_browser_params, use_insert=False):
+  """Get the rankers of tests from any number of test sets at once.
 
-    # If this is an aliased UserTest (like HTML5), use its key instead.
-    if test.test_set.user_test_category is not None:
-      category = test.test_set.user_test_category
-      #logging.info('GetRankers Special Category: %s:%s' % (category, test.key))
+  All the rankers are looked up with one memcache get and one round of
+  datastore gets.
 
-    key_name = RankerKeyName(category, test.key, browser, params_str)
+  Args:
+    test_browser_params: a list of tuples of (test_instance, browser,
+        params_str).
+    use_insert: a boolean for whether to create non-existent rankers.
+  Returns:
+    a list of instances derived from RankerBase
+    (None for each ranker that does not exist).
+  """
+  key_names = []
+  ranker_classes = {}
+  for test, browser, params_str in test_browser_params:
+    key_name = TestRankerKeyName(test, browser, params_str)
     #logging.info('RankerKeyName: %s' % key_name)
     key_names.append(key_name)
     ranker_classes[key_name] = RankerClass(test.min_value, test.max_value)
@@ -16,15 +16,19 @@
 
 """Shared models."""
 
+import bisect
 import logging
 import sys
+import time
 
 from google.appengine.ext import db
 from google.appengine.api import memcache
 from google.appengine.runtime import DeadlineExceededError
 
 from categories import all_test_sets
+from categories import test_set_base
 from models.user_agent import UserAgent
+import settings
 
 BROWSER_NAV = (
     # version_level, label
@@ -63,10 +67,88 @@ BROWSER_LIMIT = 25
 
 TOP_BROWSERS = TOP_DESKTOP_BROWSERS + TOP_DESKTOP_EDGE_BROWSERS + TOP_MOBILE_BROWSERS
 
+
+class _BrowserKeys(object):
+    """A read-only sequence of the sort keys of a browser list (for bisect)."""
+
+    def __init__(self, browsers, browser_key):
+        self.browsers = browsers
+        self.browser_key = browser_key
+
+    def __len__(self):
+        return len(self.browsers)
+
+    def __getitem__(self, index):
+        return self.browser_key(self.browsers[index])
+
+
+# Browsers that a prefix filter should skip even though the prefix matches.
+BROWSER_FILTER_EXCLUSIONS = {
+    'Opera*': ('Opera Mini',),
+}
+
+
+class BrowserPrefixIndex(object):
+    """Match exact ('Firefox 3') and prefix ('Firefox 3*') browser filters.
+
+    The browsers are kept in string order so each filter is a bisect plus a
+    walk over the k browsers that match it.
+    """
+
+    def __init__(self, browsers, exclusions=BROWSER_FILTER_EXCLUSIONS):
+        """Initialize the index.
+
+        Args:
+            browsers: a list of browsers in display order.
+            exclusions: {prefix filter: (excluded prefix, ...), ...}
+        """
+        self.browsers = tuple(browsers)
+        self.exclusions = exclusions
+        self.positions = range(len(self.browsers))
+        self.positions.sort(key=self.browsers.__getitem__)
+        self.names = [self.browsers[i] for i in self.positions]
+
+    def _PrefixRange(self, prefix):
+        low = high = bisect.bisect_left(self.names, prefix)
+        while high < len(self.names) and self.names[high].startswith(prefix):
+            high += 1
+        return low, high
+
+    def Filter(self, filters):
+        """Return the browsers that match any of the filters.
+
+        Args:
+            filters: a list of filters like 'Firefox*' (prefix) or 'Firefox 3' (exact)
+        Returns:
+            a list of browsers in display order
+        """
+        positions = set()
+        for filtr in filters:
+            if filtr[-1:] == '*':
+                low, high = self._PrefixRange(filtr[:-1])
+                excluded = set()
+                for prefix in self.exclusions.get(filtr, ()):
+                    excluded.update(range(*self._PrefixRange(prefix)))
+                positions.update(self.positions[i] for i in range(low, high)
+                                 if i not in excluded)
+            else:
+                index = bisect.bisect_left(self.names, filtr)
+                if index < len(self.names) and self.names[index] == filtr:
+                    positions.add(self.positions[index])
+        return [self.browsers[i] for i in sorted(positions)]
+
 class CategoryBrowserManager(db.Model):
     """Track the browsers that belong in each category/version level."""
 
     MEMCACHE_NAMESPACE = 'category_level_browsers'
+    # Sort keys memoized per browser string (see BrowserKey).
+    MAX_BROWSER_KEYS = 50000
+    _browser_keys = {}
+    # Versions of the browser lists, bumped whenever a list changes.
+    VERSION_MEMCACHE_NAMESPACE = 'category_level_browsers_version'
+    # Filter indexes of level 3 browsers by category (see GetPrefixIndex).
+    MAX_PREFIX_INDEXES = 100
+    _prefix_indexes = {}
 
     browsers = db.StringListProperty(default=[], indexed=False)
 
@@ -90,34 +172,59 @@ class CategoryBrowserManager(db.Model):
             category: a category string like 'network' or 'reflow'.
             user_agent: a UserAgent instance.
         """
-        key_names = [cls.KeyName(category, v) for v in range(4)]
-        version_levels = range(4)
-        if category in [t.category for t in all_test_sets.GetVisibleTestSets()]:
-            key_names.extend([cls.KeyName('summary', v) for v in range(4)])
-            version_levels.extend(range(4))
-        level_browsers = memcache.get_multi(key_names,
+        cls.AddUserAgents([(category, user_agent)])
+
+    @classmethod
+    def AddUserAgents(cls, category_user_agents):
+        """Adds the browser strings of many user agents (see AddUserAgent).
+
+        The new browsers of each category/version level are merged first so
+        that every affected manager is read and written once.
+
+        Args:
+            category_user_agents: a list of (category, UserAgent instance) tuples
+        """
+        visible_categories = set(
+                t.category for t in all_test_sets.GetVisibleTestSets())
+        level_new_browsers = {}
+        for category, user_agent in category_user_agents:
+            categories = [category]
+            if category in visible_categories:
+                categories.append('summary')
+            ua_browsers = user_agent.get_string_list()
+            max_ua_browsers_index = len(ua_browsers) - 1
+            for level_category in categories:
+                for version_level in range(4):
+                    browser = ua_browsers[min(max_ua_browsers_index, version_level)]
+                    level_new_browsers.setdefault(
+                            cls.KeyName(level_category, version_level), set()
+                            ).add(browser)
+        level_browsers = memcache.get_multi(level_new_browsers.keys(),
                                             namespace=cls.MEMCACHE_NAMESPACE)
-        browser_key_names = []
-        ua_browsers = user_agent.get_string_list()
-        max_ua_browsers_index = len(ua_browsers) - 1
-        for version_level, key_name in zip(version_levels, key_names):
-            browser = ua_browsers[min(max_ua_browsers_index, version_level)]
-            if browser not in level_browsers.get(key_name, []):
-                browser_key_names.append((browser, key_name))
-        managers = cls.get_by_key_name([x[1] for x in browser_key_names])
+        for key_name, browsers in level_new_browsers.items():
+            browsers.difference_update(level_browsers.get(key_name, []))
+            if not browsers:
+                del level_new_browsers[key_name]
+        key_names = level_new_browsers.keys()
+        managers = cls.get_by_key_name(key_names)
 
         updated_managers = []
         memcache_mapping = {}
-        for (browser, key_name), manager in zip(browser_key_names, managers):
+        for key_name, manager in zip(key_names, managers):
             if manager is None:
                 manager = cls.get_or_insert(key_name)
-            if browser not in manager.browsers:
-                cls.InsortBrowser(manager.browsers, browser)
+            is_updated = False
+            for browser in level_new_browsers[key_name]:
+                if browser not in manager.browsers:
+                    cls.InsortBrowser(manager.browsers, browser)
+                    is_updated = True
+            if is_updated:
                 updated_managers.append(manager)
                 memcache_mapping[key_name] = manager.browsers
         if updated_managers:
             db.put(updated_managers)
             memcache.set_multi(memcache_mapping, namespace=cls.MEMCACHE_NAMESPACE)
+            cls._BumpVersions(memcache_mapping.keys())
 
     @classmethod
     def GetBrowsers(cls, category, version_level,
@@ -192,16 +299,52 @@ class CategoryBrowserManager(db.Model):
         Returns:
             ('Firefox 3.1', 'Safari 4.0', 'Safari 4.5', ...)
         """
-        filtered_browsers = []
-        for browser in cls.GetBrowsers(category, version_level=3):
-            for filtr in filters:
-                if filtr[-1:] == '*':
-                    if (browser.startswith(filtr[:-1]) and
-                            (filtr != 'Opera*' or not browser.startswith('Opera Mini'))):
-                        filtered_browsers.append(browser)
-                elif browser == filtr:
-                    filtered_browsers.append(browser)
-        return filtered_browsers
+        return cls.GetPrefixIndex(category).Filter(filters)
+
+    @classmethod
+    def GetPrefixIndex(cls, category):
+        """Get the filter index of a category's level 3 browsers.
+
+        The index is kept per process along with the version of the browser
+        list it was built from. Only the version is read per request; the
+        browser list is read again when the version changes.
+
+        Args:
+            category: a category string like 'network' or 'reflow'.
+        Returns:
+            a BrowserPrefixIndex instance
+        """
+        test_set = all_test_sets.GetTestSet(category)
+        if test_set is not None and test_set.user_test_category is not None:
+            key_name = cls.KeyName(test_set.user_test_category, 3)
+        else:
+            key_name = cls.KeyName(category, 3)
+        version = memcache.get(key_name,
+                               namespace=cls.VERSION_MEMCACHE_NAMESPACE)
+        if version is None:
+            version = cls._BumpVersions([key_name])
+        cached = cls._prefix_indexes.get(category)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        prefix_index = BrowserPrefixIndex(
+                tuple(cls.GetBrowsers(category, version_level=3)))
+        if (category not in cls._prefix_indexes and
+                len(cls._prefix_indexes) >= cls.MAX_PREFIX_INDEXES):
+            cls._prefix_indexes.clear()
+        cls._prefix_indexes[category] = version, prefix_index
+        return prefix_index
+
+    @classmethod
+    def _BumpVersions(cls, key_names):
+        """Mark the browser lists of category/version levels as changed.
+
+        A version that falls out of memcache is simply restarted, which only
+        costs each process one rebuild of the prefix index.
+        """
+        version = time.time()
+        memcache.set_multi(dict.fromkeys(key_names, version),
+                           namespace=cls.VERSION_MEMCACHE_NAMESPACE)
+        return version
 
     @classmethod
     def SetBrowsers(cls, category, version_level, browsers):
@@ -211,6 +354,8 @@ class CategoryBrowserManager(db.Model):
         manager = cls.get_or_insert(key_name)
         manager.browsers = browsers
         manager.put()
+        cls._BumpVersions([key_name])
+        CategoryContentVersion.Bump(category)
 
     @classmethod
     def UpdateSummaryBrowsers(cls, categories):
@@ -240,20 +385,29 @@ class CategoryBrowserManager(db.Model):
             browsers: a list of strings (e.g. ['iPhone 3.1', 'Safari 4.1'])
             browser: a list of strings
         """
-        browser_key = cls.BrowserKey(browser)
-        low, high = 0, len(browsers)
-        while low < high:
-            mid = (low + high) / 2
-            if browser_key < cls.BrowserKey(browsers[mid]):
-                high = mid
-            else:
-                low = mid + 1
+        index = bisect.bisect_right(
+                _BrowserKeys(browsers, cls.BrowserKey), cls.BrowserKey(browser))
         if not hasattr(browsers, 'insert'):
             logging.fatal('Unexpected browsers list: %s', browsers)
-        browsers.insert(low, browser)
+        browsers.insert(index, browser)
 
     @classmethod
     def BrowserKey(cls, browser):
+        """Return the sort key of a browser string.
+
+        Keys are kept for the life of the process since parsing the browser
+        string is much slower than the lookup.
+        """
+        try:
+            return cls._browser_keys[browser]
+        except KeyError:
+            if len(cls._browser_keys) >= cls.MAX_BROWSER_KEYS:
+                cls._browser_keys.clear()
+            browser_key = cls._browser_keys[browser] = cls.ParseBrowserKey(browser)
+            return browser_key
+
+    @classmethod
+    def ParseBrowserKey(cls, browser):
         VERSION_DIGITS = 8
         MAX_VERSION = 99999999
         family, v1, v2, v3 = UserAgent.parse_pretty(browser.lower())
@@ -291,6 +445,214 @@ class CategoryBrowserManager(db.Model):
         memcache.delete(key_name, namespace=cls.MEMCACHE_NAMESPACE)
 
 
+class BrowserChangeLog(db.Model):
+    """Track which browser rows of a category/version level have changed.
+
+    Subclasses set MEMCACHE_NAMESPACE and decide what a change is relative to
+    (e.g. StaticDeltaLog logs the rows that changed since a static snapshot).
+
+    Memcache holds (generation, browsers) hints for each log. Clearing a log
+    bumps its generation, so a hint set by a write that raced with the clear
+    is ignored instead of hiding browsers that are no longer logged.
+    """
+
+    MEMCACHE_NAMESPACE = None
+    GENERATION_PREFIX = 'generation_'
+
+    browsers = db.StringListProperty(default=[], indexed=False)
+
+    @classmethod
+    def AddUserAgent(cls, category, user_agent):
+        """Log a user agent's browser strings for every version level.
+
+        Like CategoryBrowserManager.AddUserAgent, a level without its own
+        string uses the one from the previous level. The datastore is only
+        written when a browser is new to a level's log.
+
+        Args:
+            category: a category string like 'network' or 'reflow'.
+            user_agent: a UserAgent instance.
+        """
+        key_names = [cls.KeyName(category, v) for v in range(4)]
+        logged_browsers, generations = cls._GetHints(key_names)
+        ua_browsers = user_agent.get_string_list()
+        max_ua_browsers_index = len(ua_browsers) - 1
+        memcache_mapping = {}
+        for version_level, key_name in enumerate(key_names):
+            browser = ua_browsers[min(max_ua_browsers_index, version_level)]
+            if browser in logged_browsers.get(key_name, []):
+                continue
+            memcache_mapping[key_name] = db.run_in_transaction(
+                    cls._AddBrowserInTransaction, key_name, browser)
+        cls._SetHints(memcache_mapping, generations)
+
+    @classmethod
+    def _AddBrowserInTransaction(cls, key_name, browser):
+        change_log = cls.get_by_key_name(key_name)
+        if change_log is None:
+            change_log = cls(key_name=key_name)
+        if browser not in change_log.browsers:
+            change_log.browsers.append(browser)
+            change_log.put()
+        return change_log.browsers
+
+    @classmethod
+    def GetBrowsers(cls, category, version_level):
+        """Get the logged browsers for a version level.
+
+        Args:
+            category: a category string like 'network' or 'reflow'.
+            version_level: 0 (family), 1 (major), 2 (minor), 3 (3rd).
+                Any other level (e.g. 'top') gets the browsers of all levels.
+        Returns:
+            ['Firefox 3.1', 'Safari 4.0', ...]  # Order is undefined
+        """
+        if str(version_level) in ('0', '1', '2', '3'):
+            version_levels = [version_level]
+        else:
+            version_levels = range(4)
+        key_names = [cls.KeyName(category, v) for v in version_levels]
+        level_browsers, generations = cls._GetHints(key_names)
+        missing_key_names = [k for k in key_names if k not in level_browsers]
+        if missing_key_names:
+            memcache_mapping = {}
+            for key_name, change_log in zip(
+                    missing_key_names, cls.get_by_key_name(missing_key_names)):
+                memcache_mapping[key_name] = change_log and change_log.browsers or []
+            cls._SetHints(memcache_mapping, generations)
+            level_browsers.update(memcache_mapping)
+        browsers = set()
+        for key_name in key_names:
+            browsers.update(level_browsers[key_name])
+        return list(browsers)
+
+    @classmethod
+    def Clear(cls, category):
+        """Forget the logged browsers for all version levels."""
+        key_names = [cls.KeyName(category, v) for v in range(4)]
+        db.delete([db.Key.from_path(cls.kind(), k) for k in key_names])
+        cls._BumpGenerations(key_names)
+
+    @classmethod
+    def KeyName(cls, category, version_level):
+        return '%s_%s' % (category, version_level)
+
+    @classmethod
+    def _GetHints(cls, key_names):
+        """Get the memcache hints that match the current generations.
+
+        Returns:
+            (browsers_by_key_name, generations_by_key_name)
+        """
+        generation_keys = [cls.GENERATION_PREFIX + k for k in key_names]
+        cached = memcache.get_multi(key_names + generation_keys,
+                                    namespace=cls.MEMCACHE_NAMESPACE)
+        missing_key_names = [k for k in key_names
+                             if cls.GENERATION_PREFIX + k not in cached]
+        generations = {}
+        if missing_key_names:
+            generations.update(cls._BumpGenerations(missing_key_names))
+        hints = {}
+        for key_name in key_names:
+            generation = generations.setdefault(
+                    key_name, cached.get(cls.GENERATION_PREFIX + key_name))
+            hint = cached.get(key_name)
+            if hint and hint[0] == generation:
+                hints[key_name] = hint[1]
+        return hints, generations
+
+    @classmethod
+    def _SetHints(cls, browsers_by_key_name, generations):
+        """Cache browser lists under the generations read before they were."""
+        if browsers_by_key_name:
+            memcache.set_multi(
+                    dict((k, (generations[k], browsers))
+                         for k, browsers in browsers_by_key_name.items()),
+                    namespace=cls.MEMCACHE_NAMESPACE)
+
+    @classmethod
+    def _BumpGenerations(cls, key_names):
+        generation = time.time()
+        memcache.set_multi(
+                dict((cls.GENERATION_PREFIX + k, generation) for k in key_names),
+                namespace=cls.MEMCACHE_NAMESPACE)
+        return dict.fromkeys(key_names, generation)
+
+
+class StaticDeltaLog(BrowserChangeLog):
+    """Track the browsers with results newer than a category's static snapshot.
+
+    Static categories (settings.STATIC_CATEGORIES) serve stats from snapshots
+    made by bin/gen_static_stats_tables.py. The rows logged here get served
+    live on top of the snapshot. Clear the log when a new snapshot is made.
+    """
+
+    MEMCACHE_NAMESPACE = 'static_delta'
+
+    @classmethod
+    def MergeStats(cls, test_set, static_stats, browsers, test_keys,
+                   incomplete_browsers=None):
+        """Overlay live stats rows onto a static snapshot.
+
+        Args:
+            test_set: a TestSet instance
+            static_stats: a stats dict loaded from a static snapshot.
+                (see CategoryStatsManager.GetStats)
+            browsers: a list of browsers that changed since the snapshot.
+            test_keys: a list of test keys to include in 'results'.
+            incomplete_browsers: an optional list to which the browsers whose
+                live rows were left out after a deadline are appended
+        Returns:
+            static_stats with the live rows for the given browsers.
+        """
+        live_stats = CategoryStatsManager.GetStats(
+                test_set, browsers, test_keys,
+                incomplete_browsers=incomplete_browsers)
+        del live_stats['total_runs']
+        static_stats.update(live_stats)
+        static_stats['total_runs'] = sum(
+                ua_stats.get('total_runs', 0)
+                for browser, ua_stats in static_stats.items()
+                if browser != 'total_runs')
+        return static_stats
+
+
+class StatsRefreshLog(BrowserChangeLog):
+    """Track the browsers with new results since the last stats refresh.
+
+    Scheduled refreshes take the logged browsers of a category and
+    recompute only those rows (see base.admin.UpdateAllStatsCache).
+    """
+
+    MEMCACHE_NAMESPACE = 'stats_refresh_log'
+
+    @classmethod
+    def TakeBrowsers(cls, category):
+        """Get the logged browsers for all version levels and clear the log.
+
+        Args:
+            category: a category string like 'network' or 'reflow'.
+        Returns:
+            ['Firefox', 'Firefox 3', 'Firefox 3.1', ...]  # Order is undefined
+        """
+        key_names = [cls.KeyName(category, v) for v in range(4)]
+        browsers = set()
+        for key_name in key_names:
+            browsers.update(db.run_in_transaction(
+                    cls._TakeBrowsersInTransaction, key_name))
+        # Only after the logs are gone; see BrowserChangeLog.
+        cls._BumpGenerations(key_names)
+        return list(browsers)
+
+    @classmethod
+    def _TakeBrowsersInTransaction(cls, key_name):
+        change_log = cls.get_by_key_name(key_name)
+        if change_log is None:
+            return []
+        change_log.delete()
+        return change_log.browsers
+
+
 class SummaryStatsManager(db.Model):
     MEMCACHE_NAMESPACE = 'summary_stats'
 
@@ -303,7 +665,8 @@ class SummaryStatsManager(db.Model):
     def UpdateStats(cls, category, stats):
         """Update the summary stats in memory and the datastore.
 
-        This will only update part of a summary score row.
+        This updates the category's part of each summary row and the row's
+        summary, so complete rows can be served as they are.
 
         Args:
             category: a category string like 'network'
@@ -326,33 +689,57 @@ class SummaryStatsManager(db.Model):
             if category == 'acid3':
                 ua_summary_stats['results']['acid3']['display'] = (
                         stats[browser]['results']['score']['display'])
+            cls._AddRowSummary(ua_summary_stats)
         memcache.set_multi(update_summary_stats, namespace=cls.MEMCACHE_NAMESPACE)
         return update_summary_stats
 
     @classmethod
-    def _FindAndUpdateStats(cls, category, browsers):
-        test_set = all_test_sets.GetTestSet(category)
-        ua_stats = CategoryStatsManager.GetStats(
-                test_set, browsers, [t.key for t in test_set.VisibleTests()])
-        return cls.UpdateStats(category, ua_stats)
+    def _FindAndUpdateStats(cls, category_browsers):
+        """Load category stats and add them to the summary rows.
+
+        Args:
+            category_browsers: {category: [browser, ...], ...}
+        Returns:
+            The summary stats that have been updated (see UpdateStats).
+        """
+        categories = sorted(category_browsers)
+        requests = []
+        for category in categories:
+            test_set = all_test_sets.GetTestSet(category)
+            requests.append((test_set, category_browsers[category],
+                             [t.key for t in test_set.VisibleTests()]))
+        update_summary_stats = {}
+        for category, ua_stats in zip(
+                categories, CategoryStatsManager.GetStatsMulti(requests)):
+            update_summary_stats.update(cls.UpdateStats(category, ua_stats))
+        return update_summary_stats
+
+    @classmethod
+    def _AddRowSummary(cls, ua_summary_stats):
+        """Update one browser's summary row with its summary.
+
+        Returns:
+            the total runs of the row.
+        """
+        results = ua_summary_stats['results']
+        categories = results.keys()
+        score = int(sum(results[c]['score'] for c in categories)
+                                / len(categories))
+        display = '%s/100' % score
+        total_runs = sum(results[c]['total_runs'] for c in categories)
+        ua_summary_stats.update({
+                'summary_score': score,
+                'summary_display': display,
+                'total_runs': total_runs,
+                })
+        return total_runs
 
     @classmethod
     def _AddSummaryOfSummaries(cls, summary_stats):
         """Update summary_stats with row summaries."""
         grand_total_runs = 0
         for browser in summary_stats.keys():
-            results = summary_stats[browser]['results']
-            categories = results.keys()
-            score = int(sum(results[c]['score'] for c in categories)
-                                    / len(categories))
-            display = '%s/100' % score
-            total_runs = sum(results[c]['total_runs'] for c in categories)
-            grand_total_runs += total_runs
-            summary_stats[browser].update({
-                    'summary_score': score,
-                    'summary_display': display,
-                    'total_runs': total_runs,
-                    })
+            grand_total_runs += cls._AddRowSummary(summary_stats[browser])
         summary_stats['total_runs'] = grand_total_runs
 
 
@@ -382,23 +769,33 @@ class SummaryStatsManager(db.Model):
                 browsers, namespace=cls.MEMCACHE_NAMESPACE)
         if not categories:
             categories = [t.category for t in all_test_sets.GetVisibleTestSets()]
-        # Trim any unwanted stats and find any missing stats.
+        sorted_categories = sorted(categories)
+        # Rows kept up to date by UpdateStats are served as they are.
+        # Only find any missing stats.
         missing_stats = {}
         for browser in browsers:
             ua_summary_stats = summary_stats.get(browser, {'results': {}})
             existing_categories = ua_summary_stats['results'].keys()
-            for category in existing_categories:
-                if category not in categories:
-                    del ua_summary_stats['results'][category]
             for category in categories:
                 if category not in existing_categories:
                     missing_stats.setdefault(category, []).append(browser)
         # Load any missing stats
-        for category, browsers in missing_stats.items():
-            updated_stats = cls._FindAndUpdateStats(category, browsers)
-            summary_stats.update(updated_stats)
+        if missing_stats:
+            summary_stats.update(cls._FindAndUpdateStats(missing_stats))
 
-        cls._AddSummaryOfSummaries(summary_stats)
+        # Trim any unwanted stats and redo the summaries of changed rows.
+        grand_total_runs = 0
+        for browser in summary_stats.keys():
+            ua_summary_stats = summary_stats[browser]
+            results = ua_summary_stats['results']
+            if (sorted(results.keys()) != sorted_categories or
+                    'summary_score' not in ua_summary_stats):
+                for category in results.keys():
+                    if category not in categories:
+                        del results[category]
+                cls._AddRowSummary(ua_summary_stats)
+            grand_total_runs += ua_summary_stats['total_runs']
+        summary_stats['total_runs'] = grand_total_runs
         return summary_stats
 
     @classmethod
@@ -407,19 +804,36 @@ class SummaryStatsManager(db.Model):
 
 
 class CategoryStatsManager(object):
-    """Manage statistics for a category."""
+    """Manage statistics for a category.
+
+    Each browser row is cached in column shards: a summary shard with
+    summary_score, summary_display and total_runs, plus one shard of results
+    for every TESTS_PER_SHARD visible tests. Views of a few tests (f=) only
+    fetch the shards they need.
+    """
 
     MEMCACHE_NAMESPACE_PREFIX = 'category_stats'
+    SUMMARY_SHARD = 'summary'
+    TESTS_PER_SHARD = 20
+    # Rows of tables with more tests are cached as they are built.
+    INCREMENTAL_SAVE_NUM_TESTS = 30
 
     @classmethod
-    def GetStats(cls, test_set, browsers, test_keys, use_memcache=True):
+    def GetStats(cls, test_set, browsers, test_keys, use_memcache=True,
+                 incomplete_browsers=None):
         """Get stats table for a given test_set.
 
+        Summary values are always for all the visible tests. If the test set
+        has independent_test_scores, missing test shards are computed from
+        the rankers of just their tests.
+
         Args:
             test_set: a TestSet instance
             browsers: a list of browsers to use instead of version level
-            test_keys: a list of test keys to include in 'results'.
+            test_keys: a list of visible test keys to include in 'results'.
             use_memcache: whether to use memcache or not
+            incomplete_browsers: an optional list to which the browsers left
+                out after a deadline are appended
         Returns:
             {
                     browser: {
@@ -440,42 +854,223 @@ class CategoryStatsManager(object):
                     'total_runs': total_runs_for_all_browsers_combined,
             }
         """
-        category = test_set.category
-        dirty = False
-        stats = {}
+        incomplete_rows = []
+        stats = cls.GetStatsMulti([(test_set, browsers, test_keys)],
+                                  use_memcache=use_memcache,
+                                  incomplete_rows=incomplete_rows)[0]
+        if incomplete_browsers is not None:
+            incomplete_browsers.extend(b for i, b in incomplete_rows)
+        return stats
+
+    @classmethod
+    def GetStatsMulti(cls, requests, use_memcache=True, incomplete_rows=None):
+        """Get the stats tables of several test sets at once.
+
+        The cached shards of every category are looked up first. Then the
+        rankers for all the missing rows and shards are fetched in one batch,
+        instead of browser by browser and category by category. Tables with
+        more than INCREMENTAL_SAVE_NUM_TESTS tests are built a row at a time
+        and each row is cached as it is done.
+
+        After a DeadlineExceededError, the rows done so far are cached and
+        the rows still missing are left out of the tables.
+
+        Args:
+            requests: a list of (test_set, browsers, test_keys) tuples
+            use_memcache: whether to use memcache or not
+            incomplete_rows: an optional list to which the (request index,
+                browser) of each row left out is appended
+        Returns:
+            a list of stats tables (see GetStats) in the order of requests
+        """
+        plans = []
+        for test_set, browsers, test_keys in requests:
+            shard_tests = cls.ShardTestKeys(test_set)
+            test_shards = cls.TestShards(shard_tests)
+            test_keys = [k for k in test_keys if k in test_shards]
+            needed_shards = [cls.SUMMARY_SHARD] + sorted(
+                    set(test_shards[k] for k in test_keys))
+            plans.append((test_set, browsers, test_keys, shard_tests,
+                          test_shards, needed_shards))
         if use_memcache:
-            memcache_params = cls.MemcacheParams(category)
-            stats = memcache.get_multi(browsers, **memcache_params)
-            #logging.info('result_stats.GetStats browsers=%s, stats(cache)=%s' %
-            #             (browsers, stats))
-        total_runs = 0
-        try:
+            all_shards = cls._GetShardsMulti([
+                    ([cls.ShardKey(b, s) for b in plan[1] for s in plan[5]],
+                     cls.MemcacheParams(plan[0].category))
+                    for plan in plans])
+        else:
+            all_shards = [{} for plan in plans]
+
+        # Find the rankers needed for the missing rows and shards. The rows
+        # of big tables are fetched one at a time so that each is cached
+        # as soon as it is done; the rest are fetched in one batch.
+        batch_fetches = []
+        plan_rows = []
+        for plan, shards in zip(plans, all_shards):
+            test_set, browsers, test_keys, shard_tests, test_shards, needed_shards = plan
+            is_big = len(test_keys) > cls.INCREMENTAL_SAVE_NUM_TESTS
+            rows = []
             for browser in browsers:
-                #logging.info('result_stats.GetStats for browser=%s' % browser)
-                if browser not in stats:
-                    dirty = True
-                    medians, num_scores = test_set.GetMediansAndNumScores(browser)
-                    stats[browser] = test_set.GetStats(test_keys, medians, num_scores)
-                    # Store memcache incrementally if we're working a *big* test.
-                    if len(test_keys) > 30:
-                        memcache.set_multi(stats, **memcache_params)
-                else:
+                missing_shards = [s for s in needed_shards
+                                  if cls.ShardKey(browser, s) not in shards]
+                if not missing_shards:
                     logging.info('result_stats.GetStats found it cached for browser=%s'
                                              % (browser))
+                    continue
+                if (cls.SUMMARY_SHARD in missing_shards or
+                        not test_set.independent_test_scores):
+                    tests = None
+                else:
+                    tests = [test_set.GetTest(k) for s in missing_shards
+                             for k in shard_tests[s]]
+                if is_big:
+                    rows.append((browser, missing_shards, tests, None))
+                else:
+                    rows.append((browser, missing_shards, tests,
+                                 len(batch_fetches)))
+                    batch_fetches.append((test_set, browser, tests))
+            plan_rows.append((is_big, rows))
+
+        stats_tables = []
+        batch_medians = None
+        is_deadline_exceeded = False
+        for plan, shards, (is_big, rows), index in zip(
+                plans, all_shards, plan_rows, range(len(plans))):
+            test_set, browsers, test_keys, shard_tests, test_shards, needed_shards = plan
+            memcache_params = cls.MemcacheParams(test_set.category)
+            dirty_shards = {}
+            try:
+                if is_deadline_exceeded or not rows:
+                    pass
+                elif is_big:
+                    for browser, missing_shards, tests, unused_index in rows:
+                        row_shards = cls._ComputeShards(
+                                test_set, shard_tests,
+                                [(browser, missing_shards, tests)],
+                                test_set_base.GetMediansAndNumScoresMulti(
+                                        [(test_set, browser, tests)]))
+                        dirty_shards.update(row_shards)
+                        # Store memcache incrementally for a *big* test.
+                        if use_memcache:
+                            memcache.set_multi(row_shards, **memcache_params)
+                else:
+                    if batch_medians is None:
+                        batch_medians = test_set_base.GetMediansAndNumScoresMulti(
+                                batch_fetches)
+                    dirty_shards = cls._ComputeShards(
+                            test_set, shard_tests,
+                            [row[:3] for row in rows],
+                            [batch_medians[row[3]] for row in rows])
+                    if use_memcache:
+                        logging.info('result_stats.GetStats saving all stats to memcache.')
+                        memcache.set_multi(dirty_shards, **memcache_params)
+            except DeadlineExceededError:
+                # Try to get what we got in memcache.
+                is_deadline_exceeded = True
+                if use_memcache:
+                    logging.info('DeadlineExceededError caught! Trying to memcahce %s' %
+                                             dirty_shards)
+                    memcache.set_multi(dirty_shards, **memcache_params)
+                    logging.info('Whew, made it.')
+            shards.update(dirty_shards)
+
+            stats = {}
+            total_runs = 0
+            for browser in browsers:
+                if [s for s in needed_shards
+                        if cls.ShardKey(browser, s) not in shards]:
+                    if incomplete_rows is not None:
+                        incomplete_rows.append((index, browser))
+                    continue
+                stats[browser] = cls._JoinRow(browser, shards, test_keys,
+                                              test_shards)
                 total_runs += stats[browser].get('total_runs', 0)
-        except DeadlineExceededError:
-            # Try to get what we got in memcache.
-            logging.info('DeadlineExceededError caught! Trying to memcahce %s' %
-                                     stats)
-            memcache.set_multi(stats, **memcache_params)
-            logging.info('Whew, made it.')
+            stats['total_runs'] = total_runs
+            stats_tables.append(stats)
+
+        return stats_tables
+
+    @classmethod
+    def _ComputeShards(cls, test_set, shard_tests, rows,
+                       medians_and_num_scores):
+        """Compute the missing shards of rows from their rankers.
+
+        Args:
+            test_set: a TestSet instance
+            shard_tests: {shard: [test_key, ...]} (see ShardTestKeys)
+            rows: a list of (browser, missing_shards, tests); tests is None
+                to compute the whole row.
+            medians_and_num_scores: a (medians, num_scores) for each row
+        Returns:
+            {shard_key: shard, ...}
+        """
+        dirty_shards = {}
+        full_rows = [(row[0], medians) for row, medians
+                     in zip(rows, medians_and_num_scores) if row[2] is None]
+        if full_rows:
+            visible_test_keys = [t.key for t in test_set.VisibleTests()]
+            medians_matrix = []
+            num_scores_matrix = []
+            for browser, (medians, num_scores) in full_rows:
+                medians_matrix.append([medians[t.key] for t in test_set.tests])
+                num_scores_matrix.append(
+                        [num_scores[t.key] for t in test_set.tests])
+            stats_matrix = test_set.GetStatsMatrix(
+                    visible_test_keys, medians_matrix, num_scores_matrix)
+            for (browser, unused_medians), row in zip(full_rows, stats_matrix):
+                dirty_shards.update(cls._SplitRow(browser, shard_tests, row))
+        for (browser, missing_shards, tests), (medians, num_scores) in zip(
+                rows, medians_and_num_scores):
+            if tests is None:
+                continue
+            results = test_set.GetStats(
+                    [t.key for t in tests], medians)['results']
+            for shard in missing_shards:
+                dirty_shards[cls.ShardKey(browser, shard)] = dict(
+                        (k, results[k]) for k in shard_tests[shard])
+        return dirty_shards
+
+    @classmethod
+    def _GetShardsMulti(cls, key_params):
+        """Look up cached shards of several categories.
 
-        stats['total_runs'] = total_runs
+        Args:
+            key_params: a list of (memcache keys, memcache params) tuples
+        Returns:
+            a list of dicts of cached shards in the order of key_params
+        """
+        if len(key_params) > 1 and hasattr(memcache.Client, 'get_multi_async'):
+            client = memcache.Client()
+            rpcs = [client.get_multi_async(keys, **params)
+                    for keys, params in key_params]
+            return [rpc.get_result() for rpc in rpcs]
+        return [memcache.get_multi(keys, **params) for keys, params in key_params]
 
-        if use_memcache and dirty:
-            logging.info('result_stats.GetStats saving all stats to memcache.')
-            memcache.set_multi(stats, **memcache_params)
+    @classmethod
+    def GetCachedStats(cls, test_set, browsers, test_keys=None):
+        """Return the rows that are fully cached.
 
+        Args:
+            test_set: a TestSet instance
+            browsers: a list of browsers like ['Firefox 3.6', 'IE 8.0']
+            test_keys: a list of test keys (defaults to the visible tests)
+        Returns:
+            {browser: row, ...}  (see GetStats for the row format)
+        """
+        shard_tests = cls.ShardTestKeys(test_set)
+        test_shards = cls.TestShards(shard_tests)
+        if test_keys is None:
+            test_keys = [t.key for t in test_set.VisibleTests()]
+        needed_shards = [cls.SUMMARY_SHARD] + sorted(
+                set(test_shards[k] for k in test_keys if k in test_shards))
+        shards = memcache.get_multi(
+                [cls.ShardKey(b, s) for b in browsers for s in needed_shards],
+                **cls.MemcacheParams(test_set.category))
+        stats = {}
+        for browser in browsers:
+            if [s for s in needed_shards
+                    if cls.ShardKey(browser, s) not in shards]:
+                continue
+            stats[browser] = cls._JoinRow(browser, shards, test_keys, test_shards)
         return stats
 
     @classmethod
@@ -490,7 +1085,7 @@ class CategoryStatsManager(object):
         Returns:
             a list of browsers without stats in memcache.
         """
-        stats = memcache.get_multi(browsers, **cls.MemcacheParams(category))
+        stats = cls.GetCachedStats(all_test_sets.GetTestSet(category), browsers)
         SummaryStatsManager.UpdateStats(category, stats)
         return [b for b in browsers if b not in stats]
 
@@ -509,26 +1104,94 @@ class CategoryStatsManager(object):
         """
         test_set = all_test_sets.GetTestSet(category)
         test_keys = [t.key for t in test_set.VisibleTests()]
-        ua_stats = {}
+        shard_tests = cls.ShardTestKeys(test_set)
+        handled_browsers = []
+        medians_matrix = []
+        num_scores_matrix = []
         unhandled_browsers = []
         is_timed_out = False
+        try:
+            browser_medians = test_set.GetMediansAndNumScoresMulti(browsers)
+        except db.Timeout:
+            # Fall back to one browser at a time to make some progress.
+            logging.info('Timed out \'%s\' in UpdateStatsCache doing '
+                         'GetMediansAndNumScoresMulti', category)
+            browser_medians = {}
+            for browser in browsers:
+                try:
+                    browser_medians[browser] = (
+                            test_set.GetMediansAndNumScores(browser))
+                except db.Timeout:
+                    is_timed_out = True
+                    break
         for browser in browsers:
-            try:
-                medians, num_scores = test_set.GetMediansAndNumScores(browser)
-            except db.Timeout:
-                is_timed_out = True
-            if is_timed_out:
+            if browser not in browser_medians:
                 logging.info('Timed out \'%s\' in UpdateStatsCache doing '
                                          'GetMediansAndNumScores for %s', category, browser)
                 unhandled_browsers.append(browser)
             else:
-                stats = test_set.GetStats(test_keys, medians, num_scores)
+                medians, num_scores = browser_medians[browser]
+                handled_browsers.append(browser)
+                medians_matrix.append([medians[t.key] for t in test_set.tests])
+                num_scores_matrix.append(
+                        [num_scores[t.key] for t in test_set.tests])
+        ua_stats = {}
+        ua_shards = {}
+        if handled_browsers:
+            stats_matrix = test_set.GetStatsMatrix(
+                    test_keys, medians_matrix, num_scores_matrix)
+            for browser, stats in zip(handled_browsers, stats_matrix):
                 ua_stats[browser] = stats
-        memcache.set_multi(ua_stats, **cls.MemcacheParams(category))
+                ua_shards.update(cls._SplitRow(browser, shard_tests, stats))
+        memcache.set_multi(ua_shards, **cls.MemcacheParams(category))
+        CategoryContentVersion.Bump(category)
         if not is_timed_out:
             SummaryStatsManager.UpdateStats(category, ua_stats)
         return unhandled_browsers
 
+    @classmethod
+    def ShardTestKeys(cls, test_set):
+        """Return {shard: [test_key, ...]} for the visible tests."""
+        test_keys = [t.key for t in test_set.VisibleTests()]
+        return dict(('t%d' % (i / cls.TESTS_PER_SHARD),
+                     test_keys[i:i + cls.TESTS_PER_SHARD])
+                    for i in range(0, len(test_keys), cls.TESTS_PER_SHARD))
+
+    @classmethod
+    def TestShards(cls, shard_tests):
+        """Invert ShardTestKeys to {test_key: shard}."""
+        return dict((k, shard) for shard, test_keys in shard_tests.items()
+                    for k in test_keys)
+
+    @classmethod
+    def ShardKey(cls, browser, shard):
+        return '%s|%s' % (browser, shard)
+
+    @classmethod
+    def _SplitRow(cls, browser, shard_tests, row):
+        """Split a stats row into {shard_key: shard_value}."""
+        results = row['results']
+        shards = {
+                cls.ShardKey(browser, cls.SUMMARY_SHARD): dict(
+                        (k, v) for k, v in row.items() if k != 'results'),
+                }
+        for shard, test_keys in shard_tests.items():
+            shards[cls.ShardKey(browser, shard)] = dict(
+                    (k, results[k]) for k in test_keys if k in results)
+        return shards
+
+    @classmethod
+    def _JoinRow(cls, browser, shards, test_keys, test_shards):
+        """Build a stats row for test_keys out of cached shards."""
+        row = dict(shards[cls.ShardKey(browser, cls.SUMMARY_SHARD)])
+        results = {}
+        for test_key in test_keys:
+            shard = shards[cls.ShardKey(browser, test_shards[test_key])]
+            if test_key in shard:
+                results[test_key] = shard[test_key]
+        row['results'] = results
+        return row
+
     @classmethod
     def MemcacheParams(cls, category):
         return {
@@ -537,11 +1200,73 @@ class CategoryStatsManager(object):
 
     @classmethod
     def DeleteMemcacheValues(cls, category, browsers):
-        memcache.delete_multi(browsers, **cls.MemcacheParams(category))
+        shards = [cls.SUMMARY_SHARD]
+        test_set = all_test_sets.GetTestSet(category)
+        if test_set:
+            shards.extend(cls.ShardTestKeys(test_set))
+        memcache.delete_multi([cls.ShardKey(b, s) for b in browsers for s in shards],
+                              **cls.MemcacheParams(category))
+        CategoryContentVersion.Bump(category)
+
+
+class CategoryContentVersion(object):
+    """Track when the stats of a category last changed.
+
+    Handlers turn the version into ETag/Last-Modified headers so that clients
+    polling an unchanged table get a 304 without touching rankers. A version
+    that falls out of memcache is simply restarted, which only costs one full
+    response per client.
+    """
+
+    MEMCACHE_NAMESPACE = 'category_content_version'
+
+    @classmethod
+    def Get(cls, category):
+        """Return the version (a timestamp in seconds) of a category."""
+        version = memcache.get(category, namespace=cls.MEMCACHE_NAMESPACE)
+        if version is None:
+            version = cls.Bump(category)
+        return version
+
+    @classmethod
+    def Bump(cls, category):
+        """Mark a category, and the summary built from it, as changed."""
+        version = time.time()
+        memcache.set_multi(dict.fromkeys((category, 'summary'), version),
+                           namespace=cls.MEMCACHE_NAMESPACE)
+        return version
 
 
 def UpdateCategory(category, user_agent):
     logging.info('result.stats.UpdateCategory for %s, %s', category,
                              user_agent.pretty())
     CategoryBrowserManager.AddUserAgent(category, user_agent)
+    StatsRefreshLog.AddUserAgent(category, user_agent)
+    if category in settings.STATIC_CATEGORIES:
+        StaticDeltaLog.AddUserAgent(category, user_agent)
     CategoryStatsManager.UpdateStatsCache(category, user_agent.get_string_list())
+
+
+def UpdateCategories(category_user_agents):
+    """Like UpdateCategory for many (category, user_agent) pairs at once.
+
+    Browser lists are updated in one batch and the stats cache of each
+    category is refreshed once for all of its new browser strings.
+
+    Args:
+        category_user_agents: a list of (category, UserAgent instance) tuples
+    """
+    logging.info('result.stats.UpdateCategories for %s user agents',
+                             len(category_user_agents))
+    CategoryBrowserManager.AddUserAgents(category_user_agents)
+    category_browsers = {}
+    for category, user_agent in category_user_agents:
+        StatsRefreshLog.AddUserAgent(category, user_agent)
+        if category in settings.STATIC_CATEGORIES:
+            StaticDeltaLog.AddUserAgent(category, user_agent)
+        browsers = category_browsers.setdefault(category, [])
+        for browser in user_agent.get_string_list():
+            if browser not in browsers:
+                browsers.append(browser)
+    for category, browsers in category_browsers.items():
+        CategoryStatsManager.UpdateStatsCache(category, browsers)
@@ -70,6 +70,30 @@ class UserAgent(db.Expando):
   confirmed = db.BooleanProperty(default=False)
   created = db.DateTimeProperty(auto_now_add=True)
 
+  def __init__(self, *args, **kwds):
+    super(UserAgent, self).__init__(*args, **kwds)
+    self._saved_parts = self.parts()
+
+  def parts(self):
+    return self.family, self.v1, self.v2, self.v3
+
+  def put(self, **kwds):
+    """Save, logging the change if a saved user agent's parts changed.
+
+    ResultParents copy get_string_list() (user_agent_string_list), so a
+    change is logged in UserAgentChangeLog for them to be updated. Batch
+    db.put calls bypass this.
+    """
+    saved_parts = getattr(self, '_saved_parts', self.parts())  # unpickled
+    is_changed = self.is_saved() and saved_parts != self.parts()
+    key = super(UserAgent, self).put(**kwds)
+    self._saved_parts = self.parts()
+    if is_changed:
+      UserAgentChangeLog.AddUserAgent(self)
+    return key
+
+  save = put
+
   def pretty(self):
     """Invokes pretty print."""
     return self.pretty_print(self.family, self.v1, self.v2, self.v3)
@@ -193,3 +217,36 @@ class UserAgent(db.Expando):
   def parse_to_string_list(cls, pretty_string):
     """Parse a pretty string into string list."""
     return cls.parts_to_string_list(*cls.parse_pretty(pretty_string))
+
+
+class UserAgentChangeLog(db.Model):
+  """A user agent whose string list changed after it was saved.
+
+  Entries are removed once base.admin.UpdateUserAgentStringLists has updated
+  the ResultParents of the user agent.
+
+  key_name: str(user_agent.key())
+  """
+  created = db.DateTimeProperty(auto_now_add=True)
+
+  @classmethod
+  def AddUserAgent(cls, user_agent):
+    cls(key_name=str(user_agent.key())).put()
+
+  def GetUserAgentKey(self):
+    return db.Key(self.key().name())
+
+  def DeleteIfUnchanged(self):
+    """Delete the entry unless the user agent was logged again since.
+
+    Returns:
+      True if the entry was deleted.
+    """
+    return db.run_in_transaction(self._DeleteIfUnchangedInTransaction)
+
+  def _DeleteIfUnchangedInTransaction(self):
+    change_log = db.get(self.key())
+    if change_log is None or change_log.created != self.created:
+      return False
+    change_log.delete()
+    return True
@@ -54,6 +54,8 @@ class User(db.Model):
 
 
 class TestSet(test_set_base.TestSet):
+  independent_test_scores = True
+
   def GetTestScoreAndDisplayValue(self, test_key, raw_scores):
     """Get a normalized score (0 to 100) and a value to output to the display.
 
@@ -69,6 +69,8 @@ class MockTest(test_set_base.TestBase):
 
 
 class MockTestSet(test_set_base.TestSet):
+  independent_test_scores = True
+
   def __init__(self, category='mockTestSet', params=None):
     tests = (
         MockTest('apple', min_value=0, max_value=1),
@@ -28,13 +28,17 @@ import settings
 
 from django.test.client import Client
 from django.utils import simplejson
+from google.appengine.api import datastore
 from google.appengine.api import memcache
 from google.appengine.ext import db
 from categories import all_test_sets
 from models import result_stats
+import models.user_test
 from models.result import ResultParent
+from models.result import ResultParentDirty
 from models.result import ResultTime
 from models.user_agent import UserAgent
+from models.user_agent import UserAgentChangeLog
 from third_party import mox
 
 from base import admin
@@ -118,6 +122,30 @@ class TestDataDump(unittest.TestCase):
     response_params = simplejson.loads(response.content)
     self.assertEqual(20, len(response_params['data'])) # 5 parents + 15 times
 
+  def testDumpCompact(self):
+    result = ResultParent.AddResult(
+        self.test_set, '1.2.2.5', mock_data.GetUserAgentString('Firefox 3.5'),
+        'apple=1,banana=2,coconut=3')
+    params = {
+        'model': 'ResultParent',
+        'keys': '%s,agt1YS1wcm9maWxlcnIRCxIJVXNlckFnZW50GN6JIgw' % result.key(),
+        'format': 'compact',
+        }
+    response = self.client.get('/admin/data_dump', params)
+    self.assertEqual(200, response.status_code)
+    response_params = simplejson.loads(response.content)
+    self.assertEqual(['result_time_key', 'result_parent_key', 'test', 'score'],
+                     response_params['columns']['ResultTime'])
+    data = response_params['data']
+    self.assertEqual(5, len(data))  # 1 parent + 3 times + 1 lost
+    self.assertEqual(['ResultParent', str(result.key()), 'mockTestSet'],
+                     data[0][:3])
+    self.assertEqual(
+        [('apple', 1), ('banana', 2), ('coconut', 3)],
+        sorted((row[3], row[4]) for row in data[1:4]))
+    self.assertEqual('agt1YS1wcm9maWxlcnIRCxIJVXNlckFnZW50GN6JIgw',
+                     data[4]['lost_key'])
+
 
 class TestDataDumpKeys(unittest.TestCase):
 
@@ -266,8 +294,7 @@ class TestUpdateStatsCache(unittest.TestCase):
 
   def testBasic(self):
     self.mox.StubOutWithMock(self.manager, 'UpdateStatsCache')
-    self.manager.UpdateStatsCache('network', ['IE']).InAnyOrder()
-    self.manager.UpdateStatsCache('network', ['Firefox']).InAnyOrder()
+    self.manager.UpdateStatsCache('network', ['IE', 'Firefox']).AndReturn([])
     params = {
         'category': 'network',
         'browsers': 'IE,Firefox',
@@ -278,6 +305,28 @@ class TestUpdateStatsCache(unittest.TestCase):
     self.assertEqual('Success.', response.content)
     self.assertEqual(200, response.status_code)
 
+  def testOverBudgetQueuesTheRest(self):
+    self.mox.StubOutWithMock(self.manager, 'UpdateStatsCache')
+    self.manager.UpdateStatsCache('network', ['IE']).InAnyOrder().AndReturn([])
+    self.manager.UpdateStatsCache('network', ['Firefox']).InAnyOrder(
+        ).AndReturn([])
+    params = {
+        'category': 'network',
+        'browsers': 'IE,Firefox',
+        }
+    admin.UPDATE_STATS_CACHE_CHUNK_SIZE, old_chunk_size = (
+        1, admin.UPDATE_STATS_CACHE_CHUNK_SIZE)
+    admin.UPDATE_STATS_CACHE_TIME_BUDGET, old_time_budget = (
+        -1, admin.UPDATE_STATS_CACHE_TIME_BUDGET)
+    try:
+      self.mox.ReplayAll()
+      response = self.client.get('/admin/update_stats_cache', params)
+      self.mox.VerifyAll()
+    finally:
+      admin.UPDATE_STATS_CACHE_CHUNK_SIZE = old_chunk_size
+      admin.UPDATE_STATS_CACHE_TIME_BUDGET = old_time_budget
+    self.assertEqual('Success.', response.content)
+
 
 class TestUpdateAllUncachedStats(unittest.TestCase):
 
@@ -322,8 +371,8 @@ class TestUpdateAllUncachedStats(unittest.TestCase):
         }
     self.assertEqual(
         expected_stats,
-        memcache.get('Firefox',
-                     **result_stats.CategoryStatsManager.MemcacheParams('foo')))
+        result_stats.CategoryStatsManager.GetCachedStats(
+            self.test_set_1, ['Firefox'])['Firefox'])
 
 
 class TestUpdateAllStatsCache(unittest.TestCase):
@@ -369,5 +418,141 @@ class TestUpdateAllStatsCache(unittest.TestCase):
         }
     self.assertEqual(
         expected_stats,
-        memcache.get('Firefox',
-                     **result_stats.CategoryStatsManager.MemcacheParams('foo')))
+        result_stats.CategoryStatsManager.GetCachedStats(
+            self.test_set_1, ['Firefox'])['Firefox'])
+
+  def testUpdateChangedStatsCache(self):
+    ResultParent.AddResult(
+        self.test_set_1, '1.2.2.5', mock_data.GetUserAgentString('IE 7.0'),
+        'apple=1,banana=1,coconut=1')
+    result_stats.StatsRefreshLog.AddUserAgent(
+        'foo', mock_data.GetUserAgent('IE 7.0'))
+    self.assertTrue(
+        'IE 7.0' in result_stats.StatsRefreshLog.GetBrowsers('foo', 3))
+    memcache.flush_all()
+    params = {'categories': 'foo', 'changed': 1}
+    response = self.client.get('/admin/update_all_stats_cache', params)
+    self.assertEqual(200, response.status_code)
+    self.assertEqual([], result_stats.StatsRefreshLog.GetBrowsers('foo', 3))
+    self.assertEqual(
+        ['IE 7.0'],
+        result_stats.CategoryStatsManager.GetCachedStats(
+            self.test_set_1, ['IE 7.0']).keys())
+
+
+class TestUpdateUserAgentStringLists(unittest.TestCase):
+  def setUp(self):
+    self.test_set = mock_data.MockTestSet()
+    all_test_sets.AddTestSet(self.test_set)
+    self.client = Client()
+    memcache.flush_all()
+
+  def tearDown(self):
+    all_test_sets.RemoveTestSet(self.test_set)
+
+  def testChangedUserAgentUpdatesParents(self):
+    parents = [ResultParent.AddResult(
+        self.test_set, '1.2.2.5', mock_data.GetUserAgentString('Firefox 3.5'),
+        'apple=1,banana=2,coconut=3') for i in range(3)]
+    user_agent = parents[0].user_agent
+    self.assertEqual([], UserAgentChangeLog.all().fetch(10))
+    user_agent.family = 'Firefox Beta'
+    user_agent.put()
+    self.assertEqual([user_agent.key()],
+                     [c.GetUserAgentKey() for c in UserAgentChangeLog.all()])
+    response = self.client.get('/admin/update_ua_string_lists')
+    self.assertEqual(200, response.status_code)
+    self.assertEqual('Updated 1 user agents.', response.content)
+    self.assertEqual([], UserAgentChangeLog.all().fetch(10))
+    for parent in db.get([p.key() for p in parents]):
+      self.assertEqual(['Firefox Beta', 'Firefox Beta 3', 'Firefox Beta 3.5'],
+                       parent.user_agent_string_list)
+
+  def testOnlyOneChainRuns(self):
+    user_agent = mock_data.GetUserAgent('Firefox 3.5')
+    UserAgentChangeLog.AddUserAgent(user_agent)
+    memcache.set(admin.UPDATE_UA_STRING_LISTS_LEASE_KEY, 'other')
+    response = self.client.get('/admin/update_ua_string_lists')
+    self.assertEqual('Already running.', response.content)
+    response = self.client.get('/admin/update_ua_string_lists',
+                               {'chain': 'mine'})
+    self.assertEqual('Replaced by another chain.', response.content)
+    self.assertEqual(1, len(UserAgentChangeLog.all().fetch(10)))
+    response = self.client.get('/admin/update_ua_string_lists',
+                               {'chain': 'other'})
+    self.assertEqual('Updated 1 user agents.', response.content)
+    self.assertEqual(None,
+                     memcache.get(admin.UPDATE_UA_STRING_LISTS_LEASE_KEY))
+
+  def testChangeLogAddedAgainIsKept(self):
+    user_agent = mock_data.GetUserAgent('Firefox 3.5')
+    UserAgentChangeLog.AddUserAgent(user_agent)
+    change_log = UserAgentChangeLog.all().get()
+    UserAgentChangeLog.AddUserAgent(user_agent)
+    self.assertFalse(change_log.DeleteIfUnchanged())
+    change_log = UserAgentChangeLog.all().get()
+    self.assertTrue(change_log.DeleteIfUnchanged())
+    self.assertEqual([], UserAgentChangeLog.all().fetch(10))
+
+
+class TestMigrateDirtyResultTimes(unittest.TestCase):
+  def setUp(self):
+    self.test_set = mock_data.MockTestSet()
+    all_test_sets.AddTestSet(self.test_set)
+    self.client = Client()
+
+  def tearDown(self):
+    all_test_sets.RemoveTestSet(self.test_set)
+
+  def AddOldStyleDirtyResult(self):
+    """Add a dirty result the way it was saved before ResultParentDirty."""
+    parent = ResultParent.AddResult(
+        self.test_set, '1.2.2.5', mock_data.GetUserAgentString('Firefox 3.5'),
+        'apple=1,banana=2,coconut=3', skip_dirty_update=True)
+    db.delete(ResultParentDirty.KeyFor(parent.key()))
+    entities = datastore.Get([t.key() for t in parent.GetResultTimes()])
+    for entity in entities:
+      entity.set_unindexed_properties(())
+    datastore.Put(entities)
+    return parent
+
+  def testMigrateDirtyResultTimes(self):
+    parent = self.AddOldStyleDirtyResult()
+    response = self.client.get('/admin/migrate_dirty_result_times')
+    self.assertEqual(200, response.status_code)
+    self.assertEqual('Checked 3 dirty result times.', response.content)
+    marker = ResultParentDirty.get(ResultParentDirty.KeyFor(parent.key()))
+    self.assertEqual(self.test_set.category, marker.category)
+    self.assertEqual(parent.created, marker.created)
+    self.assertEqual(sorted(t.key() for t in parent.GetResultTimes()),
+                     sorted(marker.pending))
+
+
+class TestArchiveResultsUserTests(unittest.TestCase):
+  def setUp(self):
+    user = models.user_test.User.get_or_insert('archive_tester')
+    self.tests = []
+    for i in range(3):
+      test = models.user_test.Test(user=user, name='Test %s' % i,
+                                   url='http://fakeurl.com/test.html')
+      test.put()
+      self.tests.append(test)
+    self.tests.sort(key=lambda t: t.key())
+
+  def tearDown(self):
+    db.delete(self.tests)
+
+  def testNextUserTestCategories(self):
+    old_batch_size = admin.ARCHIVE_USER_TESTS_BATCH_SIZE
+    admin.ARCHIVE_USER_TESTS_BATCH_SIZE = 2
+    try:
+      categories, user_test_key = admin.NextUserTestCategories()
+      self.assertEqual([t.get_memcache_keyname() for t in self.tests[:2]],
+                       categories)
+      self.assertEqual(str(self.tests[1].key()), user_test_key)
+      categories, user_test_key = admin.NextUserTestCategories(user_test_key)
+      self.assertEqual([self.tests[2].get_memcache_keyname()], categories)
+      self.assertEqual(None, user_test_key)
+    finally:
+      admin.ARCHIVE_USER_TESTS_BATCH_SIZE = old_batch_size
+
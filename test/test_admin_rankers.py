@@ -32,6 +32,7 @@ from google.appengine.api import datastore_types
 from google.appengine.ext import db
 
 from categories import all_test_sets
+from models import ranker_upload
 from models import result_ranker
 from third_party import mox
 
@@ -170,3 +171,127 @@ class TestUploadRankers(unittest.TestCase):
     self.mox.VerifyAll()
     self.assertEqual('{}', response.content)
     self.assertEqual(200, response.status_code)
+
+
+class TestUploadPackedRankers(unittest.TestCase):
+  """Test uploading packed rankers"""
+
+  def setUp(self):
+    self.test_set = mock_data.MockTestSet()
+    all_test_sets.AddTestSet(self.test_set)
+
+    self.mox = mox.Mox()
+    self.mox.StubOutWithMock(result_ranker, 'GetRankers')
+    self.mox.StubOutWithMock(result_ranker, 'NewRanker')
+    self.mox.StubOutWithMock(result_ranker.RankerCacher, 'CachePutMulti')
+    self.apple_test = self.test_set.GetTest('apple')
+    self.banana_test = self.test_set.GetTest('banana')
+    self.coconut_test = self.test_set.GetTest('coconut')
+    self.apple_ranker = self.mox.CreateMock(result_ranker.CountRanker)
+    self.banana_ranker = self.mox.CreateMock(result_ranker.CountRanker)
+    self.coconut_ranker = self.mox.CreateMock(result_ranker.LastNRanker)
+
+    self.client = Client()
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    all_test_sets.RemoveTestSet(self.test_set)
+
+  def testPackUnpack(self):
+    payload = ranker_upload.PackRankers([
+        ('apple', u'Firefox 3.0', [2, 3], 5),
+        ('coconut', u'Opera 10\u00e9', [101, 99, 2 ** 40], 7),
+        ])
+    records = ranker_upload.UnpackRankers(payload)
+    self.assertEqual(
+        [('apple', u'Firefox 3.0', 5,
+          ranker_upload.ValuesChecksum([2, 3], 5)),
+         ('coconut', u'Opera 10\u00e9', 7,
+          ranker_upload.ValuesChecksum([101, 99, 2 ** 40], 7))],
+        [r[:4] for r in records])
+    self.assertEqual([101, 99, 2 ** 40],
+                     ranker_upload.UnpackValues(records[1][4]))
+
+  def testSkipUnchangedAndPutOnce(self):
+    payload = ranker_upload.PackRankers([
+        ('apple', 'Firefox 3.0', [2, 3], 5),
+        ('banana', 'Firefox 3.0', [0, 4], 4),
+        ('coconut', 'Firefox 3.0', [101, 99], 7),
+        ])
+    test_browsers = [
+        (self.apple_test, u'Firefox 3.0'),
+        (self.banana_test, u'Firefox 3.0'),
+        (self.coconut_test, u'Firefox 3.0'),
+        ]
+    result_ranker.GetRankers(test_browsers, None).AndReturn(
+        [self.apple_ranker, self.banana_ranker, None])
+    self.apple_ranker.GetChecksum().AndReturn(
+        ranker_upload.ValuesChecksum([2, 3], 5))
+    self.banana_ranker.GetChecksum().AndReturn(
+        ranker_upload.ValuesChecksum([1, 3], 4))
+    self.banana_ranker.SetValues([0, 4], 4, cache_put=False)
+    result_ranker.NewRanker(self.coconut_test, u'Firefox 3.0', None).AndReturn(
+        self.coconut_ranker)
+    self.coconut_ranker.SetValues([101, 99], 7, cache_put=False)
+    result_ranker.RankerCacher.CachePutMulti(
+        [self.banana_ranker, self.coconut_ranker])
+    self.mox.ReplayAll()
+    response = self.client.post(
+        '/admin/rankers/upload_packed?category=%s' % self.test_set.category,
+        payload, content_type='application/octet-stream')
+    self.mox.VerifyAll()
+    self.assertEqual({'num_changed': 2, 'num_done': 3},
+                     simplejson.loads(response.content))
+    self.assertEqual(200, response.status_code)
+
+  def testUnknownCategory(self):
+    self.mox.ReplayAll()
+    response = self.client.post(
+        '/admin/rankers/upload_packed?category=nonexistent',
+        ranker_upload.PackRankers([('apple', 'Firefox 3.0', [2, 3], 5)]),
+        content_type='application/octet-stream')
+    self.mox.VerifyAll()
+    self.assertEqual(500, response.status_code)
+    self.assertTrue('Unknown category' in response.content)
+
+  def testSkipUnknownTest(self):
+    payload = ranker_upload.PackRankers([
+        ('durian', 'Firefox 3.0', [1, 1], 2),
+        ('apple', 'Firefox 3.0', [2, 3], 5),
+        ])
+    result_ranker.GetRankers([(self.apple_test, u'Firefox 3.0')], None
+                             ).AndReturn([self.apple_ranker])
+    self.apple_ranker.GetChecksum().AndReturn(
+        ranker_upload.ValuesChecksum([2, 3], 5))
+    result_ranker.RankerCacher.CachePutMulti([])
+    self.mox.ReplayAll()
+    response = self.client.post(
+        '/admin/rankers/upload_packed?category=%s' % self.test_set.category,
+        payload, content_type='application/octet-stream')
+    self.mox.VerifyAll()
+    self.assertEqual({'num_changed': 0, 'num_done': 2},
+                     simplejson.loads(response.content))
+
+  def testStopAtTimeLimit(self):
+    payload = ranker_upload.PackRankers([
+        ('apple', 'Firefox 3.0', [2, 3], 5),
+        ('banana', 'Firefox 3.0', [0, 4], 4),
+        ])
+    test_browsers = [
+        (self.apple_test, u'Firefox 3.0'),
+        (self.banana_test, u'Firefox 3.0'),
+        ]
+    result_ranker.GetRankers(test_browsers, None).AndReturn(
+        [self.apple_ranker, self.banana_ranker])
+    self.apple_ranker.GetChecksum().AndReturn(
+        ranker_upload.ValuesChecksum([1, 3], 5))
+    self.apple_ranker.SetValues([2, 3], 5, cache_put=False)
+    result_ranker.RankerCacher.CachePutMulti([self.apple_ranker])
+    self.mox.ReplayAll()
+    response = self.client.post(
+        '/admin/rankers/upload_packed?category=%s&time_limit=-1' %
+        self.test_set.category,
+        payload, content_type='application/octet-stream')
+    self.mox.VerifyAll()
+    self.assertEqual({'num_changed': 1, 'num_done': 1},
+                     simplejson.loads(response.content))
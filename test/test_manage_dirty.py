@@ -18,9 +18,11 @@
 
 __author__ = 'elsigh@google.com (Lindsey Simon)'
 
+import datetime
 import logging
 import unittest
 
+from google.appengine.api import memcache
 from google.appengine.ext import db
 from django.test.client import Client
 
@@ -29,6 +31,7 @@ from base import manage_dirty
 from categories import all_test_sets
 from models import result_ranker
 from models.result import ResultParent
+from models.result import ResultParentDirty
 from models.result import ResultTime
 from models.user_agent import UserAgent
 from third_party import mox
@@ -63,6 +66,30 @@ class TestManageDirty(unittest.TestCase):
     self.mox.VerifyAll()
     self.assertEqual([False, False, False],
                      [x.dirty for x in result_parent.GetResultTimes()])
+    self.assertEqual(
+        None, ResultParentDirty.get(
+            ResultParentDirty.KeyFor(result_parent.key())))
+
+  def testAddResultCreatesDirtyMarker(self):
+    ua_string = ('Mozilla/5.0 (X11; U; Linux i686; en-US; rv:1.9.0.6) '
+                 'Gecko/2009011912 Firefox/3.0.6')
+    result_parent = ResultParent.AddResult(
+        self.test_set, '12.2.2.11', ua_string, 'apple=0,banana=99,coconut=101',
+        skip_dirty_update=True)
+    result_time_keys = [rt.key() for rt in result_parent.GetResultTimes()]
+    marker = ResultParentDirty.get(
+        ResultParentDirty.KeyFor(result_parent.key()))
+    self.assertEqual(self.CATEGORY, marker.category)
+    self.assertEqual(sorted(result_time_keys), sorted(marker.pending))
+    for i, result_time_key in enumerate(marker.pending):
+      next_key = ResultParentDirty.UpdatePending(
+          result_parent.key(), result_time_key)
+      if i < 2:
+        self.assertNotEqual(None, next_key)
+    self.assertEqual(None, next_key)
+    self.assertEqual(
+        None, ResultParentDirty.get(
+            ResultParentDirty.KeyFor(result_parent.key())))
 
   def xxxNOT_WORKING_YETxxxtestUpdateDirtyWithResultTimeKey(self):
     ua_string = ('Mozilla/5.0 (X11; U; Linux i686; en-US; rv:1.9.0.6) '
@@ -88,6 +115,81 @@ class TestManageDirty(unittest.TestCase):
                                **mock_data.UNIT_TEST_UA)
     self.mox.VerifyAll()
 
+  def testUpdateOldDirty(self):
+    ua_string = ('Mozilla/5.0 (X11; U; Linux i686; en-US; rv:1.9.0.6) '
+                 'Gecko/2009011912 Firefox/3.0.6')
+    old_parent, young_parent = [ResultParent.AddResult(
+        self.test_set, '12.2.2.11', ua_string, 'apple=0,banana=99,coconut=101',
+        skip_dirty_update=True) for i in range(2)]
+    old_marker = ResultParentDirty.get(
+        ResultParentDirty.KeyFor(old_parent.key()))
+    old_marker.created -= datetime.timedelta(
+        seconds=manage_dirty.OLD_SECONDS + 1)
+    old_marker.put()
+    memcache.delete('last_key', namespace=manage_dirty.OLD_DIRTY_MEMCACHE_NS)
+
+    self.mox.StubOutWithMock(manage_dirty, 'AddTasks')
+    def CheckTasks(tasks):
+      self.assertEqual(1, len(tasks))
+      self.assertTrue(
+          tasks[0].url.endswith('/-1/%s' % old_marker.pending[0]))
+      return True
+    manage_dirty.AddTasks(mox.Func(CheckTasks), 'update-dirty')
+    self.mox.ReplayAll()
+    self.assertEqual(1, manage_dirty.UpdateOldDirty())
+    self.mox.VerifyAll()
+    self.assertEqual(
+        None,
+        memcache.get('last_key', namespace=manage_dirty.OLD_DIRTY_MEMCACHE_NS))
+
+  def testUpdateOldDirtyResumesAfterLastKey(self):
+    ua_string = ('Mozilla/5.0 (X11; U; Linux i686; en-US; rv:1.9.0.6) '
+                 'Gecko/2009011912 Firefox/3.0.6')
+    for i in range(3):
+      ResultParent.AddResult(
+          self.test_set, '12.2.2.11', ua_string,
+          'apple=0,banana=99,coconut=101', skip_dirty_update=True)
+    memcache.delete('last_key', namespace=manage_dirty.OLD_DIRTY_MEMCACHE_NS)
+    marker_keys = ResultParentDirty.all(keys_only=True).order('__key__').fetch(3)
+    self.mox.StubOutWithMock(manage_dirty, 'AddTasks')
+    manage_dirty.AddTasks([], 'update-dirty')
+    manage_dirty.AddTasks([], 'update-dirty')
+    self.mox.ReplayAll()
+    max_result_times = manage_dirty.MAX_RESULT_TIMES
+    manage_dirty.MAX_RESULT_TIMES = 2
+    try:
+      manage_dirty.UpdateOldDirty()
+      self.assertEqual(
+          str(marker_keys[1]),
+          memcache.get('last_key', namespace=manage_dirty.OLD_DIRTY_MEMCACHE_NS))
+      manage_dirty.UpdateOldDirty()
+    finally:
+      manage_dirty.MAX_RESULT_TIMES = max_result_times
+    self.mox.VerifyAll()
+    # The second call reached the end of the kind, so the next one restarts.
+    self.assertEqual(
+        None,
+        memcache.get('last_key', namespace=manage_dirty.OLD_DIRTY_MEMCACHE_NS))
+
+  def testUpdateOldDirtySkipsChainInFlight(self):
+    ua_string = ('Mozilla/5.0 (X11; U; Linux i686; en-US; rv:1.9.0.6) '
+                 'Gecko/2009011912 Firefox/3.0.6')
+    parent = ResultParent.AddResult(
+        self.test_set, '12.2.2.11', ua_string, 'apple=0,banana=99,coconut=101',
+        skip_dirty_update=True)
+    marker = ResultParentDirty.get(ResultParentDirty.KeyFor(parent.key()))
+    marker.created -= datetime.timedelta(seconds=manage_dirty.OLD_SECONDS + 1)
+    marker.put()
+    memcache.delete('last_key', namespace=manage_dirty.OLD_DIRTY_MEMCACHE_NS)
+    self.mox.StubOutWithMock(manage_dirty, 'AddTasks')
+    manage_dirty.AddTasks(mox.Func(lambda tasks: len(tasks) == 1),
+                          'update-dirty')
+    manage_dirty.AddTasks([], 'update-dirty')
+    self.mox.ReplayAll()
+    self.assertEqual(1, manage_dirty.UpdateOldDirty())
+    # The first sweep leased the parent; the next one leaves it alone.
+    self.assertEqual(0, manage_dirty.UpdateOldDirty())
+    self.mox.VerifyAll()
 
 # TODO: Add more tests
 #   * Call UpdateDirty with result_time_key
@@ -0,0 +1,85 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License')
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Test models.mapper."""
+
+__author__ = 'slamm@google.com (Stephen Lamm)'
+
+import unittest
+
+from google.appengine.ext import db
+
+from models import mapper
+
+
+class MapperTestEntity(db.Model):
+  value = db.IntegerProperty(default=0)
+  group = db.StringProperty()
+
+
+class DoubleMapper(mapper.Mapper):
+  KIND = MapperTestEntity
+  FILTERS = [('group', 'a')]
+
+  def map(self, entity):
+    if entity.value == 13:
+      return [], [entity]
+    entity.value *= 2
+    return [entity], []
+
+
+class TestMapper(unittest.TestCase):
+
+  def setUp(self):
+    db.delete(MapperTestEntity.all(keys_only=True).fetch(1000))
+    self.keys = db.put([MapperTestEntity(value=i, group='a')
+                        for i in range(20)])
+    db.put(MapperTestEntity(value=100, group='b'))
+
+  def tearDown(self):
+    db.delete(MapperTestEntity.all(keys_only=True).fetch(1000))
+    db.delete(mapper.MapperShardState.all(keys_only=True).fetch(1000))
+
+  def Values(self):
+    return [e.value for e in MapperTestEntity.all().order('__key__')]
+
+  def testRun(self):
+    self.assertEqual(20, DoubleMapper().run(batch_size=3))
+    expected_values = [i * 2 for i in range(20) if i != 13] + [100]
+    self.assertEqual(expected_values, self.Values())
+
+  def testSplitKeyRanges(self):
+    key_ranges = DoubleMapper().split_key_ranges(4)
+    self.assertEqual(4, len(key_ranges))
+    self.assertEqual(None, key_ranges[0][0])
+    self.assertEqual(None, key_ranges[-1][1])
+    for (start_key, end_key), (next_start_key, next_end_key) in zip(
+        key_ranges, key_ranges[1:]):
+      self.assertEqual(end_key, next_start_key)
+    num_keys = 0
+    for start_key, end_key in key_ranges:
+      num_keys += len(DoubleMapper().get_query(start_key, end_key).fetch(100))
+    self.assertEqual(20, num_keys)
+
+  def testResume(self):
+    shard_state = mapper.MapperShardState(
+        key_name=mapper.MapperShardState.KeyName('double', 0),
+        last_key=str(self.keys[9]))
+    shard_state.put()
+    self.assertEqual(10, DoubleMapper().run(batch_size=4, name='double'))
+    expected_values = range(10) + [i * 2 for i in range(10, 20) if i != 13]
+    self.assertEqual(expected_values + [100], self.Values())
+    self.assertEqual([None], mapper.MapperShardState.GetShards('double', 1))
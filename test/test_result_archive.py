@@ -0,0 +1,186 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License')
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Test models.result_archive."""
+
+__author__ = 'slamm@google.com (Stephen Lamm)'
+
+import datetime
+import unittest
+
+from google.appengine.ext import db
+
+from categories import all_test_sets
+from models import result_archive
+from models.result import ResultParent
+from models.result import ResultParentDirty
+from models.result import ResultTime
+
+import mock_data
+
+
+class TestResultArchive(unittest.TestCase):
+
+  CATEGORY = 'test_result_archive'
+
+  def setUp(self):
+    self.test_set = mock_data.MockTestSet(self.CATEGORY)
+    all_test_sets.AddTestSet(self.test_set)
+
+  def tearDown(self):
+    all_test_sets.RemoveTestSet(self.test_set)
+    db.delete(result_archive.ResultArchive.all(keys_only=True).fetch(1000))
+
+  def AddResult(self, month, day, browser='Firefox 3.5', is_dirty=False):
+    result_parent = ResultParent.AddResult(
+        self.test_set, '12.2.2.11', mock_data.GetUserAgentString(browser),
+        'apple=1,banana=%d,coconut=3' % day, skip_dirty_update=True)
+    result_parent.created = datetime.datetime(2009, month, day, 12, 30, 15, 7)
+    result_parent.put()
+    if not is_dirty:
+      db.delete(ResultParentDirty.KeyFor(result_parent.key()))
+      result_times = result_parent.GetResultTimes()
+      for result_time in result_times:
+        result_time.dirty = False
+      db.put(result_times)
+    return result_parent
+
+  def testArchiveResults(self):
+    old_parents = [self.AddResult(8, 10), self.AddResult(9, 9),
+                   self.AddResult(9, 14)]
+    dirty_parent = self.AddResult(9, 19, is_dirty=True)
+    young_parent = self.AddResult(10, 18)
+    old_results = [p.GetResults() for p in old_parents]
+    before = datetime.datetime(2009, 10, 1)
+
+    num_archived, after = result_archive.ArchiveResults(
+        self.CATEGORY, before)
+    self.assertEqual(3, num_archived)
+    self.assertEqual((dirty_parent.created, dirty_parent.key()), after)
+    self.assertEqual((0, None), result_archive.ArchiveResults(
+        self.CATEGORY, before, after))
+
+    self.assertEqual([None, None, None],
+                     ResultParent.get([p.key() for p in old_parents]))
+    self.assertEqual(
+        None, ResultTime.all().ancestor(old_parents[0].key()).get())
+    archives = result_archive.ArchiveQuery(self.CATEGORY).order('__key__')
+    self.assertEqual([1, 2], [a.num_results for a in archives])
+
+    results = list(result_archive.IterResults(self.CATEGORY))
+    self.assertEqual(
+        [p.key() for p in old_parents + [dirty_parent, young_parent]],
+        [r.key() for r in results])
+    self.assertEqual(old_results, [r.GetResults() for r in results[:3]])
+    self.assertEqual(old_parents[0].created, results[0].created)
+    self.assertEqual(old_parents[0].user_agent.key(),
+                     results[0].user_agent.key())
+
+  def testArchiveResultsSkipsDirtyResultTimesWithoutMarker(self):
+    parent = self.AddResult(9, 1)
+    result_time = parent.GetResultTimes()[0]
+    result_time.dirty = True
+    result_time.put()
+    self.assertEqual(
+        (0, (parent.created, parent.key())),
+        result_archive.ArchiveResults(
+            self.CATEGORY, datetime.datetime(2009, 10, 1)))
+    self.assertNotEqual(None, ResultParent.get(parent.key()))
+
+  def testFetchArchivedResults(self):
+    parents = [self.AddResult(month, day)
+               for month, day in ((7, 1), (7, 11), (8, 1), (8, 11), (9, 1))]
+    parents.append(self.AddResult(9, 11, browser='IE 7.0'))
+    result_archive.ArchiveResults(self.CATEGORY, datetime.datetime(2009, 10, 1))
+    newest_first = [p.key() for p in reversed(parents)]
+
+    results, bookmark = result_archive.FetchArchivedResults(
+        self.CATEGORY, None, 4, result_archive.BOOKMARK_PREFIX)
+    self.assertEqual(newest_first[:4], [r.key() for r in results])
+    results, bookmark = result_archive.FetchArchivedResults(
+        self.CATEGORY, None, 4, bookmark)
+    self.assertEqual(newest_first[4:], [r.key() for r in results])
+    self.assertEqual(None, bookmark)
+
+    results, bookmark = result_archive.FetchArchivedResults(
+        self.CATEGORY, 'IE 7', 4, result_archive.BOOKMARK_PREFIX)
+    self.assertEqual([parents[-1].key()], [r.key() for r in results])
+    self.assertEqual(None, bookmark)
+
+  def testParseBookmark(self):
+    prefix = result_archive.BOOKMARK_PREFIX
+    self.assertEqual((None, 0), result_archive.ParseBookmark(prefix))
+    self.assertEqual(('a_2009-09:b', 3),
+                     result_archive.ParseBookmark(prefix + 'a_2009-09:b:3'))
+    for bad_position in ('x', ':3', 'a:', 'a:-1', 'a:x', '__a:3'):
+      self.assertRaises(ValueError, result_archive.ParseBookmark,
+                        prefix + bad_position)
+    self.assertRaises(ValueError, result_archive.FetchArchivedResults,
+                      self.CATEGORY, None, 4, prefix + 'x')
+
+  def testFetchArchivedResultsOldestFirst(self):
+    parents = [self.AddResult(month, day)
+               for month, day in ((7, 1), (7, 11), (8, 1), (8, 11), (9, 1))]
+    result_archive.ArchiveResults(self.CATEGORY, datetime.datetime(2009, 10, 1))
+    oldest_first = [p.key() for p in parents]
+
+    results, bookmark = result_archive.FetchArchivedResults(
+        self.CATEGORY, None, 3, result_archive.BOOKMARK_PREFIX, 'asc')
+    self.assertEqual(oldest_first[:3], [r.key() for r in results])
+    results, bookmark = result_archive.FetchArchivedResults(
+        self.CATEGORY, None, 3, bookmark, 'asc')
+    self.assertEqual(oldest_first[3:], [r.key() for r in results])
+    self.assertEqual(None, bookmark)
+
+  def testArchiveResultsPagesThroughEqualCreatedTimes(self):
+    parents = [self.AddResult(9, 1, is_dirty=True), self.AddResult(9, 1),
+               self.AddResult(9, 1)]
+    dirty_key = parents[0].key()
+    parents.sort(key=lambda p: p.key())
+    before = datetime.datetime(2009, 10, 1)
+    after = None
+    num_archived = 0
+    for i in range(len(parents)):
+      batch_archived, after = result_archive.ArchiveResults(
+          self.CATEGORY, before, after, batch_size=1)
+      num_archived += batch_archived
+      self.assertEqual((parents[i].created, parents[i].key()), after)
+    self.assertEqual(2, num_archived)
+    self.assertEqual((0, None), result_archive.ArchiveResults(
+        self.CATEGORY, before, after, batch_size=1))
+    # Both archived parents kept their own archive; the dirty one is live.
+    self.assertEqual(
+        [p.key() for p in parents if p.key() != dirty_key] + [dirty_key],
+        [r.key() for r in result_archive.IterResults(self.CATEGORY)])
+
+  def testUpdateArchivedStringLists(self):
+    parent = self.AddResult(9, 1)
+    other_parent = self.AddResult(9, 2, browser='IE 7.0')
+    result_archive.ArchiveResults(self.CATEGORY, datetime.datetime(2009, 10, 1))
+    user_agent = parent.user_agent
+    user_agent.family = 'Firefox Beta'
+    user_agent.put()
+
+    self.assertEqual(1, result_archive.UpdateArchivedStringLists(user_agent))
+    self.assertEqual(0, result_archive.UpdateArchivedStringLists(user_agent))
+    results = list(result_archive.IterResults(self.CATEGORY))
+    self.assertEqual([parent.key(), other_parent.key()],
+                     [r.key() for r in results])
+    self.assertEqual(user_agent.get_string_list(), results[0].GetBrowsers())
+    self.assertEqual(other_parent.user_agent_string_list,
+                     results[1].GetBrowsers())
+    self.assertTrue(result_archive.HasArchives(self.CATEGORY, 'Firefox Beta'))
+    self.assertFalse(result_archive.HasArchives(self.CATEGORY, 'Firefox 3.5'))
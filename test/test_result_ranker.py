@@ -24,7 +24,9 @@ import unittest
 from google.appengine.api import datastore
 from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
+from google.appengine.ext import db
 from categories import test_set_base
+from models import ranker_upload
 from models import result_ranker
 from third_party import mox
 
@@ -56,7 +58,9 @@ class RankerCacherTest(unittest.TestCase):
     ranker_class = self.mox.CreateMock(result_ranker.CountRanker)
     self.mox.StubOutWithMock(memcache, 'get_multi')
     memcache.get_multi(['k1'], **self.memcache_params).AndReturn({})
-    ranker_class.get_by_key_name(['k1']).AndReturn(['r1'])
+    ranker_class.kind().AndReturn('CountRanker')
+    self.mox.StubOutWithMock(db, 'get')
+    db.get([db.Key.from_path('CountRanker', 'k1')]).AndReturn(['r1'])
     self.mox.ReplayAll()
     rankers = self.cls.CacheGet(['k1'], {'k1': ranker_class})
     self.mox.VerifyAll()
@@ -66,7 +70,9 @@ class RankerCacherTest(unittest.TestCase):
     ranker_class = self.mox.CreateMock(result_ranker.CountRanker)
     self.mox.StubOutWithMock(memcache, 'get_multi')
     memcache.get_multi(['k1'], **self.memcache_params).AndReturn({})
-    ranker_class.get_by_key_name(['k1']).AndReturn([None])
+    ranker_class.kind().AndReturn('CountRanker')
+    self.mox.StubOutWithMock(db, 'get')
+    db.get([db.Key.from_path('CountRanker', 'k1')]).AndReturn([None])
     self.mox.ReplayAll()
     rankers = self.cls.CacheGet(['k1'], {'k1': ranker_class})
     self.mox.VerifyAll()
@@ -80,9 +86,15 @@ class RankerCacherTest(unittest.TestCase):
         ['ka1', 'ka2', 'kb1', 'kb2', 'kb3'], **self.memcache_params).AndReturn(
         {'ka2': 'sa2'})
     ranker_class_a.FromString('ka2', 'sa2').AndReturn('ra2')
-    ranker_class_a.get_by_key_name(['ka1']).InAnyOrder().AndReturn([])
-    ranker_class_b.get_by_key_name(['kb1', 'kb2', 'kb3']).InAnyOrder(
-        ).AndReturn([None, 'rb2', None])
+    ranker_class_a.kind().AndReturn('CountRanker')
+    for i in range(3):
+      ranker_class_b.kind().AndReturn('LastNRanker')
+    self.mox.StubOutWithMock(db, 'get')
+    db.get([db.Key.from_path('CountRanker', 'ka1'),
+            db.Key.from_path('LastNRanker', 'kb1'),
+            db.Key.from_path('LastNRanker', 'kb2'),
+            db.Key.from_path('LastNRanker', 'kb3')]).AndReturn(
+        [None, None, 'rb2', None])
     self.mox.ReplayAll()
     rankers = self.cls.CacheGet(['ka1', 'ka2', 'kb1', 'kb2', 'kb3'], {
         'ka1': ranker_class_a,
@@ -128,6 +140,21 @@ class CountRankerTest(unittest.TestCase):
     ranker = result_ranker.GetRanker(*self.ranker_params)
     self.assertEqual((1, 8), ranker.GetMedianAndNumScores())
 
+  def testCachePutMulti(self):
+    other_params = (self.test_set.tests[1], 'Android 0.6')
+    other_ranker = result_ranker.NewRanker(*other_params)
+    ranker = result_ranker.GetRanker(*self.ranker_params)
+    ranker.SetValues([0, 3, 1, 3], 7, cache_put=False)
+    other_ranker.SetValues([4, 3], 7, cache_put=False)
+    self.assertEqual(None, result_ranker.GetRanker(*other_params))
+    result_ranker.RankerCacher.CachePutMulti([ranker, other_ranker])
+    ranker = result_ranker.GetRanker(*self.ranker_params)
+    self.assertEqual((2, 7), ranker.GetMedianAndNumScores())
+    other_ranker = result_ranker.GetRanker(*other_params)
+    self.assertEqual((0, 7), other_ranker.GetMedianAndNumScores())
+    self.assertEqual(ranker_upload.ValuesChecksum([4, 3], 7),
+                     other_ranker.GetChecksum())
+
   def testAddScoreTooBig(self):
     ranker = result_ranker.GetRanker(*self.ranker_params)
     ranker.Add(101)
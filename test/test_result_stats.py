@@ -24,7 +24,9 @@ import unittest
 
 from google.appengine.api import memcache
 from google.appengine.ext import db
+from google.appengine.runtime import DeadlineExceededError
 from categories import all_test_sets
+from categories import test_set_base
 from models import result_stats
 from models.result import ResultParent
 from third_party import mox
@@ -65,6 +67,20 @@ class CategoryBrowserManagerTest(unittest.TestCase):
       browsers = self.cls.GetBrowsers('summary', version_level)
       self.assertEqual(expected_browsers, browsers)
 
+  def testAddUserAgents(self):
+    self.cls.AddUserAgents([
+        ('network', mock_data.GetUserAgent('Firefox 3.5')),
+        ('network', mock_data.GetUserAgent('Firefox 3.0.7')),
+        ('security', mock_data.GetUserAgent('IE 7.0')),
+        ('network', mock_data.GetUserAgent('Firefox 3.5')),
+        ])
+    self.assertEqual(['Firefox 3.0.7', 'Firefox 3.5'],
+                     self.cls.GetBrowsers('network', 3))
+    self.assertEqual(['IE 7'], self.cls.GetBrowsers('security', 1))
+    self.assertEqual(['Firefox 3', 'IE 7'], self.cls.GetBrowsers('summary', 1))
+    manager = self.cls.get_by_key_name(self.cls.KeyName('network', 2))
+    self.assertEqual(['Firefox 3.0', 'Firefox 3.5'], manager.browsers)
+
   def testGetBrowsersTop(self):
     expected_browsers = list(result_stats.TOP_BROWSERS)
     browsers = self.cls.GetBrowsers(category='foo', version_level='top')
@@ -176,6 +192,13 @@ class CategoryBrowserManagerTest(unittest.TestCase):
     self.cls.SortBrowsers(browsers)
     self.assertEqual(expected_browsers, browsers)
 
+  def testBrowserKeyMemoized(self):
+    self.cls._browser_keys.clear()
+    browser_key = self.cls.BrowserKey('Firefox 3.5.1')
+    self.assertEqual(self.cls.ParseBrowserKey('Firefox 3.5.1'), browser_key)
+    self.assertTrue(browser_key is self.cls.BrowserKey('Firefox 3.5.1'))
+    self.assertEqual(['Firefox 3.5.1'], self.cls._browser_keys.keys())
+
 
 class CategoryBrowserManagerFilterTest(unittest.TestCase):
 
@@ -225,6 +248,105 @@ class CategoryBrowserManagerFilterTest(unittest.TestCase):
         self.category, ['Firefox 2.5.1', 'Firefox 3.1*', 'Opera*'])
     self.assertEqual(expected_browsers, browsers)
 
+  def testGetFilteredBrowsersOperaMiniPrefix(self):
+    browsers = self.cls.GetFilteredBrowsers(self.category, ['Opera M*'])
+    self.assertEqual(['Opera Mini 4.0.10031'], browsers)
+
+  def testGetPrefixIndexRebuiltOnNewBrowser(self):
+    prefix_index = self.cls.GetPrefixIndex(self.category)
+    self.assertTrue(prefix_index is self.cls.GetPrefixIndex(self.category))
+    result_stats.CategoryBrowserManager.AddUserAgent(
+        self.category, mock_data.GetUserAgent('Firefox 3.1.9'))
+    self.assertEqual(
+        ['Firefox 3.1.7', 'Firefox 3.1.8', 'Firefox 3.1.9'],
+        self.cls.GetFilteredBrowsers(self.category, ['Firefox 3.1*']))
+
+  def testGetPrefixIndexSkipsBrowsersWhenVersionIsUnchanged(self):
+    prefix_index = self.cls.GetPrefixIndex(self.category)
+    old_get_browsers = self.cls.GetBrowsers
+    def FailGetBrowsers(*args, **kwds):
+      self.fail('Browsers read with an unchanged version')
+    self.cls.GetBrowsers = staticmethod(FailGetBrowsers)
+    try:
+      self.assertTrue(prefix_index is self.cls.GetPrefixIndex(self.category))
+    finally:
+      self.cls.GetBrowsers = old_get_browsers
+
+
+class BrowserPrefixIndexTest(unittest.TestCase):
+
+  def testFilter(self):
+    prefix_index = result_stats.BrowserPrefixIndex(
+        ['IE 6', 'IE 7', 'Opera 9', 'Opera Mini 4', 'Safari 4'],
+        exclusions={'IE*': ('IE 6',)})
+    self.assertEqual(['IE 7', 'Opera 9', 'Opera Mini 4'],
+                     prefix_index.Filter(['Opera*', 'IE*', 'IE 7']))
+    self.assertEqual(['IE 6', 'Safari 4'],
+                     prefix_index.Filter(['Safari 4', 'IE 6', 'Chrome*']))
+
+
+class StaticDeltaLogTest(unittest.TestCase):
+
+  def setUp(self):
+    self.mox = mox.Mox()
+    self.cls = result_stats.StaticDeltaLog
+    self.test_set = mock_data.MockTestSet()
+    all_test_sets.AddTestSet(self.test_set)
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    all_test_sets.RemoveTestSet(self.test_set)
+
+  def testAddUserAgent(self):
+    category = 'network'
+    self.cls.AddUserAgent(category, mock_data.GetUserAgent('Firefox 3.5'))
+    self.cls.AddUserAgent(category, mock_data.GetUserAgent('Firefox 3.0.7'))
+    for version_level, expected_browsers in enumerate((
+        ['Firefox'],
+        ['Firefox 3'],
+        ['Firefox 3.0', 'Firefox 3.5'],
+        ['Firefox 3.0.7', 'Firefox 3.5'])):
+      browsers = self.cls.GetBrowsers(category, version_level)
+      self.assertEqual(expected_browsers, sorted(browsers))
+    self.assertEqual(
+        ['Firefox', 'Firefox 3', 'Firefox 3.0', 'Firefox 3.0.7', 'Firefox 3.5'],
+        sorted(self.cls.GetBrowsers(category, 'top')))
+
+  def testGetBrowsersFromDb(self):
+    category = 'network'
+    self.cls.AddUserAgent(category, mock_data.GetUserAgent('IE 7.0'))
+    memcache.flush_all()
+    self.assertEqual(['IE 7.0'], self.cls.GetBrowsers(category, 3))
+
+  def testClear(self):
+    category = 'network'
+    self.cls.AddUserAgent(category, mock_data.GetUserAgent('IE 7.0'))
+    self.cls.Clear(category)
+    self.assertEqual([], self.cls.GetBrowsers(category, 'top'))
+    memcache.flush_all()
+    self.assertEqual([], self.cls.GetBrowsers(category, 'top'))
+
+  def testMergeStats(self):
+    static_stats = {
+        'Firefox 3': {'summary_score': 2, 'total_runs': 8},
+        'IE 7': {'summary_score': 9, 'total_runs': 1},
+        'total_runs': 9,
+        }
+    self.mox.StubOutWithMock(result_stats.CategoryStatsManager, 'GetStats')
+    result_stats.CategoryStatsManager.GetStats(
+        self.test_set, ['IE 7'], ['apple']).AndReturn({
+            'IE 7': {'summary_score': 7, 'total_runs': 4},
+            'total_runs': 4,
+            })
+    self.mox.ReplayAll()
+    stats = self.cls.MergeStats(self.test_set, static_stats, ['IE 7'], ['apple'])
+    self.mox.VerifyAll()
+    self.assertEqual({
+        'Firefox 3': {'summary_score': 2, 'total_runs': 8},
+        'IE 7': {'summary_score': 7, 'total_runs': 4},
+        'total_runs': 12,
+        }, stats)
+
 
 TEST_STATS = {
     'Aardvark': {
@@ -266,6 +388,35 @@ TEST_STATS = {
     }
 
 
+class StatsRefreshLogTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cls = result_stats.StatsRefreshLog
+
+  def testTakeBrowsers(self):
+    category = 'network'
+    self.cls.AddUserAgent(category, mock_data.GetUserAgent('IE 7.0'))
+    self.assertEqual(['IE', 'IE 7', 'IE 7.0'],
+                     sorted(self.cls.TakeBrowsers(category)))
+    self.assertEqual([], self.cls.TakeBrowsers(category))
+    self.cls.AddUserAgent(category, mock_data.GetUserAgent('IE 7.0'))
+    self.assertEqual(['IE', 'IE 7', 'IE 7.0'],
+                     sorted(self.cls.TakeBrowsers(category)))
+
+  def testAddUserAgentIgnoresHintFromBeforeTake(self):
+    category = 'network'
+    key_names = [self.cls.KeyName(category, v) for v in range(4)]
+    self.cls.AddUserAgent(category, mock_data.GetUserAgent('IE 7.0'))
+    stale_hints = memcache.get_multi(
+        key_names, namespace=self.cls.MEMCACHE_NAMESPACE)
+    self.cls.TakeBrowsers(category)
+    # A racing AddUserAgent sets its hint after the take.
+    memcache.set_multi(stale_hints, namespace=self.cls.MEMCACHE_NAMESPACE)
+    self.cls.AddUserAgent(category, mock_data.GetUserAgent('IE 7.0'))
+    self.assertEqual(['IE', 'IE 7', 'IE 7.0'],
+                     sorted(self.cls.TakeBrowsers(category)))
+
+
 class SummaryStatsManagerTest(unittest.TestCase):
 
   def setUp(self):
@@ -278,6 +429,9 @@ class SummaryStatsManagerTest(unittest.TestCase):
         ['Firefox 3', 'Firefox 3.5'], namespace=self.cls.MEMCACHE_NAMESPACE)
     expected_summary_stats = {
         'Firefox 3': {
+            'summary_score': 2,
+            'summary_display': '2/100',
+            'total_runs': 8,
             'results': {
                 'Aardvark': {
                     'score': 2,
@@ -287,6 +441,9 @@ class SummaryStatsManagerTest(unittest.TestCase):
                 },
             },
         'Firefox 3.5': {
+            'summary_score': 5,
+            'summary_display': '5/100',
+            'total_runs': 5,
             'results': {
                 'Aardvark': {
                     'score': 5,
@@ -305,6 +462,9 @@ class SummaryStatsManagerTest(unittest.TestCase):
           category, TEST_STATS[category])
     expected_updated_summary_stats = {
         'Firefox 3': {
+            'summary_score': 4,
+            'summary_display': '4/100',
+            'total_runs': 11,
             'results': {
                 'Aardvark': {
                     'score': 2,
@@ -319,6 +479,9 @@ class SummaryStatsManagerTest(unittest.TestCase):
                 },
             },
         'IE 7': {
+            'summary_score': 9,
+            'summary_display': '9/100',
+            'total_runs': 1,
             'results': {
                 'Badger': {
                     'score': 9,
@@ -332,6 +495,9 @@ class SummaryStatsManagerTest(unittest.TestCase):
     expected_summary_stats = expected_updated_summary_stats.copy()
     expected_summary_stats.update({
         'Firefox 3.5': {
+            'summary_score': 5,
+            'summary_display': '5/100',
+            'total_runs': 5,
             'results': {
                 'Aardvark': {
                     'score': 5,
@@ -390,6 +556,20 @@ class SummaryStatsManagerGetStatsTest(unittest.TestCase):
         ['Firefox 3.5'], categories=['Aardvark', 'Coati'])
     self.assertEqual(expected_summary_stats, summary_stats)
 
+  def testGetStatsServesReadyRows(self):
+    for category in ('Aardvark', 'Coati'):
+      self.cls.UpdateStats(category, TEST_STATS[category])
+    expected_row = memcache.get(
+        'Firefox 3.5', namespace=self.cls.MEMCACHE_NAMESPACE)
+    self.mox.StubOutWithMock(self.cls, '_AddRowSummary')
+    self.mox.StubOutWithMock(self.cls, '_FindAndUpdateStats')
+    self.mox.ReplayAll()
+    summary_stats = self.cls.GetStats(
+        ['Firefox 3.5'], categories=['Aardvark', 'Coati'])
+    self.mox.VerifyAll()
+    self.assertEqual({'Firefox 3.5': expected_row, 'total_runs': 94},
+                     summary_stats)
+
   def testGetStatsTrimUnwanted(self):
     for category in ('Aardvark', 'Coati'):
       updated_summary_stats = self.cls.UpdateStats(
@@ -440,10 +620,11 @@ class SummaryStatsManagerGetStatsTest(unittest.TestCase):
       updated_summary_stats = self.cls.UpdateStats(
           category, TEST_STATS[category])
     self.mox.StubOutWithMock(
-        result_stats.CategoryStatsManager, 'GetStats')
-    result_stats.CategoryStatsManager.GetStats(
-        self.test_set_a, ['Safari'], ['apple', 'banana', 'coconut']
-        ).InAnyOrder().AndReturn({
+        result_stats.CategoryStatsManager, 'GetStatsMulti')
+    result_stats.CategoryStatsManager.GetStatsMulti([
+        (self.test_set_a, ['Safari'], ['apple', 'banana', 'coconut']),
+        (self.test_set_b, ['Safari'], ['apple', 'banana', 'coconut']),
+        ]).AndReturn([{
             'Safari': {
                 'summary_score': 0,
                 'summary_display': '',
@@ -457,10 +638,7 @@ class SummaryStatsManagerGetStatsTest(unittest.TestCase):
                     },
                 },
             'total_runs': 0,
-            })
-    result_stats.CategoryStatsManager.GetStats(
-        self.test_set_b, ['Safari'], ['apple', 'banana', 'coconut']
-        ).InAnyOrder().AndReturn({
+            }, {
             'Safari': {
                 'summary_score': 5,
                 'summary_display': '5/15',
@@ -474,7 +652,7 @@ class SummaryStatsManagerGetStatsTest(unittest.TestCase):
                      },
                 },
             'total_runs': 15,
-            })
+            }])
     self.mox.ReplayAll()
     expected_summary_stats = {
         'Firefox 3': {
@@ -587,6 +765,83 @@ class CategoryStatsManagerTest(unittest.TestCase):
         self.test_set, browsers=('Firefox 3.0.7', 'Firefox 3.5'),
         test_keys=['apple', 'banana', 'coconut']))
 
+  def testGetStatsSubsetFetchesOnlyMissingShards(self):
+    cls = result_stats.CategoryStatsManager
+    self.mox = mox.Mox()
+    cls.TESTS_PER_SHARD, old_tests_per_shard = 1, cls.TESTS_PER_SHARD
+    try:
+      for scores, browser in (((1, 3, 100), 'Firefox 3.5'),
+                              ((0, 4, 400), 'Firefox 3.5')):
+        ResultParent.AddResult(
+            self.test_set, '12.2.2.25', mock_data.GetUserAgentString(browser),
+            'apple=%s,banana=%s,coconut=%s' % scores)
+      full_stats = cls.GetStats(self.test_set, ['Firefox 3.5'],
+                                ['apple', 'banana', 'coconut'])
+      # Drop the banana column; only its rankers should be read again.
+      memcache.delete(cls.ShardKey('Firefox 3.5', 't1'),
+                      **cls.MemcacheParams(self.test_set.category))
+      self.mox.StubOutWithMock(test_set_base, 'GetMediansAndNumScoresMulti')
+      test_set_base.GetMediansAndNumScoresMulti([
+          (self.test_set, 'Firefox 3.5', [self.test_set.GetTest('banana')]),
+          ]).AndReturn([({'banana': 4}, {'banana': 2})])
+      self.mox.ReplayAll()
+      stats = cls.GetStats(self.test_set, ['Firefox 3.5'], ['banana'])
+      self.mox.VerifyAll()
+      expected_row = dict(full_stats['Firefox 3.5'])
+      expected_row['results'] = {
+          'banana': full_stats['Firefox 3.5']['results']['banana']}
+      self.assertEqual(expected_row, stats['Firefox 3.5'])
+    finally:
+      cls.TESTS_PER_SHARD = old_tests_per_shard
+      self.mox.UnsetStubs()
+
+
+  def testGetStatsLeavesOutRowsAfterDeadline(self):
+    cls = result_stats.CategoryStatsManager
+    self.mox = mox.Mox()
+    try:
+      memcache.flush_all()
+      self.mox.StubOutWithMock(test_set_base, 'GetMediansAndNumScoresMulti')
+      test_set_base.GetMediansAndNumScoresMulti(
+          mox.IgnoreArg()).AndRaise(DeadlineExceededError)
+      self.mox.ReplayAll()
+      incomplete_browsers = []
+      stats = cls.GetStats(self.test_set, ['Firefox 3.5'],
+                           ['apple', 'banana', 'coconut'],
+                           incomplete_browsers=incomplete_browsers)
+      self.mox.VerifyAll()
+      self.assertEqual({'total_runs': 0}, stats)
+      self.assertEqual(['Firefox 3.5'], incomplete_browsers)
+    finally:
+      self.mox.UnsetStubs()
+
+  def testGetStatsCachesBigTablesRowByRow(self):
+    cls = result_stats.CategoryStatsManager
+    self.mox = mox.Mox()
+    cls.INCREMENTAL_SAVE_NUM_TESTS, old_num_tests = (
+        1, cls.INCREMENTAL_SAVE_NUM_TESTS)
+    try:
+      for browser in ('Firefox 3.0.7', 'Firefox 3.5'):
+        ResultParent.AddResult(
+            self.test_set, '12.2.2.25', mock_data.GetUserAgentString(browser),
+            'apple=1,banana=3,coconut=100')
+      memcache.flush_all()
+      self.mox.StubOutWithMock(memcache, 'set_multi')
+      for browser in ('Firefox 3.0.7', 'Firefox 3.5'):
+        memcache.set_multi(
+            mox.Func(lambda shards, b=browser: cls.ShardKey(
+                b, cls.SUMMARY_SHARD) in shards and len(shards) == 2),
+            **cls.MemcacheParams(self.test_set.category))
+      self.mox.ReplayAll()
+      stats = cls.GetStats(self.test_set, ['Firefox 3.0.7', 'Firefox 3.5'],
+                           ['apple', 'banana', 'coconut'])
+      self.mox.VerifyAll()
+      self.assertEqual(['Firefox 3.0.7', 'Firefox 3.5', 'total_runs'],
+                       sorted(stats))
+    finally:
+      cls.INCREMENTAL_SAVE_NUM_TESTS = old_num_tests
+      self.mox.UnsetStubs()
+
 
 class UpdateStatsCacheTest(unittest.TestCase):
 
@@ -606,20 +861,54 @@ class UpdateStatsCacheTest(unittest.TestCase):
     cls = result_stats.CategoryStatsManager
     browsers = ['Earth', 'Wind', 'Fire']
     test_keys = ['apple', 'banana', 'coconut']
-    self.mox.StubOutWithMock(self.test_set, 'GetMediansAndNumScores')
-    self.mox.StubOutWithMock(self.test_set, 'GetStats')
+    self.mox.StubOutWithMock(self.test_set, 'GetMediansAndNumScoresMulti')
+    self.mox.StubOutWithMock(self.test_set, 'GetStatsMatrix')
     self.mox.StubOutWithMock(result_stats.SummaryStatsManager, 'UpdateStats')
-    self.test_set.GetMediansAndNumScores('Earth').AndReturn(('m1', 'n1'))
-    self.test_set.GetStats(test_keys, 'm1', 'n1').AndReturn('s1')
-    self.test_set.GetMediansAndNumScores('Wind').AndReturn(('m2', 'n2'))
-    self.test_set.GetStats(test_keys, 'm2', 'n2').AndReturn('s2')
-    self.test_set.GetMediansAndNumScores('Fire').AndReturn(('m3', 'n3'))
-    self.test_set.GetStats(test_keys, 'm3', 'n3').AndReturn('s3')
-    expected_ua_stats = {'Earth': 's1', 'Wind': 's2', 'Fire': 's3'}
+    s1, s2, s3 = [{
+        'summary_score': i,
+        'summary_display': str(i),
+        'total_runs': i,
+        'results': {'apple': {'score': i, 'raw_score': i, 'display': str(i)}},
+        } for i in range(1, 4)]
+    self.test_set.GetMediansAndNumScoresMulti(browsers).AndReturn(dict(
+        (browser, ({'apple': i, 'banana': 10 + i, 'coconut': 20 + i},
+                   {'apple': 1, 'banana': 1, 'coconut': 1}))
+        for i, browser in enumerate(browsers)))
+    self.test_set.GetStatsMatrix(
+        test_keys, [[0, 10, 20], [1, 11, 21], [2, 12, 22]],
+        [[1, 1, 1]] * 3).AndReturn([s1, s2, s3])
+    expected_ua_stats = {'Earth': s1, 'Wind': s2, 'Fire': s3}
     result_stats.SummaryStatsManager.UpdateStats(
         category, expected_ua_stats).AndReturn('notused')
     self.mox.ReplayAll()
     cls.UpdateStatsCache(category, browsers)
     self.mox.VerifyAll()
-    ua_stats = memcache.get_multi(browsers, **cls.MemcacheParams(category))
+    ua_stats = cls.GetCachedStats(self.test_set, browsers)
     self.assertEqual(expected_ua_stats, ua_stats)
+
+  def testTimeoutFallsBackToOneBrowserAtATime(self):
+    category = self.test_set.category
+    cls = result_stats.CategoryStatsManager
+    browsers = ['Earth', 'Wind', 'Fire']
+    self.mox.StubOutWithMock(self.test_set, 'GetMediansAndNumScoresMulti')
+    self.mox.StubOutWithMock(self.test_set, 'GetMediansAndNumScores')
+    self.mox.StubOutWithMock(self.test_set, 'GetStatsMatrix')
+    self.mox.StubOutWithMock(result_stats.SummaryStatsManager, 'UpdateStats')
+    self.test_set.GetMediansAndNumScoresMulti(browsers).AndRaise(db.Timeout)
+    self.test_set.GetMediansAndNumScores('Earth').AndReturn(
+        ({'apple': 0, 'banana': 10, 'coconut': 20},
+         {'apple': 1, 'banana': 1, 'coconut': 1}))
+    self.test_set.GetMediansAndNumScores('Wind').AndRaise(db.Timeout)
+    s1 = {
+        'summary_score': 1,
+        'summary_display': '1',
+        'total_runs': 1,
+        'results': {'apple': {'score': 1, 'raw_score': 1, 'display': '1'}},
+        }
+    self.test_set.GetStatsMatrix(
+        ['apple', 'banana', 'coconut'], [[0, 10, 20]],
+        [[1, 1, 1]]).AndReturn([s1])
+    self.mox.ReplayAll()
+    self.assertEqual(['Wind', 'Fire'], cls.UpdateStatsCache(category, browsers))
+    self.mox.VerifyAll()
+    self.assertEqual({'Earth': s1}, cls.GetCachedStats(self.test_set, browsers))
@@ -21,6 +21,7 @@ __author__ = 'slamm@google.com (Stephen Lamm)'
 
 import unittest
 
+from categories import all_test_sets
 from categories import test_set_base
 import mock_data
 
@@ -137,3 +138,88 @@ class TestGetStats(unittest.TestCase):
         }
     stats = test_set.GetStats(['banana', 'coconut'], raw_scores, num_scores)
     self.assertEqual(expected_stats, stats)
+
+
+class TestGetStatsMatrix(unittest.TestCase):
+
+  def assertMatchesGetStats(self, test_set, medians_rows, num_scores_rows):
+    test_keys = [t.key for t in test_set.VisibleTests()]
+    medians_matrix = [[row.get(t.key) for t in test_set.tests]
+                      for row in medians_rows]
+    num_scores_matrix = [[row.get(t.key, 0) for t in test_set.tests]
+                         for row in num_scores_rows]
+    expected_stats = [test_set.GetStats(test_keys, medians, num_scores)
+                      for medians, num_scores in zip(medians_rows,
+                                                     num_scores_rows)]
+    self.assertEqual(expected_stats, test_set.GetStatsMatrix(
+        test_keys, medians_matrix, num_scores_matrix))
+
+  def testMockTestSet(self):
+    test_set = mock_data.MockTestSet()
+    medians_rows = [
+        {'apple': 1, 'banana': 2, 'coconut': 3},
+        {'apple': 0, 'banana': 2, 'coconut': 300},
+        {'apple': 1, 'banana': 50, 'coconut': 3},
+        ]
+    num_scores_rows = [
+        {'apple': 1, 'banana': 2, 'coconut': 3},
+        {'apple': 5, 'banana': 1, 'coconut': 1},
+        {'apple': 0, 'banana': 0, 'coconut': 0},
+        ]
+    self.assertMatchesGetStats(test_set, medians_rows, num_scores_rows)
+
+  def testNoNumScores(self):
+    test_set = mock_data.MockTestSet()
+    stats = test_set.GetStatsMatrix(['apple', 'coconut'], [[1, 2, 3]])
+    self.assertEqual([test_set.GetStats(
+        ['apple', 'coconut'], {'apple': 1, 'banana': 2, 'coconut': 3})], stats)
+
+  def testVisibleTestSets(self):
+    for test_set in all_test_sets.GetVisibleTestSets():
+      if test_set.category == 'summary':
+        continue
+      medians_rows = [dict((t.key, None) for t in test_set.tests)]
+      for value in (0, 1, 2, 3, 10, 25, 100, 2050):
+        row = {}
+        for test in test_set.tests:
+          row[test.key] = None
+          if test.min_value <= value <= test.max_value:
+            row[test.key] = value
+        medians_rows.append(row)
+      num_scores_rows = [dict((t.key, i) for t in test_set.tests)
+                         for i in range(len(medians_rows))]
+      self.assertMatchesGetStats(test_set, medians_rows, num_scores_rows)
+
+
+class TestScoreTable(unittest.TestCase):
+
+  def testGetScoreTable(self):
+    test_set = mock_data.MockTestSet()
+    table = test_set.GetScoreTable('banana')
+    # None is left out; the mock test set cannot score it.
+    self.assertEqual(101, len(table))
+    self.assertEqual((8, 'd:8'), table[4])
+    self.assertTrue(table is test_set.GetScoreTable('banana'))
+
+  def testNoTableForDependentScores(self):
+    test_set = mock_data.MockTestSet()
+    test_set.independent_test_scores = False
+    self.assertEqual(None, test_set.GetScoreTable('banana'))
+
+  def testLookupOutOfRangeFallsBack(self):
+    test_set = mock_data.MockTestSet()
+    self.assertEqual((400, 'd:400'), test_set.LookupTestScoreAndDisplayValue(
+        'banana', {'banana': 200}))
+    self.assertEqual((4, 'd:4'), test_set.LookupTestScoreAndDisplayValue(
+        'banana', {'banana': 2}))
+
+  def testGetStatsUsesTable(self):
+    test_set = mock_data.MockTestSet()
+    test_set.GetScoreTable('coconut')
+    def FailScalar(test_key, raw_scores):
+      self.fail('Scored %s=%s without the table' % (test_key, raw_scores))
+    test_set.GetTestScoreAndDisplayValue = FailScalar
+    stats = test_set.GetStats(['coconut'], {'coconut': 7})
+    self.assertEqual(
+        {'raw_score': 7, 'score': 14, 'display': 'd:14'},
+        stats['results']['coconut'])
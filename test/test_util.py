@@ -20,7 +20,9 @@ __author__ = 'elsigh@google.com (Lindsey Simon)'
 
 import unittest
 import random
+import re
 import logging
+import time
 
 from google.appengine.ext import db
 from google.appengine.api import memcache
@@ -30,6 +32,7 @@ from base import util
 from categories import all_test_sets
 from categories import test_set_params
 from models import result
+from models import result_stats
 from models.user_agent import UserAgent
 
 import mock_data
@@ -189,5 +192,173 @@ class TestClearMemcache(unittest.TestCase):
     self.assertEqual(None, recent_tests)
     self.assertEqual(200, response.status_code)
 
+
+class TestConditionalGet(unittest.TestCase):
+  def setUp(self):
+    self.test_set = mock_data.MockTestSet()
+    all_test_sets.AddTestSet(self.test_set)
+    self.client = Client()
+
+  def tearDown(self):
+    all_test_sets.RemoveTestSet(self.test_set)
+
+  def testGvizTableDataNotModified(self):
+    params = {'category': self.test_set.category, 'v': '3'}
+    response = self.client.get('/gviz_table_data', params,
+                               **mock_data.UNIT_TEST_UA)
+    self.assertEqual(200, response.status_code)
+    etag = response['ETag']
+    self.assertTrue(response.has_header('Last-Modified'))
+
+    headers = dict(mock_data.UNIT_TEST_UA, HTTP_IF_NONE_MATCH=etag)
+    response = self.client.get('/gviz_table_data', params, **headers)
+    self.assertEqual(304, response.status_code)
+    self.assertEqual('', response.content)
+
+    # Any stats update for the category changes the tag.
+    result_stats.CategoryContentVersion.Bump(self.test_set.category)
+    response = self.client.get('/gviz_table_data', params, **headers)
+    self.assertEqual(200, response.status_code)
+    self.assertNotEqual(etag, response['ETag'])
+
+  def testETagDependsOnParams(self):
+    params = {'category': self.test_set.category, 'v': '3'}
+    response = self.client.get('/gviz_table_data', params,
+                               **mock_data.UNIT_TEST_UA)
+    headers = dict(mock_data.UNIT_TEST_UA, HTTP_IF_NONE_MATCH=response['ETag'])
+    params['v'] = '2'
+    response = self.client.get('/gviz_table_data', params, **headers)
+    self.assertEqual(200, response.status_code)
+
+
+class TestRenderedStatsCache(unittest.TestCase):
+  def setUp(self):
+    self.test_set = mock_data.MockTestSet()
+    all_test_sets.AddTestSet(self.test_set)
+    self.client = Client()
+
+  def tearDown(self):
+    all_test_sets.RemoveTestSet(self.test_set)
+
+  def testSplitGvizReqId(self):
+    self.assertEqual(
+        ('reqId:%s;out:json' % util.GVIZ_REQ_ID_PLACEHOLDER, '7'),
+        util.SplitGvizReqId('reqId:7;out:json'))
+    self.assertEqual(('out:json', None), util.SplitGvizReqId('out:json'))
+    self.assertEqual(
+        ('reqId:%s' % util.GVIZ_REQ_ID_PLACEHOLDER, util.GVIZ_DEFAULT_REQ_ID),
+        util.SplitGvizReqId('reqId:</script>'))
+
+  def GvizReqId(self, tqx):
+    params = {'category': self.test_set.category, 'v': '3', 'tqx': tqx}
+    response = self.client.get('/gviz_table_data', params,
+                               **mock_data.UNIT_TEST_UA)
+    self.assertFalse(util.GVIZ_REQ_ID_PLACEHOLDER in response.content)
+    match = re.search(r"""['"]reqId['"]\s*:\s*['"]([^'"]*)['"]""",
+                      response.content)
+    return match.group(1)
+
+  def testGvizTableDataReqId(self):
+    self.assertEqual('1', self.GvizReqId('reqId:1'))
+    # The second request is served from the rendered cache.
+    self.assertEqual('2', self.GvizReqId('reqId:2'))
+
+  def testGvizTableDataBadReqId(self):
+    self.assertEqual(util.GVIZ_DEFAULT_REQ_ID,
+                     self.GvizReqId("reqId:1'});alert(1);({'x"))
+
+  def testGetRequestBrowserUsesStoredUserAgent(self):
+    user_agent = mock_data.GetUserAgent('Firefox 3.5')
+    user_agent.family = 'Firefox Beta'
+    user_agent.put()
+    class FakeRequest(object):
+      REQUEST = {}
+      META = {'HTTP_USER_AGENT':
+              mock_data.GetUserAgentString('Firefox 3.5') + ',gzip(gfe)'}
+    self.assertEqual('Firefox Beta 3.5', util.GetRequestBrowser(FakeRequest()))
+
+  def testHasResultsParams(self):
+    class FakeRequest(object):
+      GET = {'category': 'foo', 'foo_results': 'None'}
+    self.assertFalse(util.HasResultsParams(FakeRequest()))
+    FakeRequest.GET['foo_results'] = 'apple=1'
+    self.assertTrue(util.HasResultsParams(FakeRequest()))
+
+
+class TestBrowseResults(unittest.TestCase):
+  def setUp(self):
+    self.test_set = mock_data.MockTestSet()
+    all_test_sets.AddTestSet(self.test_set)
+    self.client = Client()
+
+  def tearDown(self):
+    all_test_sets.RemoveTestSet(self.test_set)
+
+  def testBadArchiveBookmark(self):
+    response = self.client.get(
+        '/browse', {'category': self.test_set.category,
+                    'bookmark': 'archive:x'}, **mock_data.UNIT_TEST_UA)
+    self.assertEqual(400, response.status_code)
+
+
+class TestStatsViews(unittest.TestCase):
+  def setUp(self):
+    self.test_set = mock_data.MockTestSet()
+    all_test_sets.AddTestSet(self.test_set)
+    self.client = Client()
+    memcache.flush_all()
+
+  def tearDown(self):
+    all_test_sets.RemoveTestSet(self.test_set)
+
+  def testStatsViewUrl(self):
+    view_key = util.StatsViewKey('network', '3', 'a,b')
+    self.assertEqual(
+        '/gviz_table_data?category=network&v=3&o=gviz_data&f=a%2Cb',
+        util.StatsViewUrl(view_key))
+
+  def testRankViews(self):
+    category = self.test_set.category
+    for version_level, hits in (('1', 1), ('2', 3), ('3', 2)):
+      for i in range(hits):
+        self.client.get('/gviz_table_data',
+                        {'category': category, 'v': version_level},
+                        **mock_data.UNIT_TEST_UA)
+    self.client.get('/gviz_table_data', {'category': category, 'v': '0'},
+                    HTTP_X_BROWSERSCOPE_WARMER='1', **mock_data.UNIT_TEST_UA)
+    view_keys = [util.StatsViewKey(category, v) for v in ('2', '3', '1')]
+    self.assertEqual(view_keys, util.GetStatsViewsToWarm(5))
+    self.assertEqual(view_keys[:2], util.GetStatsViewsToWarm(2))
+
+    now = time.time()
+    util.MarkStatsViewsWarmed(view_keys[:1], now=now)
+    self.assertEqual(view_keys[1:], util.GetStatsViewsToWarm(5, now=now))
+
+  def testRecordOnlyValidViews(self):
+    category = self.test_set.category
+    for params in ({'v': 'bogus'}, {'v': '3', 'f': 'apple,bogus'},
+                   {'v': '3', 'f': 'apple,banana'}):
+      params['category'] = category
+      self.client.get('/gviz_table_data', params, **mock_data.UNIT_TEST_UA)
+    self.assertEqual([util.StatsViewKey(category, '3', 'apple,banana')],
+                     util.GetStatsViewsToWarm(5))
+
+  def testViewIndexIsBounded(self):
+    category = self.test_set.category
+    old_max = util.STATS_VIEWS_MAX
+    util.STATS_VIEWS_MAX = 2
+    try:
+      for version_level, hits in (('1', 2), ('2', 1), ('3', 1)):
+        for i in range(hits):
+          self.client.get('/gviz_table_data',
+                          {'category': category, 'v': version_level},
+                          **mock_data.UNIT_TEST_UA)
+    finally:
+      util.STATS_VIEWS_MAX = old_max
+    self.assertEqual(
+        [util.StatsViewKey(category, v) for v in ('1', '3')],
+        util.GetStatsViewsToWarm(5))
+
+
 if __name__ == '__main__':
   unittest.main()
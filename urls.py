@@ -58,10 +58,14 @@ urlpatterns = patterns('',
   (r'^admin$', 'base.admin.Admin'),
   (r'^admin/confirm-ua', 'base.admin.ConfirmUa'),
   (r'^admin/stats', 'base.admin.Stats'),
+  (r'^admin/rankers/upload_packed$',
+   'base.admin_rankers.UploadPackedRankers'),
   (r'^admin/rankers/upload', 'base.admin_rankers.UploadRankers'),
   (r'^admin/upload_category_browsers', 'base.admin.UploadCategoryBrowsers'),
+  (r'^admin/update_categories$', 'base.admin.UpdateCategories'),
   (r'^admin/update_category', 'base.admin.UpdateCategory'),
   (r'^admin/update_summary_browsers', 'base.admin.UpdateSummaryBrowsers'),
+  (r'^admin/reset_static_delta', 'base.admin.ResetStaticDelta'),
   (r'^admin/update_stats_cache', 'base.admin.UpdateStatsCache'),
   (r'^admin/update_all_uncached_stats', 'base.admin.UpdateAllUncachedStats'),
   (r'^admin/update_all_stats_cache', 'base.admin.UpdateAllStatsCache'),
@@ -80,12 +84,18 @@ urlpatterns = patterns('',
   (r'^admin/ua_test', 'base.ua.ParseTest'),
   (r'^admin/test_task_queue', 'gaeunit_test.TaskHandler'),
   (r'^admin/getdirty', 'base.admin.GetDirty'),
+  (r'^admin/update_ua_string_lists$',
+    'base.admin.UpdateUserAgentStringLists'),
   (r'^admin/update_ua_string_list',
     'base.admin.UpdateUserAgentStringListInResultParentForBrowse'),
+  (r'^admin/archive_results$', 'base.admin.ArchiveResults'),
+  (r'^admin/migrate_dirty_result_times$',
+    'base.admin.MigrateDirtyResultTimes'),
 
   # Cron admin scripts
   (r'^cron/update_recent_tests$', 'base.cron.UpdateRecentTests'),
   (r'^cron/update_test_beacon_counts$', 'base.cron.UpdateUserTestBeaconCounts'),
+  (r'^cron/warm_stats_views$', 'base.cron.WarmStatsViews'),
 
 
   (r'^_ah/queue/update-dirty', 'base.manage_dirty.UpdateDirty'),